@@ -0,0 +1,204 @@
+"""
+Benchmarks of the ML service: gallery loading, gallery search, compact
+gallery precisions and /recognize_face end to end through the Flask app.
+"""
+
+import os
+import io
+import shutil
+import tempfile
+
+import numpy as np
+import face_recognition
+
+from machine_learning_client import ml_client
+from machine_learning_client.gallery_index import GalleryIndex
+from machine_learning_client.result_cache import ResultCache
+
+from .harness import run_load, time_calls
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMAGES_DIR = os.path.join(REPO_ROOT, "images")
+
+
+def synthetic_gallery(size, seed=0):
+    """
+    Return random encodings shaped and scaled like face encodings.
+    Args:
+        size (int): Number of encodings.
+        seed (int): Random seed, so every run searches the same gallery.
+    Returns:
+        tuple: A (size, 128) float32 matrix and names for its rows.
+    """
+    rng = np.random.default_rng(seed)
+    matrix = rng.normal(0, 0.09, (size, 128)).astype(np.float32)
+    return matrix, [f"character_{i}" for i in range(size)]
+
+
+def bench_load_encodings(repeat):
+    """
+    Time load_character_encodings on the repository's images.
+    ``cold`` encodes every image with an empty encoding store; ``warm``
+    reuses the store written by the previous call.
+    """
+    cache_dir = tempfile.mkdtemp(prefix="bench-encodings-")
+    original = ml_client.IMAGES_PATH, ml_client.ENCODING_CACHE_PATH
+    ml_client.IMAGES_PATH = IMAGES_DIR
+    ml_client.ENCODING_CACHE_PATH = os.path.join(cache_dir, "store")
+    try:
+
+        def cold():
+            shutil.rmtree(ml_client.ENCODING_CACHE_PATH, ignore_errors=True)
+            ml_client.load_character_encodings()
+
+        return {
+            "load_encodings.cold": time_calls(cold, repeat, warmup=0),
+            "load_encodings.warm": time_calls(
+                ml_client.load_character_encodings, repeat * 5
+            ),
+        }
+    finally:
+        ml_client.IMAGES_PATH, ml_client.ENCODING_CACHE_PATH = original
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def bench_search(sizes, repeat):
+    """
+    Time matching one face against synthetic galleries of several sizes.
+    ``face_distance`` is face_recognition's own distance computation over a
+    list of encodings; ``exact`` and ``ivf`` are the service's GalleryIndex
+    modes returning the top 3 matches.
+    """
+    results = {}
+    query = synthetic_gallery(1, seed=1)[0][0]
+    for size in sizes:
+        matrix, names = synthetic_gallery(size)
+        encodings = list(matrix)
+        results[f"search.face_distance.{size}"] = time_calls(
+            lambda encodings=encodings: face_recognition.face_distance(
+                encodings, query
+            ),
+            repeat,
+        )
+        exact = GalleryIndex(matrix, names)
+        results[f"search.exact.{size}"] = time_calls(
+            lambda exact=exact: exact.matches(query, k=3), repeat
+        )
+        if size >= 1000:
+            ivf = GalleryIndex(matrix, names, mode="ivf")
+            results[f"search.ivf.{size}"] = time_calls(
+                lambda ivf=ivf: ivf.matches(query, k=3), repeat
+            )
+    return results
+
+
+def precision_drift(matrix, names, precision, batch):
+    """
+    Compare one precision's results for a batch of queries with float32.
+    Returns:
+        dict: The bytes the precision saves, how many top matches change
+        with and without re-ranking, the largest distance error and how
+        many match/no-match decisions flip at THRESHOLD.
+    """
+    reference = GalleryIndex(matrix, names)
+    index = GalleryIndex(matrix, names, precision=precision)
+    unranked = GalleryIndex(matrix, names, precision=precision, rerank=1)
+    exact_rows, exact_distances = reference.search(batch, k=1)
+    found_rows, distances = index.search(batch, k=1)
+    unranked_rows, _ = unranked.search(batch, k=1)
+    search_bytes = index.memory_report()["search_bytes"]
+    return {
+        "search_bytes": search_bytes,
+        "saved_bytes": reference.memory_report()["search_bytes"] - search_bytes,
+        "top1_changed": int((found_rows[:, 0] != exact_rows[:, 0]).sum()),
+        "top1_changed_without_rerank": int(
+            (unranked_rows[:, 0] != exact_rows[:, 0]).sum()
+        ),
+        "max_distance_error": float(
+            np.abs(distances[:, 0] - exact_distances[:, 0]).max()
+        ),
+        "threshold_flips": int(
+            (
+                (distances[:, 0] <= ml_client.THRESHOLD)
+                != (exact_distances[:, 0] <= ml_client.THRESHOLD)
+            ).sum()
+        ),
+        "queries": len(batch),
+    }
+
+
+def bench_precision(sizes, repeat, queries=500):
+    """
+    Compare compact gallery precisions with the float32 gallery.
+    Queries are gallery rows plus noise, spread so their nearest distances
+    straddle THRESHOLD. Every result holds the search latency and the
+    memory and drift figures of precision_drift.
+    """
+    results = {}
+    rng = np.random.default_rng(2)
+    for size in sizes:
+        matrix, names = synthetic_gallery(size)
+        noise = rng.normal(size=(queries, 128)) * rng.uniform(0.03, 0.1, (queries, 1))
+        batch = (matrix[rng.integers(0, size, queries)] + noise).astype(np.float32)
+        for precision in ("float32", "float16", "int8"):
+            index = GalleryIndex(matrix, names, precision=precision)
+            results[f"precision.{precision}.{size}"] = {
+                **time_calls(
+                    lambda index=index, query=batch[0]: index.matches(query, k=3),
+                    repeat,
+                ),
+                **precision_drift(matrix, names, precision, batch),
+            }
+    return results
+
+
+def bench_recognize_face(requests, concurrency):
+    """
+    Load /recognize_face through the Flask app with the repository's images.
+    ``uncached`` runs detection, encoding and matching for every request;
+    ``cached`` repeats one image so responses come from the result cache.
+    Uncached requests are sent one at a time: running dlib's models on
+    several threads of one process has crashed it, and the service relies on
+    the inference pool (ML_WORKERS) for concurrent recognition.
+    """
+    original = ml_client.IMAGES_PATH, ml_client.ENCODING_CACHE_PATH
+    ml_client.IMAGES_PATH = IMAGES_DIR
+    ml_client.ENCODING_CACHE_PATH = ""
+    ml_client.swap_gallery(ml_client.build_gallery())
+    images = []
+    for filename in sorted(os.listdir(IMAGES_DIR)):
+        with open(os.path.join(IMAGES_DIR, filename), "rb") as f:
+            images.append(f.read())
+
+    def make_worker(pick):
+        def factory():
+            client = ml_client.app.test_client()
+
+            def send(number):
+                data = {"file": (io.BytesIO(pick(number)), "image.jpg")}
+                response = client.post(
+                    "/recognize_face", data=data, content_type="multipart/form-data"
+                )
+                assert response.status_code in (200, 400), response.data
+
+            return send
+
+        return factory
+
+    results = {}
+    original_cache = ml_client.RESULT_CACHE
+    try:
+        ml_client.RESULT_CACHE = ResultCache(0, 0, 0)
+        results["recognize_face.uncached"] = run_load(
+            make_worker(lambda number: images[number % len(images)]),
+            requests,
+            concurrency=1,
+        )
+        ml_client.RESULT_CACHE = ResultCache(1024, 16 * 1024 * 1024, 3600)
+        results["recognize_face.cached"] = run_load(
+            make_worker(lambda _: images[0]), requests * 5, concurrency
+        )
+    finally:
+        ml_client.RESULT_CACHE = original_cache
+        ml_client.IMAGES_PATH, ml_client.ENCODING_CACHE_PATH = original
+    return results
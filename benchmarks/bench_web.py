@@ -0,0 +1,137 @@
+"""
+Benchmark of web_app's /capture end to end, with a stand-in ML service and
+an in-memory stand-in for MongoDB, so it runs without either.
+"""
+
+import io
+import json
+import time
+import threading
+from collections import defaultdict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from web_app import web_app
+from web_app.capture_store import CaptureRecorder
+
+from .harness import run_load
+
+
+class StandInMLService(HTTPAdapter):
+    """
+    Transport adapter answering ML service calls in-process.
+    The request body is read as ml-client would read it, then a fixed match
+    is returned after ``latency`` seconds.
+    """
+
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+
+    def send(
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        body = request.body
+        if hasattr(body, "read"):
+            body.read()
+        if self.latency:
+            time.sleep(self.latency)
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps(  # pylint: disable=protected-access
+            {"matched_character": "harry", "distance": 0.4}
+        ).encode()
+        response.request = request
+        response.url = request.url
+        return response
+
+
+class InMemoryCollection:
+    """Collection stand-in that counts writes and serves no documents."""
+
+    def __init__(self, counts, name):
+        self.counts = counts
+        self.name = name
+        self.lock = threading.Lock()
+
+    def _count(self, operation, amount=1):
+        with self.lock:
+            self.counts[f"{self.name}.{operation}"] += amount
+
+    def insert_one(self, _document):
+        """Count an insert."""
+        self._count("insert_one")
+
+    def insert_many(self, documents, ordered=True):  # pylint: disable=unused-argument
+        """Count a batch insert."""
+        self._count("insert_many", len(documents))
+
+    def bulk_write(self, operations, ordered=True):  # pylint: disable=unused-argument
+        """Count a bulk write."""
+        self._count("bulk_write", len(operations))
+
+
+class InMemoryDatabase(dict):
+    """Database stand-in creating collections on first use."""
+
+    def __init__(self):
+        super().__init__()
+        self.counts = defaultdict(int)
+
+    def __missing__(self, name):
+        self[name] = InMemoryCollection(self.counts, name)
+        return self[name]
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+def bench_capture(requests_count, concurrency, ml_latency, image_size=64 * 1024):
+    """
+    Load /capture with logged-in clients.
+    Args:
+        requests_count (int): Total number of timed captures.
+        concurrency (int): Number of concurrent clients.
+        ml_latency (float): Seconds the stand-in ML service takes per call.
+        image_size (int): Bytes uploaded per capture.
+    Returns:
+        dict: The ``capture`` summary.
+    """
+    database = InMemoryDatabase()
+    session = web_app.ml_service.session
+    original = (
+        session.adapters.copy(),
+        web_app.db,
+        web_app.capture_recorder,
+        web_app.ml_service.breaker.failure_threshold,
+    )
+    session.mount("http://", StandInMLService(ml_latency))
+    web_app.db = database
+    web_app.capture_recorder = CaptureRecorder(database)
+    web_app.ml_service.breaker.failure_threshold = float("inf")
+    image = b"\xff" * image_size
+
+    def make_worker():
+        client = web_app.app.test_client()
+        with client.session_transaction() as flask_session:
+            flask_session["username"] = f"bench-{threading.get_ident()}"
+
+        def send(_number):
+            data = {"image": (io.BytesIO(image), "capture.jpg", "image/jpeg")}
+            response = client.post(
+                "/capture", data=data, content_type="multipart/form-data"
+            )
+            assert response.status_code == 200, response.data
+
+        return send
+
+    try:
+        summary = run_load(make_worker, requests_count, concurrency)
+    finally:
+        session.adapters.clear()
+        session.adapters.update(original[0])
+        web_app.db, web_app.capture_recorder = original[1], original[2]
+        web_app.ml_service.breaker.failure_threshold = original[3]
+    return {"capture": {**summary, "ml_latency_ms": ml_latency * 1000}}
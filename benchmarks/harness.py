@@ -0,0 +1,101 @@
+"""
+Timing helpers shared by the benchmarks.
+
+Every benchmark reduces its samples to the same summary, latency
+percentiles in milliseconds and throughput, so results from different runs
+and commits can be compared key by key.
+"""
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def summarize(latencies, elapsed):
+    """
+    Summarize the latencies of a run.
+    Args:
+        latencies (list): Seconds taken by each call.
+        elapsed (float): Wall-clock seconds the whole run took.
+    Returns:
+        dict: Call count, p50/p95/p99/mean latency in milliseconds and calls
+        per second.
+    """
+    samples = np.asarray(latencies, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+    return {
+        "count": len(samples),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "mean_ms": round(float(samples.mean()), 3),
+        "rps": round(len(samples) / elapsed, 2) if elapsed > 0 else None,
+    }
+
+
+def time_calls(fn, repeat, warmup=1):
+    """
+    Time repeated sequential calls of a function.
+    Args:
+        fn: The callable to time; it takes no arguments.
+        repeat (int): Number of timed calls.
+        warmup (int): Untimed calls made first.
+    Returns:
+        dict: The summary of the timed calls.
+    """
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        call_start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def run_load(make_worker, requests, concurrency, warmup=2):
+    """
+    Send requests from several threads and time each one.
+    Args:
+        make_worker: Called once per thread; returns a callable taking the
+            request number, e.g. one bound to a per-thread test client.
+        requests (int): Total number of timed requests.
+        concurrency (int): Number of threads sending requests.
+        warmup (int): Untimed requests each thread sends first.
+    Returns:
+        dict: The summary of the timed requests, plus the concurrency.
+    """
+    local = threading.local()
+    lock = threading.Lock()
+    latencies = []
+
+    def worker():
+        if not hasattr(local, "send"):
+            local.send = make_worker()
+            for i in range(warmup):
+                local.send(i)
+        return local.send
+
+    def timed(number):
+        send = worker()
+        start = time.perf_counter()
+        send(number)
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Create and warm every thread's worker before the clock starts.
+        barrier = threading.Barrier(concurrency)
+
+        def prepare(_):
+            worker()
+            barrier.wait()
+
+        list(executor.map(prepare, range(concurrency)))
+        start = time.perf_counter()
+        list(executor.map(timed, range(requests)))
+        elapsed = time.perf_counter() - start
+    return {**summarize(latencies, elapsed), "concurrency": concurrency}
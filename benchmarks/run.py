@@ -0,0 +1,146 @@
+"""
+Run the benchmarks and write their results as JSON.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --quick --only search
+    python -m benchmarks.run --compare base.json results.json
+
+Results are keyed by benchmark name with p50/p95/p99 latency in
+milliseconds and requests per second, so the files of two commits can be
+diffed or compared with ``--compare``.
+"""
+
+import sys
+import json
+import argparse
+import platform
+import subprocess
+
+import numpy as np
+
+SUITES = ("load", "search", "precision", "recognize", "capture")
+FULL_SIZES = (10, 100, 1000, 10000, 100000)
+QUICK_SIZES = (10, 1000, 10000)
+
+
+def git_commit():
+    """Return the current commit hash, or None outside a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suites(suites, quick, concurrency, ml_latency_ms):
+    """
+    Run the selected benchmark suites.
+    Args:
+        suites (list): Names from SUITES.
+        quick (bool): Use fewer repetitions and smaller galleries.
+        concurrency (int): Concurrent clients for the HTTP benchmarks.
+        ml_latency_ms (float): Latency of the stand-in ML service.
+    Returns:
+        dict: The summary of every benchmark, by name.
+    """
+    # Imported here so that benchmarking only the web app does not load the
+    # ML service's models and the other way round.
+    # pylint: disable=import-outside-toplevel
+    results = {}
+    repeat = 20 if quick else 200
+    requests = 20 if quick else 200
+    if "load" in suites:
+        from .bench_ml import bench_load_encodings
+
+        results.update(bench_load_encodings(2 if quick else 5))
+    if "search" in suites:
+        from .bench_ml import bench_search
+
+        results.update(bench_search(QUICK_SIZES if quick else FULL_SIZES, repeat))
+    if "precision" in suites:
+        from .bench_ml import bench_precision
+
+        results.update(bench_precision(QUICK_SIZES if quick else FULL_SIZES, repeat))
+    if "recognize" in suites:
+        from .bench_ml import bench_recognize_face
+
+        results.update(bench_recognize_face(requests, concurrency))
+    if "capture" in suites:
+        from .bench_web import bench_capture
+
+        results.update(bench_capture(requests * 5, concurrency, ml_latency_ms / 1000))
+    return results
+
+
+def compare(base_path, new_path):
+    """
+    Print how the latencies and throughput of two result files differ.
+    Args:
+        base_path (str): Results of the baseline commit.
+        new_path (str): Results to compare with the baseline.
+    """
+    with open(base_path, encoding="utf-8") as f:
+        base = json.load(f)["results"]
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)["results"]
+    print(f"{'benchmark':40} {'p50 ms':>20} {'p95 ms':>20} {'rps':>20}")
+    for name in sorted(set(base) & set(new)):
+        cells = []
+        for key in ("p50_ms", "p95_ms", "rps"):
+            old_value, new_value = base[name][key], new[name][key]
+            change = (new_value - old_value) / old_value * 100 if old_value else 0
+            cells.append(f"{new_value:>10.3f} ({change:+6.1f}%)")
+        print(f"{name:40} " + " ".join(cells))
+    for name in sorted(set(base) ^ set(new)):
+        print(f"{name:40} only in {'base' if name in base else 'new'}")
+
+
+def main(argv=None):
+    """Parse the command line and run or compare benchmarks."""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--quick", action="store_true", help="shorter runs")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--ml-latency-ms",
+        type=float,
+        default=0,
+        help="latency of the stand-in ML service in the capture benchmark",
+    )
+    parser.add_argument("--output", help="write results here instead of stdout")
+    parser.add_argument(
+        "--compare", nargs=2, metavar=("BASE", "NEW"), help="compare two result files"
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "quick": args.quick,
+            "concurrency": args.concurrency,
+        },
+        "results": run_suites(
+            args.only, args.quick, args.concurrency, args.ml_latency_ms
+        ),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+
+
+if __name__ == "__main__":
+    main()
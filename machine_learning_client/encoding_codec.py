@@ -0,0 +1,56 @@
+"""
+Compact wire format for face encodings.
+
+An encoding travels as the base64 of its 128 little-endian float32 values
+(684 characters instead of roughly 2.5 KB of JSON numbers), so clients can
+keep encodings and have them matched again without re-uploading the image.
+"""
+
+import base64
+import binascii
+
+import numpy as np
+
+try:
+    from .encoding_store import ENCODING_DIM
+except ImportError:
+    from encoding_store import ENCODING_DIM
+
+WIRE_DTYPE = np.dtype("<f4")
+
+
+def pack_encoding(encoding):
+    """
+    Encode one face encoding for JSON.
+    Args:
+        encoding (numpy.ndarray): A 128-d encoding.
+    Returns:
+        str: The base64 of its float32 values.
+    """
+    return base64.b64encode(np.asarray(encoding, dtype=WIRE_DTYPE).tobytes()).decode(
+        "ascii"
+    )
+
+
+def unpack_encodings(packed):
+    """
+    Decode encodings packed with pack_encoding.
+    Args:
+        packed (list): Base64 strings, one per encoding.
+    Returns:
+        numpy.ndarray: A (len(packed), 128) float32 matrix.
+    Raises:
+        ValueError: If an entry is not a valid packed encoding.
+    """
+    matrix = np.empty((len(packed), ENCODING_DIM), dtype=np.float32)
+    for row, text in enumerate(packed):
+        try:
+            raw = base64.b64decode(text, validate=True)
+        except (TypeError, binascii.Error) as e:
+            raise ValueError(f"Encoding {row} is not valid base64") from e
+        if len(raw) != ENCODING_DIM * WIRE_DTYPE.itemsize:
+            raise ValueError(f"Encoding {row} must hold {ENCODING_DIM} float32 values")
+        matrix[row] = np.frombuffer(raw, dtype=WIRE_DTYPE)
+    if not np.isfinite(matrix).all():
+        raise ValueError("Encodings must be finite")
+    return matrix
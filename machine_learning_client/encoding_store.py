@@ -0,0 +1,165 @@
+"""
+Persistent on-disk store for reference face encodings.
+
+The store is a directory holding two files:
+
+* ``encodings.npy`` - a float32 matrix with one 128-d encoding per row, loaded
+  with ``mmap_mode="r"`` so startup does not copy it into memory.
+* ``manifest.json`` - the store version and, for every image file, its name,
+  size, mtime, SHA-256 and the matrix row holding its encoding (``None`` when
+  no face was found, so the image is not re-encoded on every start).
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+STORE_VERSION = 1
+ENCODING_DIM = 128
+
+MATRIX_FILENAME = "encodings.npy"
+MANIFEST_FILENAME = "manifest.json"
+
+
+def empty_matrix():
+    """Return an empty encoding matrix with the store's shape and dtype."""
+    return np.empty((0, ENCODING_DIM), dtype=np.float32)
+
+
+def stack_encodings(encodings, cached_rows, cached_matrix):
+    """
+    Stack encodings into a float32 matrix, reusing the cached one if possible.
+    Args:
+        encodings (list): Encodings in gallery order.
+        cached_rows (list): For each encoding, the row of ``cached_matrix`` it
+            was taken from, or None if it was freshly encoded.
+        cached_matrix (numpy.ndarray): The matrix loaded from the store.
+    Returns:
+        numpy.ndarray: ``cached_matrix`` itself when every row is reused in
+        its original order, otherwise a new contiguous matrix.
+    """
+    if len(cached_matrix) and cached_rows == list(range(len(cached_matrix))):
+        return cached_matrix
+    if not encodings:
+        return empty_matrix()
+    return np.vstack(encodings).astype(np.float32)
+
+
+def file_fingerprint(path, previous=None):
+    """
+    Fingerprint an image file by size, mtime and content hash.
+    Args:
+        path (str): Path of the image file.
+        previous (dict): Manifest entry from the last run, if any. When size
+            and mtime are unchanged its hash is reused instead of re-reading
+            the file.
+    Returns:
+        dict: The ``size``, ``mtime_ns`` and ``sha256`` of the file.
+    Raises:
+        OSError: If the file cannot be read.
+    """
+    stat = os.stat(path)
+    if (
+        previous
+        and previous.get("size") == stat.st_size
+        and previous.get("mtime_ns") == stat.st_mtime_ns
+    ):
+        sha256 = previous["sha256"]
+    else:
+        digest = hashlib.sha256()
+        with open(path, "rb") as image_file:
+            for block in iter(lambda: image_file.read(1 << 20), b""):
+                digest.update(block)
+        sha256 = digest.hexdigest()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}
+
+
+class EncodingStore:
+    """Versioned encoding matrix plus manifest kept in a directory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.matrix_path = os.path.join(path, MATRIX_FILENAME)
+        self.manifest_path = os.path.join(path, MANIFEST_FILENAME)
+
+    def load(self):
+        """
+        Load the stored matrix and manifest entries.
+        Returns:
+            tuple: A read-only memory-mapped matrix and a dict of manifest
+            entries keyed by filename. An empty matrix and dict are returned
+            when the store is missing, from another version or inconsistent.
+        """
+        try:
+            with open(self.manifest_path, encoding="utf-8") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get("version") != STORE_VERSION:
+                raise ValueError(f"unsupported store version {manifest.get('version')}")
+            matrix = np.load(self.matrix_path, mmap_mode="r")
+            if matrix.dtype != np.float32 or matrix.shape[1:] != (ENCODING_DIM,):
+                raise ValueError(f"unexpected matrix {matrix.dtype} {matrix.shape}")
+            if matrix.shape[0] != manifest["count"]:
+                raise ValueError("matrix does not match manifest")
+            return matrix, manifest["entries"]
+        except FileNotFoundError:
+            return empty_matrix(), {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("Ignoring invalid encoding store %s: %s", self.path, e)
+            return empty_matrix(), {}
+
+    def save(self, matrix, entries):
+        """
+        Atomically replace the stored matrix and manifest.
+        A store that cannot be written is logged and skipped, since the
+        encodings are still usable for this run.
+        Args:
+            matrix (numpy.ndarray): The encoding matrix, or None to keep the
+                matrix already on disk and only rewrite the manifest.
+            entries (dict): Manifest entries keyed by filename.
+        Returns:
+            bool: Whether the store was written.
+        """
+        try:
+            self._save(matrix, entries)
+            return True
+        except OSError as e:
+            logging.warning("Could not update encoding store %s: %s", self.path, e)
+            return False
+
+    def _save(self, matrix, entries):
+        """Write the matrix and manifest, raising OSError on failure."""
+        os.makedirs(self.path, exist_ok=True)
+        if matrix is not None:
+            count = matrix.shape[0]
+            self._replace(
+                self.matrix_path,
+                lambda fh: np.save(fh, np.ascontiguousarray(matrix, np.float32)),
+            )
+        else:
+            count = np.load(self.matrix_path, mmap_mode="r").shape[0]
+        manifest = {
+            "version": STORE_VERSION,
+            "dim": ENCODING_DIM,
+            "count": count,
+            "entries": entries,
+        }
+        self._replace(
+            self.manifest_path,
+            lambda fh: fh.write(json.dumps(manifest, sort_keys=True).encode("utf-8")),
+        )
+
+    def _replace(self, target, write):
+        """Write a file next to ``target`` and rename it into place."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_file:
+                write(tmp_file)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
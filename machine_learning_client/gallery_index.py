@@ -0,0 +1,364 @@
+"""
+Nearest-neighbour search over the reference face encodings.
+
+The gallery is held as one contiguous float32 matrix. Exact search computes
+all Euclidean distances with a single matrix product; approximate search
+(``ivf``) buckets the gallery with k-means and only scans the buckets whose
+centroids are closest to the query.
+
+For large galleries the search can instead run on a compact copy of the
+matrix, float16 or int8 with a per-dimension offset and scale, taking a half
+or a quarter of the memory. The best candidates found on the compact copy
+are re-ranked with exact float32 distances, so reported distances are
+exact. With the float32 matrix memory-mapped from the encoding store, only
+the re-ranked rows are read and the mapped pages are shared by every
+process on the host.
+"""
+
+import math
+import logging
+import itertools
+
+import numpy as np
+
+INDEX_MODES = ("exact", "ivf")
+PRECISIONS = ("float32", "float16", "int8")
+
+_generations = itertools.count(1)
+
+
+def _squared_distances(queries, matrix, matrix_sq_norms):
+    """Return the (queries x matrix) matrix of squared Euclidean distances."""
+    query_sq_norms = np.einsum("ij,ij->i", queries, queries)
+    squared = query_sq_norms[:, None] + matrix_sq_norms[None, :]
+    squared -= 2.0 * (queries @ matrix.T)
+    return np.maximum(squared, 0.0, out=squared)
+
+
+def _top_k(squared, k):
+    """Return the indices and distances of the k smallest entries per row."""
+    k = min(k, squared.shape[1])
+    if k < squared.shape[1]:
+        candidates = np.argpartition(squared, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(squared.shape[1]), squared.shape)
+    candidate_sq = np.take_along_axis(squared, candidates, axis=1)
+    order = np.argsort(candidate_sq, axis=1, kind="stable")
+    indices = np.take_along_axis(candidates, order, axis=1)
+    distances = np.sqrt(np.take_along_axis(candidate_sq, order, axis=1))
+    return indices, distances
+
+
+class CompactMatrix:
+    """
+    Reduced-precision copy of an encoding matrix for approximate distances.
+    Rows are stored as ``codes`` with ``row ~ offset + scale * codes``:
+    float16 values with no offset and unit scale, or int8 steps spanning
+    each dimension's range.
+    Args:
+        matrix (numpy.ndarray): The (n, d) float32 encodings.
+        precision (str): ``float16`` or ``int8``.
+        chunk_size (int): Rows converted back to float32 at a time.
+    """
+
+    def __init__(self, matrix, precision, chunk_size=8192):
+        if precision not in PRECISIONS[1:]:
+            raise ValueError(f"Unknown compact precision: {precision}")
+        self.precision = precision
+        self.chunk_size = chunk_size
+        dim = matrix.shape[1]
+        if precision == "float16" or matrix.shape[0] == 0:
+            self.offset = np.zeros(dim, dtype=np.float32)
+            self.scale = np.ones(dim, dtype=np.float32)
+            dtype = np.float16 if precision == "float16" else np.int8
+        else:
+            low, high = matrix.min(axis=0), matrix.max(axis=0)
+            self.offset = ((low + high) / 2).astype(np.float32)
+            self.scale = np.maximum((high - low) / 254, 1e-12).astype(np.float32)
+            dtype = np.int8
+        self.codes = np.empty(matrix.shape, dtype=dtype)
+        self.sq_norms = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), chunk_size):
+            rows = slice(start, start + chunk_size)
+            chunk = (np.asarray(matrix[rows], np.float32) - self.offset) / self.scale
+            if dtype == np.int8:
+                chunk = np.clip(np.rint(chunk), -127, 127)
+            self.codes[rows] = chunk
+            scaled = self.codes[rows].astype(np.float32) * self.scale
+            self.sq_norms[rows] = np.einsum("ij,ij->i", scaled, scaled)
+
+    @property
+    def nbytes(self):
+        """Bytes held by the compact copy."""
+        return sum(
+            array.nbytes
+            for array in (self.codes, self.sq_norms, self.offset, self.scale)
+        )
+
+    def squared_distances(self, queries, rows=None):
+        """
+        Return approximate squared distances from queries to stored rows.
+        Args:
+            queries (numpy.ndarray): (q, d) float32 queries.
+            rows (numpy.ndarray): Row indices to compare with; all if None.
+        Returns:
+            numpy.ndarray: The (q, len(rows)) squared distances.
+        """
+        codes = self.codes if rows is None else self.codes[rows]
+        sq_norms = self.sq_norms if rows is None else self.sq_norms[rows]
+        shifted = queries - self.offset
+        weighted = shifted * self.scale
+        query_sq_norms = np.einsum("ij,ij->i", shifted, shifted)
+        squared = np.empty((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), self.chunk_size):
+            block = codes[start : start + self.chunk_size].astype(np.float32)
+            squared[:, start : start + len(block)] = (
+                query_sq_norms[:, None]
+                + sq_norms[None, start : start + len(block)]
+                - 2.0 * (weighted @ block.T)
+            )
+        return np.maximum(squared, 0.0, out=squared)
+
+
+def assign_clusters(matrix, centroids, chunk_size=8192):
+    """Return the index of the nearest centroid for every row of a matrix."""
+    centroid_sq = np.einsum("ij,ij->i", centroids, centroids)
+    assignment = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), chunk_size):
+        chunk = matrix[start : start + chunk_size]
+        squared = _squared_distances(chunk, centroids, centroid_sq)
+        assignment[start : start + chunk_size] = np.argmin(squared, axis=1)
+    return assignment
+
+
+def kmeans(matrix, n_clusters, iterations=10, sample_size=20000, seed=0):
+    """
+    Cluster rows of a matrix with Lloyd's algorithm.
+    Centroids are trained on a random sample of at most ``sample_size`` rows
+    and every row is then assigned to its nearest centroid.
+    Args:
+        matrix (numpy.ndarray): The (n, d) float32 data.
+        n_clusters (int): Number of centroids.
+        iterations (int): Number of refinement passes.
+        sample_size (int): Maximum number of rows used for training.
+        seed (int): Seed for sampling rows and initial centroids.
+    Returns:
+        tuple: The (n_clusters, d) centroids and the cluster of every row.
+    """
+    rng = np.random.default_rng(seed)
+    sample = matrix
+    if len(matrix) > sample_size:
+        sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign_clusters(sample, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids, assign_clusters(matrix, centroids)
+
+
+class GalleryIndex:  # pylint: disable=too-many-instance-attributes
+    """
+    Searchable gallery of reference encodings and their character names.
+    Args:
+        matrix (numpy.ndarray): The (n, 128) encodings. A contiguous float32
+            matrix (such as the memory-mapped store) is used without copying.
+        names (list): The character name of every row.
+        mode (str): ``exact`` for a full scan or ``ivf`` for bucketed search.
+        n_lists (int): Number of k-means buckets for ``ivf``; defaults to
+            the square root of the gallery size.
+        n_probe (int): Number of buckets scanned per query for ``ivf``.
+        precision (str): ``float32`` to search the matrix itself, or
+            ``float16``/``int8`` to search a compact copy and re-rank.
+        rerank (int): Candidates per query re-ranked with exact distances
+            when searching a compact copy.
+    Every index gets a new ``generation`` number, so results derived from
+    one gallery can be told apart from results of a gallery built later.
+    """
+
+    def __init__(
+        self,
+        matrix,
+        names,
+        mode="exact",
+        n_lists=None,
+        n_probe=8,
+        precision="float32",
+        rerank=32,
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if mode not in INDEX_MODES:
+            raise ValueError(f"Unknown index mode: {mode}")
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}")
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.names = list(names)
+        if len(self.names) != len(self.matrix):
+            raise ValueError("Every encoding needs exactly one name")
+        self.compact = None
+        self.sq_norms = None
+        if precision == "float32":
+            self.sq_norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+        else:
+            self.compact = CompactMatrix(self.matrix, precision)
+        self.precision = precision
+        self.rerank = rerank
+        self.mode = mode
+        self.n_probe = n_probe
+        self.generation = next(_generations)
+        self.ivf = None
+
+        if mode == "ivf" and len(self.matrix):
+            n_lists = n_lists or max(1, int(math.sqrt(len(self.matrix))))
+            n_lists = min(n_lists, len(self.matrix))
+            if n_probe < n_lists:
+                self._build_ivf(n_lists)
+            else:
+                logging.info("Gallery too small for ivf, using exact search")
+                self.mode = "exact"
+
+    def _build_ivf(self, n_lists):
+        """Bucket the gallery rows by their nearest k-means centroid."""
+        centroids, assignment = kmeans(self.matrix, n_lists)
+        counts = np.bincount(assignment, minlength=n_lists)
+        self.ivf = (
+            centroids,
+            np.argsort(assignment, kind="stable"),
+            np.concatenate(([0], np.cumsum(counts))),
+        )
+        logging.info(
+            "Built ivf index with %d lists over %d encodings", n_lists, len(self)
+        )
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def memory_report(self):
+        """
+        Describe the memory the index searches.
+        Returns:
+            dict: The precision, the bytes searched per query scan, the bytes
+            of the float32 matrix and whether that matrix is memory-mapped
+            (and so only read where needed and shared between processes).
+        """
+        searched = self.compact.nbytes if self.compact else self.matrix.nbytes
+        if self.sq_norms is not None:
+            searched += self.sq_norms.nbytes
+        return {
+            "precision": self.precision,
+            "search_bytes": int(searched),
+            "matrix_bytes": int(self.matrix.nbytes),
+            "matrix_mapped": isinstance(self.matrix, np.memmap)
+            or isinstance(self.matrix.base, np.memmap),
+        }
+
+    def _squared_distances(self, queries, rows=None):
+        """Squared distances to all or some rows, approximate if compact."""
+        if self.compact is not None:
+            return self.compact.squared_distances(queries, rows)
+        if rows is None:
+            return _squared_distances(queries, self.matrix, self.sq_norms)
+        return _squared_distances(queries, self.matrix[rows], self.sq_norms[rows])
+
+    def _rerank(self, queries, candidates, approximate, k):
+        """
+        Re-rank candidate rows by their exact float32 distances.
+        Args:
+            queries (numpy.ndarray): (q, d) float32 queries.
+            candidates (numpy.ndarray): (q, c) candidate rows per query.
+            approximate (numpy.ndarray): (q, c) approximate distances;
+                infinite entries are padding and stay last.
+            k (int): Number of neighbours to keep per query.
+        Returns:
+            tuple: The (q, k') row indices and exact distances.
+        """
+        rows = self.matrix[candidates.ravel()].reshape(*candidates.shape, -1)
+        difference = rows - queries[:, None, :]
+        squared = np.einsum("qcd,qcd->qc", difference, difference)
+        squared[~np.isfinite(approximate)] = np.inf
+        order, distances = _top_k(squared, k)
+        return np.take_along_axis(candidates, order, axis=1), distances
+
+    def search(self, queries, k=1):
+        """
+        Find the k nearest gallery rows for each query encoding.
+        Args:
+            queries (numpy.ndarray): A (128,) encoding or (q, 128) encodings.
+            k (int): Number of neighbours to return per query.
+        Returns:
+            tuple: (q, k') row indices and (q, k') Euclidean distances sorted
+            by distance, where k' is at most k and the gallery size.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if len(self) == 0:
+            empty = np.empty((len(queries), 0))
+            return empty.astype(np.int64), empty
+        wanted = k if self.compact is None else max(k, self.rerank)
+        if self.mode == "exact":
+            indices, distances = _top_k(self._squared_distances(queries), wanted)
+        else:
+            indices, distances = self._search_ivf(queries, wanted)
+        if self.compact is None:
+            return indices, distances
+        return self._rerank(queries, indices, distances, k)
+
+    def _probe_members(self, queries):
+        """Return, per query, the gallery rows of its n_probe nearest buckets."""
+        centroids, list_members, list_offsets = self.ivf
+        centroid_sq = np.einsum("ij,ij->i", centroids, centroids)
+        probe_sq = _squared_distances(queries, centroids, centroid_sq)
+        probes = np.argpartition(probe_sq, self.n_probe - 1, axis=1)
+        return [
+            np.concatenate(
+                [
+                    list_members[list_offsets[bucket] : list_offsets[bucket + 1]]
+                    for bucket in buckets[: self.n_probe]
+                ]
+            )
+            for buckets in probes
+        ]
+
+    def _search_ivf(self, queries, k):
+        """Search only the n_probe buckets closest to each query."""
+        k = min(k, len(self))
+        indices = np.zeros((len(queries), k), dtype=np.int64)
+        distances = np.full((len(queries), k), np.inf)
+        for row, members in enumerate(self._probe_members(queries)):
+            squared = self._squared_distances(queries[row : row + 1], members)
+            found, found_distances = _top_k(squared, k)
+            indices[row, : found.shape[1]] = members[found[0]]
+            distances[row, : found.shape[1]] = found_distances[0]
+        return indices, distances
+
+    def matches(self, query, k=1):
+        """
+        Return the k nearest characters to a single query encoding.
+        Args:
+            query (numpy.ndarray): A (128,) face encoding.
+            k (int): Number of matches to return.
+        Returns:
+            list: ``(name, distance)`` pairs sorted by distance.
+        """
+        return self.batch_matches(query, k)[0]
+
+    def batch_matches(self, queries, k=1):
+        """
+        Return the k nearest characters for every query in one search.
+        Args:
+            queries (numpy.ndarray): A (128,) encoding or (q, 128) encodings.
+            k (int): Number of matches to return per query.
+        Returns:
+            list: For each query, ``(name, distance)`` pairs sorted by
+            distance.
+        """
+        indices, distances = self.search(queries, k)
+        return [
+            [
+                (self.names[index], float(distance))
+                for index, distance in zip(row_indices, row_distances)
+                if np.isfinite(distance)
+            ]
+            for row_indices, row_distances in zip(indices, distances)
+        ]
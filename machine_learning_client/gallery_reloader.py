@@ -0,0 +1,130 @@
+"""
+Background rebuilding and swapping of the character gallery.
+
+A reload builds a complete new gallery off the request path and then hands
+it to a swap callback, which replaces the service's gallery reference in a
+single assignment. Requests keep using the gallery they started with, so
+they never block on a reload or see a partially built gallery.
+"""
+
+import os
+import time
+import logging
+import threading
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def directory_signature(path):
+    """
+    Summarise the image files of a directory.
+    Args:
+        path (str): The images directory.
+    Returns:
+        tuple: ``(filename, size, mtime_ns)`` of every image, sorted, or
+        None if the directory cannot be read.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return tuple(
+                sorted(
+                    (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                    for entry in entries
+                    if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file()
+                )
+            )
+    except OSError:
+        return None
+
+
+class GalleryReloader:
+    """
+    Rebuild the gallery in a background thread and swap it in when done.
+    Args:
+        build: Callable returning a new gallery; it may take a long time.
+        swap: Callable receiving the new gallery to make it current.
+    """
+
+    def __init__(self, build, swap):
+        self._build = build
+        self._swap = swap
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = False
+        self.last_reload = None
+        self.last_error = None
+
+    @property
+    def reloading(self):
+        """Whether a reload is running."""
+        with self._lock:
+            return self._thread is not None
+
+    def request_reload(self):
+        """
+        Start a background reload.
+        If a reload is already running, one more reload is run after it so
+        changes made while it was building are picked up.
+        Returns:
+            bool: True if a new reload thread was started.
+        """
+        with self._lock:
+            if self._thread is not None:
+                self._pending = True
+                return False
+            self._thread = threading.Thread(
+                target=self._run, name="gallery-reload", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def reload_now(self):
+        """Build and swap in a new gallery on the calling thread."""
+        start = time.perf_counter()
+        gallery = self._build()
+        self._swap(gallery)
+        self.last_reload = time.time()
+        logging.info(
+            "Gallery reloaded with %d encodings in %.2fs",
+            len(gallery),
+            time.perf_counter() - start,
+        )
+
+    def _run(self):
+        """Reload until no further reload was requested meanwhile."""
+        while True:
+            try:
+                self.reload_now()
+                self.last_error = None
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                self.last_error = str(e)
+                logging.error("Gallery reload failed: %s", e)
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+                self._pending = False
+
+    def watch(self, path, interval):
+        """
+        Poll a directory and reload when its image files change.
+        Args:
+            path (str): The images directory.
+            interval (float): Seconds between polls.
+        Returns:
+            threading.Thread: The started daemon watcher thread.
+        """
+
+        def poll():
+            signature = directory_signature(path)
+            while True:
+                time.sleep(interval)
+                current = directory_signature(path)
+                if current != signature:
+                    logging.info("Change detected in %s, reloading gallery", path)
+                    signature = current
+                    self.request_reload()
+
+        watcher = threading.Thread(target=poll, name="gallery-watch", daemon=True)
+        watcher.start()
+        return watcher
@@ -0,0 +1,149 @@
+"""
+Process pool for CPU-bound face detection and encoding.
+
+Workers are forked from the service process after the dlib models and the
+gallery are loaded, so those pages are shared copy-on-write instead of being
+loaded again per worker. The pool admits at most ``size + queue_depth`` tasks
+at a time; further submissions raise PoolSaturated so the HTTP layer can shed
+load instead of queueing without bound.
+
+A worker that dies, from the OOM killer or a crash in dlib, breaks the
+whole executor. The next submission replaces it with workers started from
+a forkserver, as forking the threaded service is no longer safe, and the
+pool reports itself ``broken`` until then.
+"""
+
+import os
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import face_recognition
+
+
+class PoolSaturated(Exception):
+    """Raised when every worker is busy and the queue is full."""
+
+
+def _warm_worker(warmup_image=None):
+    """
+    Run a recognition pass so the first real task does not pay for it.
+    Args:
+        warmup_image (str): Path of an image with a face, which also warms
+            up the encoder; without it only the detector runs.
+    """
+    image = np.zeros((64, 64, 3), dtype=np.uint8)
+    if warmup_image:
+        try:
+            image = face_recognition.load_image_file(warmup_image)
+        except OSError as e:
+            logging.warning("Failed to load warmup image %s: %s", warmup_image, e)
+    locations = face_recognition.face_locations(image)
+    if locations:
+        face_recognition.face_encodings(image, known_face_locations=locations[:1])
+
+
+class InferencePool:
+    """
+    Bounded pool of pre-warmed worker processes.
+    Args:
+        size (int): Number of worker processes.
+        queue_depth (int): Number of tasks allowed to wait for a worker.
+        warmup_image (str): Image every worker recognizes once on startup.
+    """
+
+    def __init__(self, size, queue_depth, warmup_image=None):
+        self.size = size
+        self.queue_depth = queue_depth
+        self._slots = threading.BoundedSemaphore(size + queue_depth)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._warmup_image = warmup_image
+        self._executor = self._start_executor("fork")
+        # Fork every worker now, before the service starts any threads.
+        for future in [self._executor.submit(os.getpid) for _ in range(size)]:
+            future.result()
+        logging.info(
+            "Started inference pool with %d workers and queue depth %d",
+            size,
+            queue_depth,
+        )
+
+    def _start_executor(self, start_method):
+        """Create an executor whose workers warm up on startup."""
+        return ProcessPoolExecutor(
+            max_workers=self.size,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_warm_worker,
+            initargs=(self._warmup_image,),
+        )
+
+    @property
+    def broken(self):
+        """Whether a worker died and the pool awaits a restart."""
+        # Set by the executor once it notices a worker exited abnormally.
+        return bool(getattr(self._executor, "_broken", False))
+
+    @property
+    def pending(self):
+        """Number of tasks queued or running."""
+        return self._pending
+
+    def submit(self, fn, *args, timeout=0):
+        """
+        Run ``fn(*args)`` in a worker process.
+        Args:
+            fn: A module-level function, so it can be sent to the worker.
+            timeout (float): Seconds to wait for a free slot; 0 fails at once.
+        Returns:
+            concurrent.futures.Future: The future for the task's result.
+        Raises:
+            PoolSaturated: If no slot became free in time, or the pool broke
+                again right after a restart.
+        """
+        # pylint: disable-next=consider-using-with
+        if not self._slots.acquire(timeout=timeout or None, blocking=timeout > 0):
+            raise PoolSaturated("Recognition queue is full")
+        with self._lock:
+            self._pending += 1
+        try:
+            future = self._submit_or_restart(fn, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _submit_or_restart(self, fn, *args):
+        """Submit a task, replacing a broken executor once if need be."""
+        executor = self._executor
+        try:
+            return executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._restart(executor)
+        try:
+            return self._executor.submit(fn, *args)
+        except BrokenProcessPool as e:
+            raise PoolSaturated("Recognition workers are restarting") from e
+
+    def _restart(self, broken):
+        """Replace a broken executor, unless another thread already has."""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            logging.error("An inference worker died; restarting the pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._start_executor("forkserver")
+
+    def _release(self):
+        """Free the slot of a finished task."""
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,207 @@
+"""
+Face tracking for continuous recognition of a webcam stream.
+
+Clients of the /live WebSocket send a stream of frames. Running detection
+and encoding on every one of them would make the cost grow linearly with
+the frame rate, so full detection only runs on keyframes: every
+``keyframe_interval`` frames, or as soon as there is no face being tracked.
+In between, a dlib correlation tracker follows the face box, which costs a
+small fraction of a detection. The face is only encoded, and so matched,
+when a track starts: when the previous one was lost, or when a keyframe's
+detection no longer overlaps the tracked box because the track drifted.
+
+Frames that arrived while one was being processed are skipped up to the
+newest, so a server that falls behind drops stale frames instead of
+building a backlog.
+"""
+
+import time
+
+from dlib import correlation_tracker, rectangle  # pylint: disable=no-name-in-module
+
+
+def _elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def box_overlap(a, b):
+    """
+    Return the intersection over union of two face boxes.
+    Args:
+        a (tuple): A ``(top, right, bottom, left)`` box.
+        b (tuple): Another box.
+    Returns:
+        float: 0 for disjoint boxes up to 1 for identical ones.
+    """
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = (a[1] - a[3]) * (a[2] - a[0]) + (b[1] - b[3]) * (b[2] - b[0])
+    union -= intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class CorrelationTracker:
+    """Follow a face box from frame to frame with dlib's correlation tracker."""
+
+    def __init__(self):
+        self._tracker = correlation_tracker()
+
+    def start(self, image, box):
+        """
+        Start tracking a face.
+        Args:
+            image (numpy.ndarray): The RGB frame the face was detected in.
+            box (tuple): Its ``(top, right, bottom, left)`` box.
+        """
+        top, right, bottom, left = box
+        self._tracker.start_track(image, rectangle(left, top, right, bottom))
+
+    def update(self, image):
+        """
+        Find the tracked face in the next frame.
+        Args:
+            image (numpy.ndarray): The next RGB frame.
+        Returns:
+            tuple: The peak-to-sidelobe ratio, which drops when the tracker
+            loses the face, and the face's ``(top, right, bottom, left)`` box.
+        """
+        confidence = self._tracker.update(image)
+        position = self._tracker.get_position()
+        box = tuple(
+            int(round(side))
+            for side in (
+                position.top(),
+                position.right(),
+                position.bottom(),
+                position.left(),
+            )
+        )
+        return confidence, box
+
+
+class FaceTracker:  # pylint: disable=too-many-instance-attributes
+    """
+    Decide per frame whether to detect, track or encode the face.
+    One tracker follows the most prominent face of one stream.
+    Args:
+        detect: Callable taking an RGB frame and returning the
+            ``(top, right, bottom, left)`` box of every face in it.
+        encode: Callable taking a frame and a box and returning the face's
+            encoding.
+        make_tracker: Callable returning a new CorrelationTracker-like
+            object with ``start(image, box)`` and ``update(image)``.
+        keyframe_interval (int): Frames between full detections.
+        min_confidence (float): Tracker confidence below which the track
+            counts as lost.
+        min_overlap (float): Overlap between the tracked box and a
+            keyframe's detection below which the track counts as drifted.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        detect,
+        encode,
+        make_tracker=CorrelationTracker,
+        keyframe_interval=10,
+        min_confidence=7.0,
+        min_overlap=0.5,
+    ):
+        self.detect = detect
+        self.encode = encode
+        self.make_tracker = make_tracker
+        self.keyframe_interval = keyframe_interval
+        self.min_confidence = min_confidence
+        self.min_overlap = min_overlap
+        self.box = None
+        self.encoding = None
+        self._tracker = None
+        self._shape = None
+        self._since_keyframe = 0
+
+    def process(self, image):
+        """
+        Update the face state with a new frame.
+        Args:
+            image (numpy.ndarray): The RGB frame.
+        Returns:
+            dict: ``box``, the face box in frame coordinates or None when no
+            face is in view; ``keyframe``, whether the face was detected
+            rather than tracked; ``encoded``, whether ``encoding`` changed;
+            and the ``timings`` of the stages that ran in milliseconds.
+        """
+        timings = {}
+        if image.shape != self._shape:
+            self._shape = image.shape
+            self.reset()
+        if self._tracker is not None and self._since_keyframe < self.keyframe_interval:
+            start = time.perf_counter()
+            confidence, box = self._tracker.update(image)
+            timings["track"] = _elapsed_ms(start)
+            if confidence >= self.min_confidence:
+                self.box = box
+                self._since_keyframe += 1
+                return {
+                    "box": box,
+                    "keyframe": False,
+                    "encoded": False,
+                    "timings": timings,
+                }
+            # Lost: whoever is detected next is encoded afresh.
+            self.reset()
+
+        start = time.perf_counter()
+        boxes = self.detect(image)
+        timings["detect"] = _elapsed_ms(start)
+        self._since_keyframe = 0
+        if not boxes:
+            self.reset()
+            return {"box": None, "keyframe": True, "encoded": False, "timings": timings}
+
+        box = self._pick(boxes)
+        encoded = self.box is None or box_overlap(box, self.box) < self.min_overlap
+        if encoded:
+            start = time.perf_counter()
+            self.encoding = self.encode(image, box)
+            timings["encode"] = _elapsed_ms(start)
+        self.box = box
+        self._tracker = self.make_tracker()
+        self._tracker.start(image, box)
+        return {"box": box, "keyframe": True, "encoded": encoded, "timings": timings}
+
+    def _pick(self, boxes):
+        """Return the detection continuing the track, else the largest face."""
+        if self.box is not None:
+            best = max(boxes, key=lambda box: box_overlap(box, self.box))
+            if box_overlap(best, self.box) >= self.min_overlap:
+                return best
+        return max(boxes, key=lambda box: (box[1] - box[3]) * (box[2] - box[0]))
+
+    def reset(self):
+        """Forget the tracked face, so the next frame is a keyframe."""
+        self.box = None
+        self.encoding = None
+        self._tracker = None
+
+
+def newest_message(ws):
+    """
+    Wait for a message and skip to the newest one already received.
+    The WebSocket buffers messages as they arrive, so everything that came
+    in while the previous frame was processed is waiting; only the last of
+    it is worth processing.
+    Args:
+        ws (simple_websocket.Server): The connection.
+    Returns:
+        tuple: The newest message and the number of older ones dropped.
+    Raises:
+        simple_websocket.ConnectionClosed: If the client disconnected.
+    """
+    message = ws.receive()
+    dropped = 0
+    while True:
+        newer = ws.receive(timeout=0)
+        if newer is None:
+            return message, dropped
+        message = newer
+        dropped += 1
@@ -0,0 +1,124 @@
+"""
+Prometheus metrics and request IDs for the ML service.
+
+Every request is timed by endpoint and tagged with an ID, taken from the
+caller's X-Request-ID header or generated, which is echoed in the response
+and added to every log line written while handling it. Recognition stages
+(decode, detect, encode, match) are timed separately so a slow capture can
+be traced from web_app's logs and metrics into this service's.
+"""
+
+import os
+import re
+import time
+import uuid
+import logging
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+REQUEST_LATENCY = Histogram(
+    "ml_request_duration_seconds",
+    "Time spent handling HTTP requests.",
+    ["endpoint", "method", "status"],
+)
+STAGE_LATENCY = Histogram(
+    "ml_stage_duration_seconds",
+    "Time spent in each recognition stage.",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+GALLERY_SIZE = Gauge(
+    "ml_gallery_size", "Encodings in the character gallery.", multiprocess_mode="max"
+)
+QUEUE_DEPTH = Gauge(
+    "ml_inference_queue_depth",
+    "Recognition tasks queued or running in the inference pool.",
+    multiprocess_mode="livesum",
+)
+
+
+def observe_stages(timings):
+    """
+    Record stage timings as reported by the preprocessing pipeline.
+    Args:
+        timings (dict): Milliseconds spent per stage, e.g. ``{"detect": 12.5}``.
+    """
+    for stage, milliseconds in timings.items():
+        STAGE_LATENCY.labels(stage).observe(milliseconds / 1000)
+
+
+def request_id():
+    """Return the ID of the current request, or ``-`` outside of one."""
+    if has_request_context():
+        return g.get("request_id", "-")
+    return "-"
+
+
+class RequestIdFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Add the current request ID to log records as ``request_id``."""
+
+    def filter(self, record):
+        record.request_id = request_id()
+        return True
+
+
+def metrics_response():
+    """
+    Render every metric in the Prometheus text format.
+    When PROMETHEUS_MULTIPROC_DIR is set, the metrics of all worker
+    processes are collected from that directory.
+    """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def instrument(app, refresh_gauges=None):
+    """
+    Time the requests of a Flask app, propagate request IDs and add /metrics.
+    Args:
+        app (Flask): The application.
+        refresh_gauges: Optional callable updating the gauges; it runs after
+            every request and before metrics are rendered.
+    """
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+
+    @app.before_request
+    def start_timer():
+        incoming = request.headers.get(REQUEST_ID_HEADER, "")
+        g.request_id = (
+            incoming if _REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex
+        )
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(
+            time.perf_counter() - g.get("request_start", time.perf_counter())
+        )
+        response.headers[REQUEST_ID_HEADER] = request_id()
+        if refresh_gauges:
+            refresh_gauges()
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        if refresh_gauges:
+            refresh_gauges()
+        return metrics_response()
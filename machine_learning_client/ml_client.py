@@ -1,106 +1,1240 @@
 """
 Optimized Machine Learning Service for Face Recognition
+
+Importing the module loads the dlib models (with face_recognition) but
+nothing else; init_service loads the gallery, warms up and starts the
+inference pool, and /readyz reports ready once it has. ``python
+ml_client.py`` runs it before serving; other WSGI servers must call it
+before the app takes traffic.
 """
 
-# pylint: disable=broad-exception-caught
+# pylint: disable=broad-exception-caught,too-many-lines
 
+import gc
 import os
+import hmac
+import base64
+import json
+import time
+import struct
 import logging
-from flask import Flask, request, jsonify
+import threading
+import multiprocessing
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask_sock import Sock
 import face_recognition
 import numpy as np
 
+try:
+    from .encoding_store import (
+        EncodingStore,
+        empty_matrix,
+        file_fingerprint,
+        stack_encodings,
+    )
+    from .gallery_index import GalleryIndex
+    from .encoding_codec import pack_encoding, unpack_encodings
+    from .inference_pool import InferencePool, PoolSaturated
+    from .preprocess import (
+        OptionLimits,
+        RecognitionOptions,
+        analyze_image,
+        analyze_loaded,
+        load_image,
+        parse_options,
+    )
+    from .result_cache import ResultCache, content_key, encoding_key
+    from .gallery_reloader import GalleryReloader
+    from .live_tracking import FaceTracker, newest_message
+    from .metrics import GALLERY_SIZE, QUEUE_DEPTH, STAGE_LATENCY
+    from .metrics import instrument, observe_stages
+except ImportError:
+    from encoding_store import (
+        EncodingStore,
+        empty_matrix,
+        file_fingerprint,
+        stack_encodings,
+    )
+    from gallery_index import GalleryIndex
+    from encoding_codec import pack_encoding, unpack_encodings
+    from inference_pool import InferencePool, PoolSaturated
+    from preprocess import (
+        OptionLimits,
+        RecognitionOptions,
+        analyze_image,
+        analyze_loaded,
+        load_image,
+        parse_options,
+    )
+    from result_cache import ResultCache, content_key, encoding_key
+    from gallery_reloader import GalleryReloader
+    from live_tracking import FaceTracker, newest_message
+    from metrics import GALLERY_SIZE, QUEUE_DEPTH, STAGE_LATENCY
+    from metrics import instrument, observe_stages
+
 app = Flask(__name__)
 
 logging.basicConfig(
-    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s",
 )
 
-ENCODINGS = []
-NAMES = []
+GALLERY = GalleryIndex(empty_matrix(), [])
 ENCODINGS_LOADED = False
+# Startup progress reported by /readyz; see init_service.
+STARTUP = {"phase": "starting", "warmup_ms": None}
 
 IMAGES_PATH = "/app/images"
+ENCODING_CACHE_PATH = os.getenv("ENCODING_CACHE_PATH", "/app/cache/encodings")
 THRESHOLD = 0.8
+INDEX_MODE = os.getenv("INDEX_MODE", "exact")
+INDEX_PROBES = int(os.getenv("INDEX_PROBES", "8"))
+# float16 or int8 search a compact copy of the gallery and re-rank the best
+# RERANK_CANDIDATES rows with exact distances; see gallery_index.py.
+GALLERY_PRECISION = os.getenv("GALLERY_PRECISION", "float32")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "32"))
+TOP_K = int(os.getenv("TOP_K", "3"))
+MATCH_MAX_K = int(os.getenv("MATCH_MAX_K", "50"))
+MATCH_MAX_ENCODINGS = int(os.getenv("MATCH_MAX_ENCODINGS", "1024"))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "16"))
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "256"))
+BATCH_MAX_IMAGE_BYTES = int(os.getenv("BATCH_MAX_IMAGE_BYTES", str(16 * 1024 * 1024)))
+BOOTSTRAP_WORKERS = int(os.getenv("BOOTSTRAP_WORKERS", str(os.cpu_count() or 1)))
+BOOTSTRAP_PARALLEL_MIN = int(os.getenv("BOOTSTRAP_PARALLEL_MIN", "32"))
+BOOTSTRAP_PROGRESS_EVERY = int(os.getenv("BOOTSTRAP_PROGRESS_EVERY", "100"))
+GALLERY_WATCH_INTERVAL = float(os.getenv("GALLERY_WATCH_INTERVAL", "0"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+ML_WORKERS = int(os.getenv("ML_WORKERS", "0"))
+ML_QUEUE_DEPTH = int(os.getenv("ML_QUEUE_DEPTH", "32"))
+ML_TASK_TIMEOUT = float(os.getenv("ML_TASK_TIMEOUT", "30"))
+# Recognized once on startup and by every inference pool worker, so the
+# first request does not pay for warming up dlib and the gallery.
+WARMUP_IMAGE = os.getenv(
+    "WARMUP_IMAGE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "warmup.jpg"),
+)
+
+DEFAULT_OPTIONS = RecognitionOptions(
+    max_side=int(os.getenv("MAX_IMAGE_SIDE", "1024")),
+    detector=os.getenv("FACE_DETECTOR", "hog"),
+    upsample=int(os.getenv("FACE_UPSAMPLE", "1")),
+    num_jitters=int(os.getenv("NUM_JITTERS", "1")),
+    model=os.getenv("ENCODING_MODEL", "small"),
+    all_faces=False,
+)
+# Ceilings on the options a request may ask for; by default requests can
+# only choose cheaper options than the defaults.
+REQUEST_LIMITS = OptionLimits(
+    max_side=int(os.getenv("REQUEST_MAX_SIDE", str(DEFAULT_OPTIONS.max_side))),
+    detectors=tuple(
+        os.getenv("REQUEST_DETECTORS", DEFAULT_OPTIONS.detector).split(",")
+    ),
+    upsample=int(os.getenv("REQUEST_MAX_UPSAMPLE", str(DEFAULT_OPTIONS.upsample))),
+    num_jitters=int(os.getenv("REQUEST_MAX_JITTERS", str(DEFAULT_OPTIONS.num_jitters))),
+)
+RESULT_CACHE = ResultCache(
+    max_entries=int(os.getenv("RESULT_CACHE_SIZE", "1024")),
+    max_bytes=int(os.getenv("RESULT_CACHE_BYTES", str(16 * 1024 * 1024))),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", "300")),
+)
+MATCH_CACHE_QUANTUM = float(os.getenv("MATCH_CACHE_QUANTUM", "0"))
+MATCH_CACHE = ResultCache(
+    max_entries=int(os.getenv("MATCH_CACHE_SIZE", "4096")),
+    max_bytes=int(os.getenv("MATCH_CACHE_BYTES", str(4 * 1024 * 1024))),
+    ttl=float(os.getenv("RESULT_CACHE_TTL", "300")),
+)
 
+# Live streams run detection at a lower resolution than uploads, on
+# keyframes only; see live_tracking.py.
+LIVE_OPTIONS = DEFAULT_OPTIONS._replace(max_side=int(os.getenv("LIVE_MAX_SIDE", "480")))
+LIVE_KEYFRAME_INTERVAL = int(os.getenv("LIVE_KEYFRAME_INTERVAL", "10"))
+LIVE_MIN_CONFIDENCE = float(os.getenv("LIVE_MIN_CONFIDENCE", "7"))
+LIVE_MIN_OVERLAP = float(os.getenv("LIVE_MIN_OVERLAP", "0.5"))
+LIVE_MAX_SESSIONS = int(os.getenv("LIVE_MAX_SESSIONS", "8"))
+LIVE_MAX_FRAME_BYTES = int(os.getenv("LIVE_MAX_FRAME_BYTES", str(2 * 1024 * 1024)))
+LIVE_SESSIONS = threading.BoundedSemaphore(LIVE_MAX_SESSIONS)
+# Streams must present a short-lived token web_app signs with this secret
+# for a logged-in user; without a secret /live refuses every stream. When
+# LIVE_ALLOWED_ORIGINS is set, the handshake's Origin must also be listed.
+LIVE_TOKEN_SECRET = os.getenv("LIVE_TOKEN_SECRET", "")
+LIVE_ALLOWED_ORIGINS = [
+    origin for origin in os.getenv("LIVE_ALLOWED_ORIGINS", "").split(",") if origin
+]
 
-def load_character_encodings():
+app.config["SOCK_SERVER_OPTIONS"] = {
+    "max_message_size": LIVE_MAX_FRAME_BYTES,
+    "ping_interval": 25,
+}
+sock = Sock(app)
+
+INFERENCE_POOL = None
+DECODE_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BATCH_DECODE_THREADS", "4")),
+    thread_name_prefix="decode",
+)
+# dlib's HOG detector crashes the process when several threads run it at
+# once, so without an inference pool recognition runs one call at a time.
+INLINE_INFERENCE = threading.Lock()
+
+
+def encode_reference_image(image_path):
     """
-    Load character encodings from the specified images folder.
+    Encode the first face found in a reference image.
+    Args:
+        image_path (str): Path of the image file.
+    Returns:
+        numpy.ndarray: The face encoding; None if no face was found, or False
+        if the image could not be loaded or encoded.
+    """
+    filename = os.path.basename(image_path)
+    try:
+        image = face_recognition.load_image_file(image_path)
+        face_enc = face_recognition.face_encodings(image)
+    except Exception as e:
+        logging.error("Error loading image %s: %s", filename, e)
+        return False
+    if face_enc:
+        logging.info("Loaded encoding for: %s", filename)
+        return face_enc[0]
+    logging.warning("No face found in image: %s", filename)
+    return None
+
+
+def encode_reference_images(image_paths, start_method="forkserver"):
+    """
+    Encode several reference images, in parallel when there are many.
+    With at least BOOTSTRAP_PARALLEL_MIN images, the work is split into
+    chunks across BOOTSTRAP_WORKERS processes. Errors stay isolated per file
+    exactly as in encode_reference_image. Progress is logged every
+    BOOTSTRAP_PROGRESS_EVERY images.
+    Args:
+        image_paths (list): Paths of the images to encode.
+        start_method (str): How the processes are started. Forking is
+            cheapest but only safe before the service starts any thread:
+            a child forked while another thread holds a lock inherits it
+            locked and can deadlock.
     Returns:
-        tuple: A list of face encodings and corresponding names.
+        list: The encoding of every image; None where no face was found and
+        False where encoding failed.
     """
+    workers = min(BOOTSTRAP_WORKERS, len(image_paths))
+    results = []
+
+    def report():
+        if len(results) % BOOTSTRAP_PROGRESS_EVERY == 0 or len(results) == len(
+            image_paths
+        ):
+            logging.info("Encoded %d/%d images", len(results), len(image_paths))
+
+    if workers <= 1 or len(image_paths) < BOOTSTRAP_PARALLEL_MIN:
+        for image_path in image_paths:
+            # Reloads run this next to request threads; see INLINE_INFERENCE.
+            with INLINE_INFERENCE:
+                results.append(encode_reference_image(image_path))
+            report()
+        return results
+
+    chunksize = max(1, len(image_paths) // (workers * 4))
+    logging.info(
+        "Encoding %d images with %d processes in chunks of %d",
+        len(image_paths),
+        workers,
+        chunksize,
+    )
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context(start_method)
+    ) as executor:
+        for encoding in executor.map(
+            encode_reference_image, image_paths, chunksize=chunksize
+        ):
+            results.append(encoding)
+            report()
+    return results
+
+
+def plan_gallery(cached_entries):
+    """
+    Decide which images can reuse a stored encoding and which need encoding.
+    Args:
+        cached_entries (dict): Manifest entries of the encoding store.
+    Returns:
+        tuple: For every image in gallery order, its filename, fingerprint,
+        name, stored row and whether the stored encoding is reused; and the
+        paths of the images that need encoding.
+    """
+    plan = []
+    pending = []
+    for filename in sorted(os.listdir(IMAGES_PATH)):
+        if not filename.lower().endswith((".png", ".jpg", ".jpeg")):
+            continue
+        image_path = os.path.join(IMAGES_PATH, filename)
+        previous = cached_entries.get(filename)
+        try:
+            stamp = file_fingerprint(image_path, previous)
+        except OSError:
+            stamp = None
+
+        if stamp and previous and previous["sha256"] == stamp["sha256"]:
+            plan.append((filename, stamp, previous["name"], previous["row"], True))
+        else:
+            plan.append((filename, stamp, os.path.splitext(filename)[0], None, False))
+            pending.append(image_path)
+
+    return plan, pending
+
+
+def assemble_gallery(plan, fresh_encodings, cached_matrix):
+    """
+    Combine reused and freshly computed encodings in gallery order.
+    Args:
+        plan (list): The image plan from plan_gallery.
+        fresh_encodings (list): Encodings of the images that needed encoding.
+        cached_matrix (numpy.ndarray): The matrix loaded from the store.
+    Returns:
+        tuple: The encodings, their names, the stored row each was reused
+        from (None if fresh) and the new manifest entries. Images whose
+        encoding failed get no entry, so they are encoded again next time.
+    """
+    fresh = iter(fresh_encodings)
     encodings = []
     names = []
+    cached_rows = []
+    entries = {}
+    for filename, stamp, name, source_row, reused in plan:
+        if reused:
+            encoding = None if source_row is None else cached_matrix[source_row]
+        else:
+            encoding = next(fresh)
+            if encoding is False:
+                continue
+
+        if encoding is not None:
+            encodings.append(encoding)
+            names.append(name)
+            cached_rows.append(source_row)
+        if stamp:
+            entries[filename] = {
+                **stamp,
+                "name": name,
+                "row": None if encoding is None else len(encodings) - 1,
+            }
+    return encodings, names, cached_rows, entries
+
+
+def load_character_encodings(start_method="forkserver"):
+    """
+    Load character encodings from the specified images folder.
+    Encodings are cached in the encoding store at ENCODING_CACHE_PATH, so only
+    images that are new or whose content changed since the last run are
+    re-encoded, in parallel when there are many of them. When nothing changed
+    the stored matrix is returned as a read-only memory map without copying
+    it.
+    Args:
+        start_method (str): How encoding processes are started; see
+            encode_reference_images.
+    Returns:
+        tuple: A (n, 128) float32 matrix of face encodings and the
+        corresponding names.
+    """
     if not os.path.exists(IMAGES_PATH):
         logging.error("Images directory does not exist: %s", IMAGES_PATH)
-        return encodings, names
+        return empty_matrix(), []
+
+    store = EncodingStore(ENCODING_CACHE_PATH) if ENCODING_CACHE_PATH else None
+    cached_matrix, cached_entries = store.load() if store else (empty_matrix(), {})
+
+    plan, pending = plan_gallery(cached_entries)
+    encodings, names, cached_rows, entries = assemble_gallery(
+        plan, encode_reference_images(pending, start_method), cached_matrix
+    )
+    matrix = stack_encodings(encodings, cached_rows, cached_matrix)
+    if store and entries != cached_entries:
+        saved = store.save(None if matrix is cached_matrix else matrix, entries)
+        if saved and matrix is not cached_matrix:
+            # Serve the saved copy memory-mapped, like an unchanged store,
+            # rather than keeping the freshly stacked matrix in memory.
+            stored_matrix, _ = store.load()
+            if stored_matrix.shape == matrix.shape:
+                matrix = stored_matrix
+    logging.info(
+        "Reused %d cached encodings, encoded %d new or changed images",
+        len(cached_rows) - cached_rows.count(None),
+        cached_rows.count(None),
+    )
+    return matrix, names
+
+
+def build_gallery(start_method="forkserver"):
+    """
+    Build a gallery index from the images folder.
+    Args:
+        start_method (str): How encoding processes are started; see
+            encode_reference_images. Reloads run while request threads
+            are serving, so they must not fork.
+    Returns:
+        GalleryIndex: A new index over the current character encodings.
+    """
+    gallery = GalleryIndex(
+        *load_character_encodings(start_method),
+        mode=INDEX_MODE,
+        n_probe=INDEX_PROBES,
+        precision=GALLERY_PRECISION,
+        rerank=RERANK_CANDIDATES,
+    )
+    logging.info("Gallery memory: %s", gallery.memory_report())
+    return gallery
+
+
+def swap_gallery(gallery):
+    """
+    Make a newly built gallery the one used by new requests.
+    Requests already running keep the gallery they started with.
+    Args:
+        gallery (GalleryIndex): The new gallery.
+    """
+    global GALLERY, ENCODINGS_LOADED  # pylint: disable=global-statement
+    GALLERY = gallery
+    ENCODINGS_LOADED = True
+    GALLERY_SIZE.set(len(gallery))
+    RESULT_CACHE.clear()
+    MATCH_CACHE.clear()
+
+
+def refresh_gauges():
+    """Update the gauges that are read rather than counted."""
+    GALLERY_SIZE.set(len(GALLERY))
+    QUEUE_DEPTH.set(INFERENCE_POOL.pending if INFERENCE_POOL is not None else 0)
 
-    for filename in os.listdir(IMAGES_PATH):
-        if filename.lower().endswith((".png", ".jpg", ".jpeg")):
-            image_path = os.path.join(IMAGES_PATH, filename)
-            try:
-                image = face_recognition.load_image_file(image_path)
-                face_enc = face_recognition.face_encodings(image)
-                if face_enc:
-                    encodings.append(face_enc[0])
-                    names.append(os.path.splitext(filename)[0])
-                    logging.info("Loaded encoding for: %s", filename)
-                else:
-                    logging.warning("No face found in image: %s", filename)
-            except Exception as e:
-                logging.error("Error loading image %s: %s", filename, e)
-    return encodings, names
 
+instrument(app, refresh_gauges)
 
-ENCODINGS, NAMES = load_character_encodings()
-ENCODINGS_LOADED = True
-logging.info("Character encodings loaded. Total: %d", len(ENCODINGS))
+RELOADER = GalleryReloader(build_gallery, swap_gallery)
+
+
+def match_result(matches):
+    """
+    Build the JSON result for one face from its nearest gallery matches.
+    Args:
+        matches (list): ``(name, distance)`` pairs sorted by distance.
+    Returns:
+        dict: The matched character (or "No match found" when the closest
+        distance is above THRESHOLD), its distance and the top matches.
+    """
+    if not matches:
+        return {"matched_character": "No match found", "matches": []}
+
+    best_name, min_distance = matches[0]
+    return {
+        "matched_character": (
+            "No match found" if min_distance > THRESHOLD else best_name
+        ),
+        "distance": min_distance,
+        "matches": [
+            {"character": name, "distance": distance} for name, distance in matches
+        ],
+    }
+
+
+def face_box(box):
+    """Return a ``(top, right, bottom, left)`` face box as a JSON object."""
+    return dict(zip(("top", "right", "bottom", "left"), map(int, box)))
+
+
+def image_result(boxes, face_matches, all_faces=False, encodings=None):
+    """
+    Build the JSON result for an image from the matches of its faces.
+    Args:
+        boxes (list): The ``(top, right, bottom, left)`` box of every face.
+        face_matches (list): The nearest gallery matches of every face.
+        all_faces (bool): Report every face under ``faces``.
+        encodings (list): If given, every reported face also carries its
+            packed ``encoding``.
+    Returns:
+        dict: The result for the first face or, with all_faces, the result
+        for the closest face plus a ``faces`` list with each face's box.
+    """
+    packed = [pack_encoding(encoding) for encoding in encodings or []]
+    if not all_faces:
+        result = match_result(face_matches[0])
+        if packed:
+            result["encoding"] = packed[0]
+        return result
+    faces = [
+        {"box": face_box(box), **match_result(matches)}
+        for box, matches in zip(boxes, face_matches)
+    ]
+    for face, encoding in zip(faces, packed):
+        face["encoding"] = encoding
+    best = min(faces, key=lambda face: face.get("distance", float("inf")))
+    result = {key: value for key, value in best.items() if key != "box"}
+    result["faces"] = faces
+    return result
+
+
+def request_options():
+    """
+    Return the recognition options for the current request, within
+    REQUEST_LIMITS.
+    Raises:
+        ValueError: If a request argument is invalid.
+    """
+    return parse_options(request.values, DEFAULT_OPTIONS, REQUEST_LIMITS)
+
+
+def locate_faces(data, options):
+    """
+    Encode the faces of an uploaded image, in the inference pool if enabled.
+    Returns:
+        tuple: The face boxes, encodings and stage timings from analyze_image.
+    Raises:
+        PoolSaturated: If the inference pool queue is full.
+    """
+    return run_inference(analyze_image, data, options)
+
+
+def run_inference(fn, *args):
+    """
+    Call a recognition function in the inference pool, or inline under
+    INLINE_INFERENCE when the pool is disabled.
+    Args:
+        fn (callable): A module-level function, so the pool can pickle it.
+        *args: Its arguments.
+    Returns:
+        The function's result.
+    Raises:
+        PoolSaturated: If the inference pool queue is full, or the worker
+            running the task died.
+    """
+    if INFERENCE_POOL is None:
+        with INLINE_INFERENCE:
+            return fn(*args)
+    future = INFERENCE_POOL.submit(fn, *args)
+    try:
+        return future.result(timeout=ML_TASK_TIMEOUT)
+    except BrokenProcessPool as e:
+        raise PoolSaturated("Recognition worker died") from e
+
+
+def match_faces(gallery, encodings, k=None):
+    """
+    Match face encodings against the gallery in one search.
+    With MATCH_CACHE_QUANTUM set, matches of near-identical encodings are
+    served from the match cache and only the remaining faces are searched.
+    Args:
+        gallery (GalleryIndex): The gallery to match against.
+        encodings (list): The face encodings.
+        k (int): Matches per face; defaults to TOP_K.
+    Returns:
+        list: The nearest ``(name, distance)`` matches of every face.
+    """
+    k = k or TOP_K
+    if MATCH_CACHE_QUANTUM <= 0:
+        return gallery.batch_matches(np.vstack(encodings), k=k)
+
+    keys = [
+        encoding_key(encoding, MATCH_CACHE_QUANTUM, gallery.generation, k)
+        for encoding in encodings
+    ]
+    face_matches = [MATCH_CACHE.get(key) for key in keys]
+    missing = [i for i, matches in enumerate(face_matches) if matches is None]
+    if missing:
+        found = gallery.batch_matches(np.vstack([encodings[i] for i in missing]), k=k)
+        for i, matches in zip(missing, found):
+            face_matches[i] = matches
+            MATCH_CACHE.put(keys[i], matches, 64 * (len(matches) + 1))
+    return face_matches
+
+
+def cache_result(key, payload, status=200):
+    """Cache a recognition response under a content key."""
+    RESULT_CACHE.put(key, (payload, status), len(json.dumps(payload)) + len(key))
+
+
+def uploaded_image():
+    """
+    Return the image uploaded with the current request.
+    The image is either the raw request body, with an ``image/*`` or
+    application/octet-stream Content-Type, or a multipart ``file`` part.
+    Raises:
+        ValueError: If no image was uploaded or it is empty.
+    """
+    if request.mimetype.startswith("image/") or (
+        request.mimetype == "application/octet-stream"
+    ):
+        data = request.get_data()
+    elif "file" in request.files:
+        data = request.files["file"].read()
+    else:
+        raise ValueError("No file part")
+    if not data:
+        raise ValueError("Empty image")
+    return data
+
+
+def include_encodings():
+    """Return whether the request asks for the encodings of matched faces."""
+    return request.values.get("include_encoding", "").lower() in ("1", "true", "yes")
 
 
 @app.route("/recognize_face", methods=["POST"])
-def recognize_face():
+def recognize_face():  # pylint: disable=too-many-return-statements
     """
     Recognize face from an uploaded image.
+    With ``all_faces=1`` every detected face is matched, using one distance
+    computation for all of them, and returned with its bounding box.
+    ``max_side``, ``detector``, ``upsample``, ``num_jitters`` and ``model``
+    override the deployment's preprocessing and detector settings.
+    Responses are cached by a hash of the uploaded bytes, the options and the
+    gallery generation; cached responses carry ``"cached": true``.
+    The image is either a multipart ``file`` part or the raw request body
+    with an ``image/*`` or application/octet-stream Content-Type. With
+    ``include_encoding=1`` the packed encoding of each reported face is
+    returned too, so it can later be matched again with /match.
     Returns:
         Response: JSON response with the matched character or an error message.
     """
-    if "file" not in request.files:
-        return jsonify({"error": "No file part"}), 400
+    try:
+        data = uploaded_image()
+        options = request_options()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    with_encodings = include_encodings()
+
+    gallery = GALLERY
+    cache_key = content_key(data, options, gallery.generation, TOP_K, with_encodings)
+    cached = RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        payload, status = cached
+        return jsonify({**payload, "cached": True}), status
 
-    file = request.files["file"]
     try:
-        test_image = face_recognition.load_image_file(file)
-        test_encodings = face_recognition.face_encodings(test_image)
+        boxes, test_encodings, timings = locate_faces(data, options)
 
         if not test_encodings:
+            cache_result(cache_key, {"error": "No face found in the image"}, 400)
             return jsonify({"error": "No face found in the image"}), 400
 
-        test_encoding = test_encodings[0]
-
         if not ENCODINGS_LOADED:
             return jsonify({"error": "Encodings not loaded"}), 500
 
-        distances = face_recognition.face_distance(ENCODINGS, test_encoding)
-        if len(distances) == 0:
-            return jsonify({"matched_character": "No match found"})
-
-        min_distance_index = np.argmin(distances)
-        min_distance = distances[min_distance_index]
-
-        if min_distance > THRESHOLD:
-            matched_character = "No match found"
-        else:
-            matched_character = NAMES[min_distance_index]
-
+        start = time.perf_counter()
+        face_matches = match_faces(gallery, test_encodings)
+        timings["match"] = round((time.perf_counter() - start) * 1000, 2)
+        observe_stages(timings)
+        result = image_result(
+            boxes,
+            face_matches,
+            options.all_faces,
+            test_encodings if with_encodings else None,
+        )
+        cache_result(cache_key, result)
         logging.info(
-            "Matched character: %s with distance: %.2f", matched_character, min_distance
+            "Matched character: %s with distance: %.2f (timings: %s)",
+            result["matched_character"],
+            result.get("distance", float("nan")),
+            timings,
         )
-        return jsonify({"matched_character": matched_character})
+        return jsonify({**result, "timings_ms": timings})
+    except PoolSaturated as e:
+        logging.warning("Rejecting recognition request: %s", e)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
     except Exception as e:
         logging.error("Error during face recognition: %s", str(e))
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/encode", methods=["POST"])
+def encode():
+    """
+    Detect and encode the faces of an uploaded image without matching them.
+    The image is sent as to /recognize_face and the same preprocessing
+    arguments apply. Responses are cached by a hash of the image and the
+    options; they do not depend on the gallery.
+    Returns:
+        Response: JSON with a ``faces`` list holding the box and the packed
+        float32 ``encoding`` of every face.
+    """
+    try:
+        data = uploaded_image()
+        options = request_options()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    cache_key = content_key(data, options, "encode")
+    cached = RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        payload, status = cached
+        return jsonify({**payload, "cached": True}), status
+
+    try:
+        boxes, encodings, timings = locate_faces(data, options)
+    except PoolSaturated as e:
+        logging.warning("Rejecting encoding request: %s", e)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "1"}
+    except Exception as e:
+        logging.error("Error during face encoding: %s", str(e))
+        return jsonify({"error": str(e)}), 500
+    observe_stages(timings)
+    if not encodings:
+        cache_result(cache_key, {"error": "No face found in the image"}, 400)
+        return jsonify({"error": "No face found in the image"}), 400
+    if not options.all_faces:
+        boxes, encodings = boxes[:1], encodings[:1]
+    result = {
+        "faces": [
+            {"box": face_box(box), "encoding": pack_encoding(encoding)}
+            for box, encoding in zip(boxes, encodings)
+        ],
+        "dtype": "float32",
+    }
+    cache_result(cache_key, result)
+    return jsonify({**result, "timings_ms": timings})
+
+
+@app.route("/match", methods=["POST"])
+def match():
+    """
+    Match packed encodings, as returned by /encode, against the gallery.
+    The JSON body holds ``encodings``, a list of at most MATCH_MAX_ENCODINGS
+    packed encodings, and optionally ``k``, the number of matches per
+    encoding (TOP_K by default, at most MATCH_MAX_K).
+    Returns:
+        Response: JSON with one /recognize_face style result per encoding,
+        in order, and the generation of the gallery they were matched with.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("encodings"), list):
+        return jsonify({"error": "Expected a JSON object with encodings"}), 400
+    packed = body["encodings"]
+    if len(packed) > MATCH_MAX_ENCODINGS:
+        return jsonify({"error": f"At most {MATCH_MAX_ENCODINGS} encodings"}), 400
+    try:
+        k = int(body.get("k", TOP_K))
+        if not 1 <= k <= MATCH_MAX_K:
+            raise ValueError(f"k must be between 1 and {MATCH_MAX_K}")
+        encodings = unpack_encodings(packed)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    gallery = GALLERY
+    results = []
+    if len(encodings):
+        with STAGE_LATENCY.labels("match").time():
+            results = [
+                match_result(matches) for matches in match_faces(gallery, encodings, k)
+            ]
+    return jsonify({"results": results, "generation": gallery.generation})
+
+
+def detect_live_faces(image):
+    """
+    Return the boxes of the faces in a live frame, in frame coordinates.
+    Runs in the inference pool; see run_inference.
+    """
+    return face_recognition.face_locations(
+        image,
+        number_of_times_to_upsample=LIVE_OPTIONS.upsample,
+        model=LIVE_OPTIONS.detector,
+    )
+
+
+def encode_live_face(image, box):
+    """
+    Return the encoding of the face in a box of a live frame.
+    Runs in the inference pool; see run_inference.
+    """
+    return face_recognition.face_encodings(
+        image,
+        known_face_locations=[box],
+        num_jitters=LIVE_OPTIONS.num_jitters,
+        model=LIVE_OPTIONS.model,
+    )[0]
+
+
+def live_result(tracker, data, matched):
+    """
+    Follow the face into the next frame of a live stream.
+    The face is matched against the gallery only when the tracker encoded
+    it afresh or the gallery was reloaded; otherwise the last match holds.
+    Args:
+        tracker (FaceTracker): The stream's tracker.
+        data (bytes): The encoded frame.
+        matched (dict): The stream's last match, as its gallery
+            ``generation`` and ``result``; updated when matching again.
+    Returns:
+        dict: The face's ``box`` in frame coordinates (None when no face is
+        in view), whether the frame was a ``keyframe`` and whether the face
+        was ``encoded``, the /recognize_face match fields while a face is in
+        view and the stage timings.
+    """
+    start = time.perf_counter()
+    image, scale = load_image(data, LIVE_OPTIONS.max_side)
+    timings = {"decode": round((time.perf_counter() - start) * 1000, 2)}
+    state = tracker.process(image)
+    timings.update(state["timings"])
+    result = {"box": None, "keyframe": state["keyframe"], "encoded": state["encoded"]}
+    if state["box"] is not None:
+        result["box"] = face_box([side * scale for side in state["box"]])
+        gallery = GALLERY
+        if state["encoded"] or matched.get("generation") != gallery.generation:
+            start = time.perf_counter()
+            matched["result"] = match_result(
+                match_faces(gallery, [tracker.encoding])[0]
+            )
+            matched["generation"] = gallery.generation
+            timings["match"] = round((time.perf_counter() - start) * 1000, 2)
+        result.update(matched["result"])
+    observe_stages(timings)
+    result["timings_ms"] = timings
+    return result
+
+
+def live(ws):
+    """
+    Recognize the face in a webcam stream sent over a WebSocket.
+    The client sends every frame as a binary message holding a JPEG or PNG
+    image and gets a JSON text message back for every frame processed, with
+    the ``frame`` number counting all frames received, the fields of
+    live_result and the number of frames ``dropped`` so far because newer
+    ones had arrived before they could be processed. Frames are decoded
+    and tracked in the request thread; detection and encoding go through
+    run_inference like uploads. At most
+    LIVE_MAX_SESSIONS streams are served at once; others are closed with
+    code 1013 (try again later).
+    Args:
+        ws (simple_websocket.Server): The connection.
+    """
+    if not LIVE_SESSIONS.acquire(blocking=False):  # pylint: disable=consider-using-with
+        ws.close(reason=1013, message="Too many live streams")
+        return
+    try:
+        tracker = FaceTracker(
+            lambda image: run_inference(detect_live_faces, image),
+            lambda image, box: run_inference(encode_live_face, image, box),
+            keyframe_interval=LIVE_KEYFRAME_INTERVAL,
+            min_confidence=LIVE_MIN_CONFIDENCE,
+            min_overlap=LIVE_MIN_OVERLAP,
+        )
+        matched = {}
+        received = dropped = 0
+        while True:
+            data, skipped = newest_message(ws)
+            received += skipped + 1
+            dropped += skipped
+            if not isinstance(data, bytes):
+                reply = {"error": "Frames must be sent as binary messages"}
+            else:
+                try:
+                    reply = live_result(tracker, data, matched)
+                except Exception as e:
+                    logging.error("Error during live recognition: %s", str(e))
+                    reply = {"error": str(e)}
+            ws.send(json.dumps({**reply, "frame": received, "dropped": dropped}))
+    finally:
+        LIVE_SESSIONS.release()
+
+
+sock.route("/live")(live)
+
+
+def verify_live_token(token, now=None):
+    """
+    Check a /live token issued by web_app.
+    Tokens are ``<user>.<expires>.<signature>``: the base64url username,
+    the Unix time they expire at and the hex HMAC-SHA256 of the first two
+    parts under LIVE_TOKEN_SECRET.
+    Args:
+        token (str): The token from the handshake's query string.
+        now (float, optional): The current Unix time.
+    Returns:
+        str: The username the token was issued to, or None if it is
+        malformed, forged or expired.
+    """
+    if not LIVE_TOKEN_SECRET:
+        return None
+    try:
+        user, expires, signature = token.split(".")
+        expires_at = int(expires)
+        username = base64.urlsafe_b64decode(user.encode()).decode()
+    except ValueError:
+        return None
+    expected = hmac.new(
+        LIVE_TOKEN_SECRET.encode(), f"{user}.{expires}".encode(), "sha256"
+    ).hexdigest()
+    if not hmac.compare_digest(signature.encode(), expected.encode()):
+        return None
+    if expires_at < (time.time() if now is None else now):
+        return None
+    return username
+
+
+@app.before_request
+def authorize_live():
+    """
+    Refuse /live handshakes from unlisted origins or without a valid token,
+    before the connection is upgraded.
+    """
+    if request.endpoint != "live":
+        return None
+    if LIVE_ALLOWED_ORIGINS and request.headers.get("Origin") not in (
+        LIVE_ALLOWED_ORIGINS
+    ):
+        return jsonify({"error": "Origin not allowed"}), 403
+    if verify_live_token(request.args.get("token", "")) is None:
+        return jsonify({"error": "Invalid or expired live token"}), 403
+    return None
+
+
+@app.route("/cache_stats", methods=["GET"])
+def cache_stats():
+    """
+    Report the result and match cache counters.
+    Returns:
+        Response: JSON with hits, misses, entries and bytes of each cache.
+    """
+    return jsonify({"results": RESULT_CACHE.stats(), "matches": MATCH_CACHE.stats()})
+
+
+def read_packed_images(stream):
+    """
+    Read images from a packed binary stream.
+    Each image is a 4-byte big-endian length followed by that many bytes.
+    Args:
+        stream: A file-like object holding the packed images.
+    Yields:
+        tuple: A generated name and the bytes of each image.
+    Raises:
+        ValueError: If a frame is truncated or larger than BATCH_MAX_IMAGE_BYTES.
+    """
+    index = 0
+    while True:
+        header = stream.read(4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError("Truncated image header")
+        (length,) = struct.unpack(">I", header)
+        if length > BATCH_MAX_IMAGE_BYTES:
+            raise ValueError(f"Image {index} exceeds {BATCH_MAX_IMAGE_BYTES} bytes")
+        data = b""
+        while len(data) < length:
+            block = stream.read(length - len(data))
+            if not block:
+                raise ValueError(f"Truncated image {index}")
+            data += block
+        yield f"image_{index}", data
+        index += 1
+
+
+def decode_image(data, max_side):
+    """Decode image bytes with load_image, returning the error on failure."""
+    try:
+        start = time.perf_counter()
+        image, scale = load_image(data, max_side)
+        return image, scale, round((time.perf_counter() - start) * 1000, 2)
+    except Exception as e:
+        return e
+
+
+def encode_images(datas, options):
+    """
+    Encode the faces of several images.
+    Without an inference pool the images are decoded concurrently on threads
+    and encoded one after another; with a pool each image is a worker task,
+    waiting up to ML_TASK_TIMEOUT for a free slot.
+    Args:
+        datas (list): The bytes of each image.
+        options (RecognitionOptions): Preprocessing and detector settings.
+    Yields:
+        The ``(boxes, encodings, timings)`` of each image, or the exception
+        raised while processing it.
+    """
+    if INFERENCE_POOL is None:
+        decoded = DECODE_POOL.map(decode_image, datas, [options.max_side] * len(datas))
+        for outcome in decoded:
+            if isinstance(outcome, Exception):
+                yield outcome
+                continue
+            image, scale, decode_ms = outcome
+            try:
+                with INLINE_INFERENCE:
+                    boxes, encodings, timings = analyze_loaded(image, scale, options)
+                yield boxes, encodings, {"decode": decode_ms, **timings}
+            except Exception as e:
+                yield e
+        return
+
+    futures = []
+    for data in datas:
+        try:
+            futures.append(
+                INFERENCE_POOL.submit(
+                    analyze_image, data, options, timeout=ML_TASK_TIMEOUT
+                )
+            )
+        except PoolSaturated as e:
+            futures.append(e)
+    for future in futures:
+        if isinstance(future, Exception):
+            yield future
+            continue
+        try:
+            yield future.result(timeout=ML_TASK_TIMEOUT)
+        except Exception as e:
+            yield e
+
+
+def encode_chunk(chunk, start, options):
+    """
+    Encode the faces of a chunk of images.
+    Args:
+        chunk (list): ``(name, bytes)`` pairs for the images.
+        start (int): Position of the first image in the whole batch.
+        options (RecognitionOptions): Preprocessing and detector settings.
+    Returns:
+        tuple: The result dict of every image (holding an ``error`` for
+        images that failed) and ``(result, boxes, encodings)`` for the
+        images whose faces still need matching.
+    """
+    results = []
+    encoded = []
+    outcomes = encode_images([data for _, data in chunk], options)
+    for (filename, _), outcome in zip(chunk, outcomes):
+        result = {"index": start + len(results), "filename": filename}
+        results.append(result)
+        if isinstance(outcome, Exception):
+            result["error"] = str(outcome)
+            continue
+        boxes, test_encodings, result["timings_ms"] = outcome
+        observe_stages(result["timings_ms"])
+        if not test_encodings:
+            result["error"] = "No face found in the image"
+            continue
+        encoded.append((result, boxes, test_encodings))
+    return results, encoded
+
+
+def recognize_chunk(gallery, chunk, start, options):
+    """
+    Recognize a chunk of images with one gallery search.
+    The encodings of every face in the chunk are matched against the
+    gallery together.
+    Args:
+        gallery (GalleryIndex): The gallery to match against.
+        chunk (list): ``(name, bytes)`` pairs for the images.
+        start (int): Position of the first image in the whole batch.
+        options (RecognitionOptions): Preprocessing and detector settings.
+    Returns:
+        list: The JSON result for every image, in order.
+    """
+    results, encoded = encode_chunk(chunk, start, options)
+    if encoded:
+        with STAGE_LATENCY.labels("match").time():
+            all_matches = gallery.batch_matches(
+                np.vstack(
+                    [encoding for _, _, encodings in encoded for encoding in encodings]
+                ),
+                k=TOP_K,
+            )
+        row = 0
+        for result, boxes, encodings in encoded:
+            face_matches = all_matches[row : row + len(encodings)]
+            result.update(image_result(boxes, face_matches, options.all_faces))
+            row += len(encodings)
+    return results
+
+
+@app.route("/recognize_faces", methods=["POST"])
+def recognize_faces():
+    """
+    Recognize faces in a batch of images.
+    Images are sent either as several multipart ``files`` parts or, with
+    Content-Type application/octet-stream, as a packed stream of
+    length-prefixed images. They are processed in chunks of BATCH_CHUNK_SIZE.
+    ``all_faces=1`` and the preprocessing arguments of /recognize_face apply
+    to every image.
+    Returns:
+        Response: Newline-delimited JSON with one result per image, streamed
+        as each chunk completes.
+    """
+    if request.mimetype == "application/octet-stream":
+        images = read_packed_images(request.stream)
+    elif "files" in request.files:
+        # Uploaded files are closed once the view returns, so read them here.
+        images = iter(
+            [
+                (file.filename, file.read())
+                for file in request.files.getlist("files")[: BATCH_MAX_IMAGES + 1]
+            ]
+        )
+    else:
+        return jsonify({"error": "No files part"}), 400
+
+    if not ENCODINGS_LOADED:
+        return jsonify({"error": "Encodings not loaded"}), 500
+
+    try:
+        options = request_options()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    gallery = GALLERY
+
+    def generate():
+        start = 0
+        try:
+            while start < BATCH_MAX_IMAGES:
+                size = min(BATCH_CHUNK_SIZE, BATCH_MAX_IMAGES - start)
+                chunk = list(islice(images, size))
+                if not chunk:
+                    return
+                for result in recognize_chunk(gallery, chunk, start, options):
+                    yield json.dumps(result) + "\n"
+                start += len(chunk)
+            if next(images, None) is not None:
+                yield json.dumps(
+                    {"error": f"Batch truncated at {BATCH_MAX_IMAGES} images"}
+                ) + "\n"
+        except ValueError as e:
+            logging.error("Invalid batch upload: %s", e)
+            yield json.dumps({"error": str(e)}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def is_admin():
+    """Return whether the request carries the configured admin token."""
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token, ADMIN_TOKEN)
+
+
+@app.route("/admin/reload_gallery", methods=["POST"])
+def reload_gallery():
+    """
+    Re-encode added or changed images in the background and swap them in.
+    Requires the ADMIN_TOKEN in the X-Admin-Token header; the endpoint is
+    disabled when no token is configured.
+    Returns:
+        Response: 202 once the reload has been scheduled.
+    """
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    started = RELOADER.request_reload()
+    return jsonify({"status": "reloading" if started else "queued"}), 202
+
+
+@app.route("/admin/gallery", methods=["GET"])
+def gallery_status():
+    """
+    Report the current gallery and reload state.
+    Returns:
+        Response: JSON with the gallery size, generation and reload status.
+    """
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    gallery = GALLERY
+    return jsonify(
+        {
+            "size": len(gallery),
+            "generation": gallery.generation,
+            "mode": gallery.mode,
+            "memory": gallery.memory_report(),
+            "reloading": RELOADER.reloading,
+            "last_reload": RELOADER.last_reload,
+            "last_error": RELOADER.last_error,
+        }
+    )
+
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    """
+    Liveness probe.
+    Returns:
+        Response: 200 whenever the process is serving requests.
+    """
+    return jsonify({"status": "ok"})
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """
+    Readiness probe.
+    Returns:
+        Response: 200 once init_service has loaded the gallery and warmed
+        up, with the gallery size and generation; 503 with the startup
+        ``status`` before that, or with ``inference_pool_broken`` while a
+        dead inference worker has not been replaced yet.
+    """
+    if STARTUP["phase"] != "ready":
+        return jsonify({"status": STARTUP["phase"]}), 503
+    if INFERENCE_POOL is not None and INFERENCE_POOL.broken:
+        return jsonify({"status": "inference_pool_broken"}), 503
+    gallery = GALLERY
+    return jsonify(
+        {
+            "status": "ready",
+            "gallery_size": len(gallery),
+            "generation": gallery.generation,
+            "warmup_ms": STARTUP["warmup_ms"],
+            "inference_workers": INFERENCE_POOL.size if INFERENCE_POOL else 0,
+        }
+    )
+
+
+def warm_up():
+    """
+    Recognize the WARMUP_IMAGE sample in this process.
+    The first detection, encoding and gallery search are much slower than
+    the following ones, so they are run here rather than by a request.
+    Returns:
+        dict: The stage timings in milliseconds, or None if the sample could
+        not be recognized.
+    """
+    try:
+        with open(WARMUP_IMAGE, "rb") as f:
+            _, encodings, timings = analyze_image(f.read(), DEFAULT_OPTIONS)
+    except Exception as e:
+        logging.warning("Warmup with %s failed: %s", WARMUP_IMAGE, e)
+        return None
+    if not encodings:
+        logging.warning("No face found in the warmup image %s", WARMUP_IMAGE)
+    elif len(GALLERY):
+        start = time.perf_counter()
+        match_faces(GALLERY, encodings)
+        timings["match"] = round((time.perf_counter() - start) * 1000, 2)
+    logging.info("Warmed up (timings: %s)", timings)
+    return timings
+
+
+def init_service():
+    """
+    Load the gallery, warm up and start the inference pool.
+    The inference pool forks its workers last, after the models and the
+    gallery are loaded and the warmup touched them, so every worker shares
+    those pages copy-on-write and is warm from its first task. /readyz
+    reports ready when this returns.
+    """
+    global INFERENCE_POOL  # pylint: disable=global-statement
+    STARTUP["phase"] = "loading"
+    # Nothing but this thread runs yet, so encoding processes can be forked.
+    swap_gallery(build_gallery(start_method="fork"))
+    logging.info("Character encodings loaded. Total: %d", len(GALLERY))
+    STARTUP["phase"] = "warming"
+    STARTUP["warmup_ms"] = warm_up()
+    if ML_WORKERS > 0:
+        # Never collect what exists now: collections in the workers would
+        # write to those objects and so copy the pages they share.
+        gc.freeze()
+        INFERENCE_POOL = InferencePool(ML_WORKERS, ML_QUEUE_DEPTH, WARMUP_IMAGE)
+    if GALLERY_WATCH_INTERVAL > 0:
+        RELOADER.watch(IMAGES_PATH, GALLERY_WATCH_INTERVAL)
+    STARTUP["phase"] = "ready"
+
+
 if __name__ == "__main__":
+    init_service()
     app.run(host="0.0.0.0", port=5000)
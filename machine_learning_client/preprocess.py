@@ -0,0 +1,170 @@
+"""
+Image preprocessing and face encoding pipeline.
+
+Uploads are decoded with Pillow, using JPEG draft mode so large frames are
+decoded directly at a reduced scale, and downscaled so their longest side is
+at most ``max_side``. Faces are detected and encoded on the small image and
+their boxes are mapped back to the coordinates of the original upload. Every
+stage is timed so the speed/accuracy tradeoff can be tuned.
+
+Callers may pick their own options per request, within limits set by the
+deployment: the cnn detector, upsampling, jitters and large images cost
+orders of magnitude more CPU than the defaults.
+"""
+
+import io
+import time
+from collections import namedtuple
+
+import numpy as np
+import face_recognition
+from PIL import Image
+
+DETECTORS = ("hog", "cnn")
+ENCODING_MODELS = ("small", "large")
+MAX_UPSAMPLE = 2
+MAX_JITTERS = 10
+
+RecognitionOptions = namedtuple(
+    "RecognitionOptions",
+    ["max_side", "detector", "upsample", "num_jitters", "model", "all_faces"],
+)
+# The most expensive options a request may ask for: the largest max_side
+# (0 allows the original size), the allowed detectors and the most
+# upsampling and jitters.
+OptionLimits = namedtuple(
+    "OptionLimits", ["max_side", "detectors", "upsample", "num_jitters"]
+)
+
+
+def parse_options(values, defaults, limits=None):
+    """
+    Build recognition options from request values.
+    Args:
+        values (Mapping): Request arguments or form fields overriding the
+            defaults, e.g. ``max_side=800`` or ``detector=cnn``.
+        defaults (RecognitionOptions): The deployment's default options.
+        limits (OptionLimits): If given, max_side, upsample and num_jitters
+            are lowered to these limits and other detectors are rejected.
+    Returns:
+        RecognitionOptions: The options for this request.
+    Raises:
+        ValueError: If a value is malformed or out of range.
+    """
+    options = defaults._replace(
+        max_side=int(values.get("max_side", defaults.max_side)),
+        detector=values.get("detector", defaults.detector),
+        upsample=int(values.get("upsample", defaults.upsample)),
+        num_jitters=int(values.get("num_jitters", defaults.num_jitters)),
+        model=values.get("model", defaults.model),
+        all_faces=str(values.get("all_faces", defaults.all_faces)).lower()
+        in ("1", "true", "yes"),
+    )
+    if options.max_side < 0:
+        raise ValueError("max_side must not be negative")
+    if options.detector not in DETECTORS:
+        raise ValueError(f"detector must be one of {', '.join(DETECTORS)}")
+    if not 0 <= options.upsample <= MAX_UPSAMPLE:
+        raise ValueError(f"upsample must be between 0 and {MAX_UPSAMPLE}")
+    if not 1 <= options.num_jitters <= MAX_JITTERS:
+        raise ValueError(f"num_jitters must be between 1 and {MAX_JITTERS}")
+    if options.model not in ENCODING_MODELS:
+        raise ValueError(f"model must be one of {', '.join(ENCODING_MODELS)}")
+    if limits is None:
+        return options
+    if options.detector not in limits.detectors:
+        raise ValueError(f"detector must be one of {', '.join(limits.detectors)}")
+    max_side = options.max_side
+    if limits.max_side and not 0 < max_side <= limits.max_side:
+        max_side = limits.max_side
+    return options._replace(
+        max_side=max_side,
+        upsample=min(options.upsample, limits.upsample),
+        num_jitters=min(options.num_jitters, limits.num_jitters),
+    )
+
+
+def _elapsed_ms(start):
+    """Return the milliseconds elapsed since a perf_counter value."""
+    return round((time.perf_counter() - start) * 1000, 2)
+
+
+def load_image(data, max_side=0):
+    """
+    Decode an image, downscaling it so its longest side is at most max_side.
+    Args:
+        data: The image as bytes or a binary file object.
+        max_side (int): Maximum length of the longest side; 0 keeps the
+            original size.
+    Returns:
+        tuple: The RGB image as a uint8 array and the factor that maps its
+        coordinates back to the original image.
+    """
+    image = Image.open(io.BytesIO(data) if isinstance(data, bytes) else data)
+    original_width, original_height = image.size
+    if max_side and max(image.size) > max_side:
+        # JPEG can decode at 1/2, 1/4 or 1/8 scale, which is much cheaper
+        # than decoding everything and resizing afterwards.
+        image.draft("RGB", (max_side, max_side))
+    image = image.convert("RGB")
+    if max_side and max(image.size) > max_side:
+        ratio = max_side / max(image.size)
+        image = image.resize(
+            (max(1, round(image.width * ratio)), max(1, round(image.height * ratio))),
+            Image.Resampling.BILINEAR,
+        )
+    scale = max(original_width / image.width, original_height / image.height)
+    return np.asarray(image), scale
+
+
+def analyze_loaded(image, scale, options):
+    """
+    Detect and encode the faces of a decoded image.
+    Args:
+        image (numpy.ndarray): The RGB image from load_image.
+        scale (float): The factor mapping image coordinates to the original.
+        options (RecognitionOptions): Detector and encoder settings. Unless
+            ``all_faces`` is set only the first detected face is encoded.
+    Returns:
+        tuple: The ``(top, right, bottom, left)`` box of every face in
+        original image coordinates, the face encodings and the ``detect`` and
+        ``encode`` timings in milliseconds.
+    """
+    start = time.perf_counter()
+    locations = face_recognition.face_locations(
+        image, number_of_times_to_upsample=options.upsample, model=options.detector
+    )
+    timings = {"detect": _elapsed_ms(start)}
+    if not options.all_faces:
+        locations = locations[:1]
+
+    start = time.perf_counter()
+    encodings = []
+    if locations:
+        encodings = face_recognition.face_encodings(
+            image,
+            known_face_locations=locations,
+            num_jitters=options.num_jitters,
+            model=options.model,
+        )
+    timings["encode"] = _elapsed_ms(start)
+
+    boxes = [tuple(int(round(side * scale)) for side in box) for box in locations]
+    return boxes, encodings, timings
+
+
+def analyze_image(data, options):
+    """
+    Decode an image and detect and encode its faces.
+    Args:
+        data: The image as bytes or a binary file object.
+        options (RecognitionOptions): Preprocessing and detector settings.
+    Returns:
+        tuple: The face boxes, encodings and per-stage timings, as returned
+        by analyze_loaded, with the ``decode`` time added.
+    """
+    start = time.perf_counter()
+    image, scale = load_image(data, options.max_side)
+    decode_ms = _elapsed_ms(start)
+    boxes, encodings, timings = analyze_loaded(image, scale, options)
+    return boxes, encodings, {"decode": decode_ms, **timings}
@@ -0,0 +1,116 @@
+"""
+Bounded LRU cache with expiry for recognition results.
+
+Results are keyed by a hash of the uploaded bytes together with everything
+else that affects the answer (recognition options and gallery generation),
+so a changed gallery never serves stale matches. The cache is bounded both
+by entry count and by the approximate size of the cached values.
+"""
+
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def content_key(data, *parts):
+    """
+    Return a cache key for some content and the parameters applied to it.
+    Args:
+        data (bytes): The content, e.g. an uploaded image.
+        parts: Other values the result depends on; their repr is hashed.
+    Returns:
+        str: A hex SHA-256 digest.
+    """
+    digest = hashlib.sha256(data)
+    for part in parts:
+        digest.update(b"\0" + repr(part).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def encoding_key(encoding, quantum, *parts):
+    """
+    Return a cache key shared by encodings that round to the same grid point.
+    Args:
+        encoding (numpy.ndarray): A face encoding.
+        quantum (float): Grid spacing; encodings closer than this in every
+            dimension usually share a key.
+        parts: Other values the result depends on.
+    Returns:
+        str: A hex SHA-256 digest.
+    """
+    grid = np.round(np.asarray(encoding, dtype=np.float64) / quantum)
+    return content_key(grid.astype(np.int32).tobytes(), quantum, *parts)
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache whose entries expire after a time to live.
+    Args:
+        max_entries (int): Maximum number of entries; 0 disables the cache.
+        max_bytes (int): Maximum total size of the cached values.
+        ttl (float): Seconds an entry stays valid.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.counters = {"hits": 0, "misses": 0}
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for a key, or None if absent or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value, size):
+        """
+        Cache a value, evicting the least recently used entries if needed.
+        Args:
+            key (str): The cache key.
+            value: The value to cache; it must not be modified afterwards.
+            size (int): Approximate size of the value in bytes.
+        """
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """Drop an entry; the lock must be held."""
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return the hit and miss counters and the current footprint."""
+        with self._lock:
+            return {
+                **self.counters,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
@@ -0,0 +1,88 @@
+"""
+Unit tests for the gallery_index module
+"""
+
+import numpy as np
+import pytest
+from machine_learning_client.gallery_index import GalleryIndex
+
+
+def random_gallery(size, seed=0):
+    """Return a random gallery of unit-scale encodings and names."""
+    rng = np.random.default_rng(seed)
+    matrix = rng.normal(scale=0.1, size=(size, 128)).astype(np.float32)
+    return matrix, [f"character_{i}" for i in range(size)]
+
+
+def test_exact_search_matches_brute_force():
+    """Test that exact search agrees with a direct distance computation."""
+    matrix, names = random_gallery(200)
+    queries = matrix[:5] + 0.01
+
+    indices, distances = GalleryIndex(matrix, names).search(queries, k=4)
+
+    expected = np.linalg.norm(matrix[None, :, :] - queries[:, None, :], axis=2)
+    assert np.array_equal(indices, np.argsort(expected, axis=1)[:, :4])
+    assert np.allclose(distances, np.sort(expected, axis=1)[:, :4], atol=1e-5)
+
+
+def test_ivf_search_finds_near_duplicates():
+    """Test that approximate search finds the row a query was derived from."""
+    matrix, names = random_gallery(2000)
+    index = GalleryIndex(matrix, names, mode="ivf", n_probe=4)
+    assert index.mode == "ivf"
+
+    indices, _ = index.search(matrix[:50] + 0.001, k=1)
+
+    assert np.array_equal(indices[:, 0], np.arange(50))
+
+
+def test_ivf_falls_back_to_exact_for_small_galleries():
+    """Test that tiny galleries are scanned exactly."""
+    matrix, names = random_gallery(9)
+    assert GalleryIndex(matrix, names, mode="ivf").mode == "exact"
+
+
+def test_search_empty_gallery():
+    """Test that an empty gallery returns no matches."""
+    index = GalleryIndex(np.empty((0, 128)), [])
+    assert not index.matches(np.zeros(128), k=3)
+
+
+def test_unknown_mode():
+    """Test that an unknown index mode is rejected."""
+    matrix, names = random_gallery(3)
+    with pytest.raises(ValueError):
+        GalleryIndex(matrix, names, mode="lsh")
+
+
+@pytest.mark.parametrize("precision", ["float16", "int8"])
+@pytest.mark.parametrize("mode", ["exact", "ivf"])
+def test_compact_search_reranks_exactly(precision, mode):
+    """Test that compact galleries return the exact neighbours and distances."""
+    matrix, names = random_gallery(2000)
+    rng = np.random.default_rng(1)
+    queries = matrix[:40] + rng.normal(scale=0.05, size=(40, 128)).astype(np.float32)
+
+    compact = GalleryIndex(matrix, names, mode=mode, n_probe=8, precision=precision)
+    indices, distances = compact.search(queries, k=3)
+    expected_indices, expected_distances = GalleryIndex(
+        matrix, names, mode=mode, n_probe=8
+    ).search(queries, k=3)
+
+    assert np.array_equal(indices[:, 0], expected_indices[:, 0])
+    assert np.allclose(distances, expected_distances, atol=1e-5)
+    report = compact.memory_report()
+    assert report["search_bytes"] < matrix.nbytes * (
+        0.6 if precision == "float16" else 0.3
+    )
+
+
+def test_compact_precision_validation():
+    """Test that unknown precisions are rejected."""
+    matrix, names = random_gallery(10)
+    with pytest.raises(ValueError):
+        GalleryIndex(matrix, names, precision="int4")
+    assert not GalleryIndex(np.empty((0, 128)), [], precision="int8").matches(
+        np.zeros(128), k=3
+    )
@@ -0,0 +1,53 @@
+"""
+Unit tests for the gallery_reloader module
+"""
+
+import threading
+from machine_learning_client.gallery_reloader import (
+    GalleryReloader,
+    directory_signature,
+)
+
+
+def test_directory_signature_tracks_images(tmp_path):
+    """Test that the signature changes when images are added or modified."""
+    (tmp_path / "notes.txt").write_text("ignored")
+    empty = directory_signature(str(tmp_path))
+    (tmp_path / "harry.jpg").write_bytes(b"harry")
+    added = directory_signature(str(tmp_path))
+    (tmp_path / "harry.jpg").write_bytes(b"harry, changed")
+
+    assert empty == ()
+    assert [name for name, _, _ in added] == ["harry.jpg"]
+    assert directory_signature(str(tmp_path)) != added
+    assert directory_signature(str(tmp_path / "missing")) is None
+
+
+def test_reload_requested_during_build_runs_again():
+    """Test that a reload requested while building triggers one more build."""
+    building = threading.Event()
+    release = threading.Event()
+    builds = []
+    swapped = []
+
+    def build():
+        """Build a gallery, blocking the first build until released."""
+        builds.append(len(builds))
+        if len(builds) == 1:
+            building.set()
+            release.wait(5)
+        return builds[-1:]
+
+    reloader = GalleryReloader(build, swapped.append)
+    assert reloader.request_reload()
+    building.wait(5)
+    assert not reloader.request_reload()
+    assert not reloader.request_reload()
+    release.set()
+    for _ in range(100):
+        if not reloader.reloading:
+            break
+        threading.Event().wait(0.05)
+
+    assert builds == [0, 1]
+    assert swapped == [[0], [1]]
@@ -0,0 +1,62 @@
+"""
+Unit tests for the inference_pool module
+"""
+
+import os
+import time
+import signal
+import pytest
+from machine_learning_client.inference_pool import InferencePool, PoolSaturated
+
+
+def test_pool_runs_tasks_in_worker_processes():
+    """Test that tasks run in forked worker processes."""
+    pool = InferencePool(2, 0)
+    try:
+        pids = {pool.submit(os.getpid).result() for _ in range(2)}
+        assert os.getpid() not in pids
+    finally:
+        pool.shutdown()
+
+
+def test_pool_rejects_tasks_when_full():
+    """Test that submissions beyond workers plus queue depth are rejected."""
+    pool = InferencePool(1, 1)
+    try:
+        running = pool.submit(time.sleep, 0.5)
+        queued = pool.submit(time.sleep, 0)
+        assert pool.pending == 2
+        with pytest.raises(PoolSaturated):
+            pool.submit(time.sleep, 0)
+        running.result()
+        queued.result()
+        assert pool.submit(os.getpid, timeout=1).result()
+    finally:
+        pool.shutdown()
+
+
+def test_pool_warms_workers_with_sample_image():
+    """Test that workers start after recognizing the warmup image."""
+    sample = os.path.join(os.path.dirname(__file__), os.pardir, "warmup.jpg")
+    pool = InferencePool(1, 0, warmup_image=sample)
+    try:
+        assert pool.submit(os.getpid, timeout=1).result() != os.getpid()
+    finally:
+        pool.shutdown()
+
+
+def test_pool_replaces_killed_worker():
+    """Test that a dead worker breaks the pool only until the next task."""
+    pool = InferencePool(1, 0)
+    try:
+        pid = pool.submit(os.getpid).result()
+        os.kill(pid, signal.SIGKILL)
+        deadline = time.monotonic() + 5
+        while not pool.broken and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pool.broken
+
+        assert pool.submit(os.getpid, timeout=1).result(timeout=30) != pid
+        assert not pool.broken
+    finally:
+        pool.shutdown()
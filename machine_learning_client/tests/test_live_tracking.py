@@ -0,0 +1,200 @@
+"""
+Unit tests for the live_tracking module
+"""
+
+import numpy as np
+import pytest
+from simple_websocket import ConnectionClosed
+from machine_learning_client.live_tracking import (
+    CorrelationTracker,
+    FaceTracker,
+    box_overlap,
+    newest_message,
+)
+
+FRAME = np.zeros((60, 80, 3), dtype=np.uint8)
+FACE = (10, 40, 40, 10)
+
+
+class ScriptedTracker:
+    """Tracker reporting scripted ``(confidence, box)`` updates."""
+
+    def __init__(self, updates):
+        self.updates = updates
+        self.started = []
+
+    def start(self, image, box):
+        """Record where tracking started."""
+        self.started.append((image.shape, box))
+
+    def update(self, _image):
+        """Return the next scripted update."""
+        return self.updates.pop(0)
+
+
+class FakeWebSocket:
+    """
+    WebSocket whose messages arrive in bursts.
+    A blocking receive starts the next burst; non-blocking receives return
+    the rest of the current burst and then None.
+    """
+
+    def __init__(self, bursts):
+        self.bursts = [list(burst) for burst in bursts]
+        self.current = []
+        self.sent = []
+
+    def receive(self, timeout=None):
+        """Return the next message of the current or the next burst."""
+        if timeout is None:
+            if not self.bursts:
+                raise ConnectionClosed()
+            self.current = self.bursts.pop(0)
+        return self.current.pop(0) if self.current else None
+
+    def send(self, data):
+        """Record a sent message."""
+        self.sent.append(data)
+
+
+def make_tracker(detections, updates, keyframe_interval=3):
+    """
+    Return a FaceTracker over scripted detections and tracker updates.
+    Args:
+        detections (list): Boxes returned by each detection, in order.
+        updates (list): ``(confidence, box)`` of each tracker update.
+    Returns:
+        tuple: The tracker, the list of encoded boxes and the scripted
+        tracker.
+    """
+    encoded = []
+    scripted = ScriptedTracker(updates)
+
+    def encode(_image, box):
+        encoded.append(box)
+        return np.full(128, len(encoded), dtype=np.float32)
+
+    tracker = FaceTracker(
+        lambda _image: detections.pop(0),
+        encode,
+        make_tracker=lambda: scripted,
+        keyframe_interval=keyframe_interval,
+    )
+    return tracker, encoded, scripted
+
+
+def test_box_overlap():
+    """Test intersection over union of face boxes."""
+    assert box_overlap(FACE, FACE) == 1
+    assert box_overlap(FACE, (10, 80, 40, 50)) == 0
+    assert box_overlap(FACE, (10, 55, 40, 25)) == pytest.approx(15 / 45)
+    assert box_overlap((0, 0, 0, 0), (0, 0, 0, 0)) == 0
+
+
+def test_tracks_between_keyframes_without_encoding():
+    """Test that frames between keyframes are tracked, not detected."""
+    moved = (12, 42, 42, 12)
+    tracker, encoded, scripted = make_tracker(
+        [[FACE], [moved]], [(20.0, (11, 41, 41, 11)), (20.0, moved), (20.0, moved)]
+    )
+
+    states = [tracker.process(FRAME) for _ in range(5)]
+
+    assert [state["keyframe"] for state in states] == [True, False, False, False, True]
+    assert [state["encoded"] for state in states] == [True, False, False, False, False]
+    assert encoded == [FACE]
+    assert states[1]["box"] == (11, 41, 41, 11)
+    assert "track" in states[1]["timings"] and "detect" not in states[1]["timings"]
+    assert scripted.started == [(FRAME.shape, FACE), (FRAME.shape, moved)]
+    assert tracker.encoding[0] == 1
+
+
+def test_lost_track_is_detected_and_encoded_again():
+    """Test that a low tracker confidence triggers detection and encoding."""
+    tracker, encoded, _ = make_tracker([[FACE], [FACE]], [(2.0, FACE)])
+
+    tracker.process(FRAME)
+    state = tracker.process(FRAME)
+
+    assert state["keyframe"] and state["encoded"]
+    assert encoded == [FACE, FACE]
+    assert tracker.encoding[0] == 2
+
+
+def test_drifted_track_is_encoded_again():
+    """Test that a keyframe detection away from the track re-encodes."""
+    elsewhere = (10, 80, 40, 50)
+    tracker, encoded, _ = make_tracker(
+        [[FACE], [elsewhere]], [(20.0, FACE)], keyframe_interval=1
+    )
+
+    tracker.process(FRAME)
+    tracker.process(FRAME)
+    state = tracker.process(FRAME)
+
+    assert state["encoded"] and state["box"] == elsewhere
+    assert encoded == [FACE, elsewhere]
+
+
+def test_keyframe_prefers_the_tracked_face():
+    """Test that a keyframe keeps following the tracked face."""
+    larger = (0, 80, 60, 45)
+    tracker, encoded, _ = make_tracker([[FACE], [larger, FACE]], [], 0)
+
+    first = tracker.process(FRAME)
+    second = tracker.process(FRAME)
+
+    assert first["box"] == second["box"] == FACE
+    assert encoded == [FACE]
+
+
+def test_no_face_clears_the_track():
+    """Test that a keyframe without faces drops the face and its encoding."""
+    tracker, encoded, _ = make_tracker([[FACE], [], [FACE]], [], 0)
+
+    tracker.process(FRAME)
+    empty = tracker.process(FRAME)
+    again = tracker.process(FRAME)
+
+    assert empty["box"] is None and not empty["encoded"]
+    assert again["encoded"]
+    assert len(encoded) == 2
+
+
+def test_frame_size_change_restarts_tracking():
+    """Test that frames of another size are detected afresh."""
+    tracker, encoded, _ = make_tracker([[FACE], [FACE]], [])
+
+    tracker.process(FRAME)
+    state = tracker.process(np.zeros((30, 40, 3), dtype=np.uint8))
+
+    assert state["keyframe"] and state["encoded"]
+    assert len(encoded) == 2
+
+
+def test_correlation_tracker_follows_a_moving_patch():
+    """Test the dlib tracker on a bright square moving across a frame."""
+
+    def frame(shift):
+        image = np.zeros((120, 160, 3), dtype=np.uint8)
+        image[30:70, 40 + shift : 80 + shift] = 255
+        image[45:55, 55 + shift : 65 + shift] = 0
+        return image
+
+    tracker = CorrelationTracker()
+    tracker.start(frame(0), (30, 80, 70, 40))
+    for shift in (3, 6, 9):
+        _, box = tracker.update(frame(shift))
+
+    assert box[3] == pytest.approx(49, abs=3)
+    assert box[1] - box[3] == pytest.approx(40, abs=4)
+
+
+def test_newest_message_drops_stale_frames():
+    """Test that only the newest of the buffered messages is returned."""
+    ws = FakeWebSocket([[b"1", b"2", b"3"], [b"4"]])
+
+    assert newest_message(ws) == (b"3", 2)
+    assert newest_message(ws) == (b"4", 0)
+    with pytest.raises(ConnectionClosed):
+        newest_message(ws)
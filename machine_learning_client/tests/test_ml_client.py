@@ -4,22 +4,84 @@ Unit tests for the machine_learning_client module
 
 # pylint: disable=redefined-outer-name
 
+import os
 import io
+import hmac
+import base64
+import json
+import struct
+import time
+import threading
+from types import SimpleNamespace
+from concurrent.futures import Future
 from unittest.mock import patch
+import numpy as np
 import pytest
+from PIL import Image
+from simple_websocket import ConnectionClosed
+from machine_learning_client import ml_client
 from machine_learning_client.ml_client import app, load_character_encodings
+from machine_learning_client.gallery_index import GalleryIndex
+from machine_learning_client.encoding_codec import pack_encoding, unpack_encodings
+from machine_learning_client.inference_pool import InferencePool, PoolSaturated
+from machine_learning_client.result_cache import ResultCache
+from machine_learning_client.tests.test_live_tracking import FakeWebSocket
+
+
+def image_bytes(shade, size=(40, 30), image_format="PNG"):
+    """Return an encoded grey image whose shade identifies it to mock_faces."""
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (shade, shade, shade)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def mock_faces(monkeypatch, faces):
+    """
+    Mock face detection and encoding.
+    Args:
+        faces (dict): Maps an image shade to the (box, encoding) of each face
+            in images of that shade.
+    """
+
+    def mock_face_locations(image, number_of_times_to_upsample=1, model="hog"):
+        """Mock face locations function."""
+        assert number_of_times_to_upsample >= 0 and model in ("hog", "cnn")
+        return [box for box, _ in faces.get(int(image[0, 0, 0]), [])]
+
+    def mock_face_encodings(
+        image, known_face_locations=None, num_jitters=1, model="small"
+    ):
+        """Mock face encodings function."""
+        assert num_jitters >= 1 and model in ("small", "large")
+        encodings = [encoding for _, encoding in faces.get(int(image[0, 0, 0]), [])]
+        return encodings[: len(known_face_locations)]
+
+    monkeypatch.setattr("face_recognition.face_locations", mock_face_locations)
+    monkeypatch.setattr("face_recognition.face_encodings", mock_face_encodings)
+
+
+def use_gallery(monkeypatch, encodings, names):
+    """Replace the service's gallery."""
+    monkeypatch.setattr(
+        "machine_learning_client.ml_client.GALLERY",
+        GalleryIndex(np.vstack(encodings), names),
+    )
 
 
 @pytest.fixture
-def client():
+def client(monkeypatch):
     """Create a test client for the Flask app."""
     app.config["TESTING"] = True
+    monkeypatch.setattr(ml_client, "RESULT_CACHE", ResultCache(64, 1 << 20, 60))
+    monkeypatch.setattr(ml_client, "MATCH_CACHE", ResultCache(64, 1 << 20, 60))
+    monkeypatch.setattr(ml_client, "ENCODINGS_LOADED", True)
     with app.test_client() as client:
         yield client
 
 
-def test_load_character_encodings():
+def test_load_character_encodings(monkeypatch):
     """Test loading character encodings from images."""
+    monkeypatch.setattr("machine_learning_client.ml_client.ENCODING_CACHE_PATH", "")
     with patch("os.path.exists", return_value=True), patch(
         "os.listdir"
     ) as mock_listdir, patch(
@@ -30,17 +92,95 @@ def test_load_character_encodings():
         mock_listdir.return_value = ["harry.jpg", "hermione.jpg"]
         mock_load_image.return_value = "mock_image"
         mock_encodings.side_effect = [
-            [b"mock_encoding_harry"],
-            [b"mock_encoding_hermione"],
+            [np.full(128, 0.1)],
+            [np.full(128, 0.2)],
         ]
 
         encodings, names = load_character_encodings()
 
-        assert len(encodings) == 2
+        assert encodings.shape == (2, 128)
+        assert encodings.dtype == np.float32
         assert len(names) == 2
         assert names == ["harry", "hermione"]
 
 
+def test_load_character_encodings_uses_store(tmp_path, monkeypatch):
+    """Test that unchanged images are served from the encoding store."""
+    images = tmp_path / "images"
+    images.mkdir()
+    (images / "harry.jpg").write_bytes(b"harry")
+    (images / "ron.jpg").write_bytes(b"ron")
+    monkeypatch.setattr("machine_learning_client.ml_client.IMAGES_PATH", str(images))
+    monkeypatch.setattr(
+        "machine_learning_client.ml_client.ENCODING_CACHE_PATH", str(tmp_path / "store")
+    )
+
+    encoded = []
+
+    def mock_face_encodings(image):
+        """Mock face encodings function that records encoded images."""
+        encoded.append(image)
+        return [np.full(128, len(encoded), dtype=np.float64)]
+
+    monkeypatch.setattr("face_recognition.load_image_file", lambda path: path)
+    monkeypatch.setattr("face_recognition.face_encodings", mock_face_encodings)
+
+    first, names = load_character_encodings()
+    assert names == ["harry", "ron"]
+    assert len(encoded) == 2
+
+    second, names = load_character_encodings()
+    assert len(encoded) == 2
+    assert isinstance(second, np.memmap)
+    assert np.array_equal(first, second)
+
+    (images / "ron.jpg").write_bytes(b"changed ron")
+    (images / "luna.jpg").write_bytes(b"luna")
+    third, names = load_character_encodings()
+    assert names == ["harry", "luna", "ron"]
+    assert [str(path).rsplit("/", 1)[-1] for path in encoded[2:]] == [
+        "luna.jpg",
+        "ron.jpg",
+    ]
+    assert np.array_equal(third[0], first[0])
+
+
+def test_failed_reference_encodings_are_not_stored(tmp_path, monkeypatch):
+    """Test that an image that failed to load is encoded again next time."""
+    images = tmp_path / "images"
+    images.mkdir()
+    (images / "harry.jpg").write_bytes(b"harry")
+    (images / "ron.jpg").write_bytes(b"ron")
+    monkeypatch.setattr("machine_learning_client.ml_client.IMAGES_PATH", str(images))
+    monkeypatch.setattr(
+        "machine_learning_client.ml_client.ENCODING_CACHE_PATH", str(tmp_path / "store")
+    )
+    failing = {"ron.jpg"}
+    loaded = []
+
+    def mock_load_image_file(path):
+        """Load an image, failing for those in ``failing``."""
+        loaded.append(os.path.basename(path))
+        if os.path.basename(path) in failing:
+            raise OSError("temporarily unavailable")
+        return path
+
+    monkeypatch.setattr("face_recognition.load_image_file", mock_load_image_file)
+    monkeypatch.setattr(
+        "face_recognition.face_encodings",
+        lambda path: [] if path.endswith("harry.jpg") else [np.full(128, 0.1)],
+    )
+
+    _, names = load_character_encodings()
+    assert not names
+
+    failing.clear()
+    loaded.clear()
+    _, names = load_character_encodings()
+    assert names == ["ron"]
+    assert loaded == ["ron.jpg"]
+
+
 def test_recognize_face_no_file(client):
     """Test the recognize_face endpoint with no file provided."""
     response = client.post("/recognize_face")
@@ -50,19 +190,9 @@ def test_recognize_face_no_file(client):
 
 def test_recognize_face_no_face_found(client, monkeypatch):
     """Test the recognize_face endpoint when no face is found in the image."""
+    mock_faces(monkeypatch, {})
 
-    def mock_load_image_file(_file):
-        """Mock load image file function."""
-        return "mock_image"
-
-    def mock_face_encodings(_image):
-        """Mock face encodings function."""
-        return []
-
-    monkeypatch.setattr("face_recognition.load_image_file", mock_load_image_file)
-    monkeypatch.setattr("face_recognition.face_encodings", mock_face_encodings)
-
-    data = {"file": (io.BytesIO(b"fake_image_data"), "image.jpg")}
+    data = {"file": (io.BytesIO(image_bytes(0)), "image.jpg")}
     response = client.post(
         "/recognize_face", data=data, content_type="multipart/form-data"
     )
@@ -72,65 +202,126 @@ def test_recognize_face_no_face_found(client, monkeypatch):
 
 def test_recognize_face_successful_match(client, monkeypatch):
     """Test the recognize_face endpoint with a successful face match."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.full(128, 0.1))]})
+    use_gallery(monkeypatch, [np.full(128, 0.1)], ["Harry Potter"])
 
-    def mock_load_image_file(_file):
-        """Mock load image file function."""
-        return "mock_image"
+    data = {"file": (io.BytesIO(image_bytes(1)), "image.jpg")}
+    response = client.post(
+        "/recognize_face", data=data, content_type="multipart/form-data"
+    )
+    assert response.status_code == 200
+    assert b"Harry Potter" in response.data
+    assert set(response.get_json()["timings_ms"]) == {
+        "decode",
+        "detect",
+        "encode",
+        "match",
+    }
 
-    def mock_face_encodings(_image):
-        """Mock face encodings function."""
-        return [b"mock_test_encoding"]
 
-    monkeypatch.setattr("face_recognition.load_image_file", mock_load_image_file)
-    monkeypatch.setattr("face_recognition.face_encodings", mock_face_encodings)
+def test_recognize_face_metrics(client, monkeypatch):
+    """Test that stages are timed and the request ID is echoed."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.full(128, 0.1))]})
+    use_gallery(monkeypatch, [np.full(128, 0.1)], ["Harry Potter"])
 
-    monkeypatch.setattr(
-        "machine_learning_client.ml_client.ENCODINGS", [b"mock_test_encoding"]
+    data = {"file": (io.BytesIO(image_bytes(1)), "image.jpg")}
+    response = client.post(
+        "/recognize_face",
+        data=data,
+        content_type="multipart/form-data",
+        headers={"X-Request-ID": "trace-1"},
     )
-    monkeypatch.setattr("machine_learning_client.ml_client.NAMES", ["Harry Potter"])
+    assert response.headers["X-Request-ID"] == "trace-1"
+    assert len(client.get("/cache_stats").headers["X-Request-ID"]) == 32
+
+    metrics = client.get("/metrics").data.decode()
+    for stage in ("decode", "detect", "encode", "match"):
+        assert f'ml_stage_duration_seconds_count{{stage="{stage}"}}' in metrics
+    assert "ml_gallery_size 1.0" in metrics
+    assert "ml_inference_queue_depth 0.0" in metrics
 
-    def mock_face_distance(_encodings, _test_encoding):
-        """Mock face distance function."""
-        return [0.2]
 
-    monkeypatch.setattr("face_recognition.face_distance", mock_face_distance)
+def test_recognize_face_raw_body(client, monkeypatch):
+    """Test the recognize_face endpoint with the image as the request body."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.full(128, 0.1))]})
+    use_gallery(monkeypatch, [np.full(128, 0.1)], ["Harry Potter"])
 
-    data = {"file": (io.BytesIO(b"fake_image_data"), "image.jpg")}
     response = client.post(
-        "/recognize_face", data=data, content_type="multipart/form-data"
+        "/recognize_face", data=image_bytes(1), content_type="image/png"
     )
     assert response.status_code == 200
-    assert b"Harry Potter" in response.data
+    assert response.get_json()["matched_character"] == "Harry Potter"
 
+    response = client.post("/recognize_face", data=b"", content_type="image/png")
+    assert response.status_code == 400
 
-def test_recognize_face_no_match(client, monkeypatch):
-    """Test the recognize_face endpoint when no match is found."""
 
-    def mock_load_image_file(_file):
-        """Mock load image file function."""
-        return "mock_image"
+def test_encode_then_match(client, monkeypatch):
+    """Test that encodings from /encode can be matched again with /match."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.full(128, 0.1))]})
+    use_gallery(
+        monkeypatch, [np.full(128, 0.1), np.full(128, 0.3)], ["Harry Potter", "Ron"]
+    )
 
-    def mock_face_encodings(_image):
-        """Mock face encodings function."""
-        return [b"mock_test_encoding"]
+    response = client.post("/encode", data=image_bytes(1), content_type="image/png")
+    assert response.status_code == 200
+    faces = response.get_json()["faces"]
+    assert faces[0]["box"] == {"top": 0, "right": 10, "bottom": 10, "left": 0}
+    assert np.allclose(unpack_encodings([faces[0]["encoding"]])[0], 0.1)
 
-    def mock_load_character_encodings():
-        """Mock load character encodings function."""
-        return [b"mock_different_encoding"], ["Hermione Granger"]
+    response = client.post(
+        "/match", json={"encodings": [faces[0]["encoding"]] * 2, "k": 2}
+    )
+    assert response.status_code == 200
+    results = response.get_json()["results"]
+    assert len(results) == 2
+    assert results[0]["matched_character"] == "Harry Potter"
+    assert [match["character"] for match in results[0]["matches"]] == [
+        "Harry Potter",
+        "Ron",
+    ]
+
+
+def test_match_rejects_invalid_encodings(client):
+    """Test that /match rejects malformed encodings and arguments."""
+    packed = pack_encoding(np.zeros(128))
+    for body in (
+        {"encodings": ["not base64!"]},
+        {"encodings": [pack_encoding(np.zeros(64))]},
+        {"encodings": [packed], "k": 0},
+        {"encoding": packed},
+    ):
+        assert client.post("/match", json=body).status_code == 400
+    response = client.post("/match", json={"encodings": []})
+    assert response.get_json()["results"] == []
+
+
+def test_recognize_face_include_encoding(client, monkeypatch):
+    """Test that recognize_face returns the face's encoding on request."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.full(128, 0.1))]})
+    use_gallery(monkeypatch, [np.full(128, 0.1)], ["Harry Potter"])
 
-    def mock_face_distance(_encodings, _test_encoding):
-        """Mock face distance function."""
-        return [0.9]  # Above threshold
+    response = client.post(
+        "/recognize_face?include_encoding=1",
+        data=image_bytes(1),
+        content_type="image/png",
+    )
+    packed = response.get_json()["encoding"]
+    assert np.allclose(unpack_encodings([packed])[0], 0.1)
 
-    monkeypatch.setattr("face_recognition.load_image_file", mock_load_image_file)
-    monkeypatch.setattr("face_recognition.face_encodings", mock_face_encodings)
-    monkeypatch.setattr(
-        "machine_learning_client.ml_client.load_character_encodings",
-        mock_load_character_encodings,
+    response = client.post(
+        "/recognize_face", data=image_bytes(1), content_type="image/png"
     )
-    monkeypatch.setattr("face_recognition.face_distance", mock_face_distance)
+    assert "encoding" not in response.get_json()
 
-    data = {"file": (io.BytesIO(b"fake_image_data"), "image.jpg")}
+
+def test_recognize_face_no_match(client, monkeypatch):
+    """Test the recognize_face endpoint when no match is found."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.zeros(128))]})
+    # Distance 0.9 is above the threshold
+    use_gallery(monkeypatch, [np.full(128, 0.9 / np.sqrt(128))], ["Hermione Granger"])
+
+    data = {"file": (io.BytesIO(image_bytes(1)), "image.jpg")}
     response = client.post(
         "/recognize_face", data=data, content_type="multipart/form-data"
     )
@@ -138,49 +329,657 @@ def test_recognize_face_no_match(client, monkeypatch):
     assert b"No match found" in response.data
 
 
-def test_recognize_face_invalid_image(client, monkeypatch):
+def test_recognize_face_invalid_image(client):
     """Test the recognize_face endpoint when the uploaded file is not a valid image."""
-
-    def mock_load_image_file(_file):
-        """Mock load image file function."""
-        raise ValueError("Invalid image file")
-
-    monkeypatch.setattr("face_recognition.load_image_file", mock_load_image_file)
-
     data = {"file": (io.BytesIO(b"invalid_image_data"), "image.jpg")}
     response = client.post(
         "/recognize_face", data=data, content_type="multipart/form-data"
     )
     assert response.status_code == 500
-    assert b"Invalid image file" in response.data
+    assert b"cannot identify image file" in response.data
 
 
 def test_recognize_face_multiple_faces(client, monkeypatch):
     """Test the recognize_face endpoint with an image containing multiple faces."""
+    mock_faces(
+        monkeypatch,
+        {
+            1: [
+                ((0, 10, 10, 0), np.full(128, 0.3)),
+                ((0, 30, 10, 20), np.full(128, 0.4)),
+            ]
+        },
+    )
+    use_gallery(monkeypatch, [np.full(128, 0.3)], ["Character 1"])
 
-    def mock_load_image_file(_file):
-        """Mock load image file function."""
-        return "mock_image"
+    data = {"file": (io.BytesIO(image_bytes(1)), "image.jpg")}
+    response = client.post(
+        "/recognize_face", data=data, content_type="multipart/form-data"
+    )
 
-    def mock_face_encodings(_image):
-        """Mock face encodings function."""
-        return [b"mock_face_1", b"mock_face_2"]
+    assert response.status_code == 200
+    assert b"Character 1" in response.data
+    assert "faces" not in response.get_json()
 
-    def mock_face_distance(_encodings, _test_encoding):
-        """Mock face distance function."""
-        return [0.3, 0.4]
 
-    monkeypatch.setattr("face_recognition.load_image_file", mock_load_image_file)
+def test_recognize_face_returns_top_k(client, monkeypatch):
+    """Test that the closest characters are returned in distance order."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.zeros(128))]})
+    matrix = np.zeros((3, 128))
+    matrix[:, 0] = [0.5, 0.1, 0.3]
+    use_gallery(monkeypatch, matrix, ["ron", "harry", "luna"])
+    monkeypatch.setattr("machine_learning_client.ml_client.TOP_K", 2)
+
+    data = {"file": (io.BytesIO(image_bytes(1)), "image.jpg")}
+    response = client.post(
+        "/recognize_face", data=data, content_type="multipart/form-data"
+    )
+
+    result = response.get_json()
+    assert result["matched_character"] == "harry"
+    assert [match["character"] for match in result["matches"]] == ["harry", "luna"]
+    assert result["distance"] == pytest.approx(0.1)
+
+
+def test_recognize_face_all_faces(client, monkeypatch):
+    """Test that every face in a group photo is matched with its box."""
+    mock_faces(
+        monkeypatch,
+        {
+            1: [
+                ((10, 60, 60, 10), np.full(128, 0.5)),
+                ((20, 160, 70, 110), np.full(128, 0.1)),
+            ]
+        },
+    )
+    use_gallery(monkeypatch, [np.full(128, 0.1), np.full(128, 0.5)], ["harry", "ron"])
+
+    data = {"file": (io.BytesIO(image_bytes(1, (200, 100))), "image.jpg")}
+    response = client.post(
+        "/recognize_face?all_faces=1", data=data, content_type="multipart/form-data"
+    )
+
+    result = response.get_json()
+    assert [face["matched_character"] for face in result["faces"]] == ["ron", "harry"]
+    assert result["faces"][1]["box"] == {
+        "top": 20,
+        "right": 160,
+        "bottom": 70,
+        "left": 110,
+    }
+    assert result["matched_character"] in ("ron", "harry")
+    assert "box" not in result
+
+
+def test_recognize_face_downscales_and_maps_boxes(client, monkeypatch):
+    """Test that large uploads are downscaled and boxes mapped back."""
+    sizes = []
+
+    def mock_face_locations(image, number_of_times_to_upsample=1, model="hog"):
+        """Mock face locations function that records the detected image size."""
+        sizes.append((image.shape[1], image.shape[0], number_of_times_to_upsample))
+        return [(10, 40, 40, 10)] if model == "hog" else []
+
+    monkeypatch.setattr("face_recognition.face_locations", mock_face_locations)
+    monkeypatch.setattr(
+        "face_recognition.face_encodings",
+        lambda image, known_face_locations=None, num_jitters=1, model="small": [
+            np.zeros(128)
+        ],
+    )
+    use_gallery(monkeypatch, [np.zeros(128)], ["harry"])
+
+    data = {
+        "file": (io.BytesIO(image_bytes(1, (800, 400), "JPEG")), "image.jpg"),
+        "max_side": "200",
+        "upsample": "0",
+        "all_faces": "true",
+    }
+    response = client.post(
+        "/recognize_face", data=data, content_type="multipart/form-data"
+    )
+
+    assert sizes == [(200, 100, 0)]
+    assert response.get_json()["faces"][0]["box"] == {
+        "top": 40,
+        "right": 160,
+        "bottom": 160,
+        "left": 40,
+    }
+
+
+def test_recognize_face_invalid_options(client):
+    """Test that invalid preprocessing options are rejected."""
+    data = {"file": (io.BytesIO(image_bytes(1)), "image.jpg"), "detector": "fast"}
+    response = client.post(
+        "/recognize_face", data=data, content_type="multipart/form-data"
+    )
+    assert response.status_code == 400
+    assert b"detector must be one of" in response.data
+
+
+def test_recognize_face_caps_expensive_options(client, monkeypatch):
+    """Test that requested options are lowered to the deployment's limits."""
+    calls = []
+
+    def mock_face_locations(image, number_of_times_to_upsample=1, model="hog"):
+        """Mock face locations function that records the detector settings."""
+        calls.append((max(image.shape), number_of_times_to_upsample, model))
+        return [(10, 40, 40, 10)]
+
+    def mock_face_encodings(_image, num_jitters=1, **_):
+        """Mock face encodings function that records the jitters."""
+        calls.append(num_jitters)
+        return [np.zeros(128)]
+
+    monkeypatch.setattr("face_recognition.face_locations", mock_face_locations)
     monkeypatch.setattr("face_recognition.face_encodings", mock_face_encodings)
-    monkeypatch.setattr("face_recognition.face_distance", mock_face_distance)
+    monkeypatch.setattr(
+        ml_client,
+        "REQUEST_LIMITS",
+        ml_client.OptionLimits(
+            max_side=300, detectors=("hog",), upsample=1, num_jitters=2
+        ),
+    )
+    use_gallery(monkeypatch, [np.zeros(128)], ["harry"])
+
+    def recognize(**options):
+        data = {"file": (io.BytesIO(image_bytes(1, (800, 400), "JPEG")), "a.jpg")}
+        return client.post(
+            "/recognize_face",
+            data={**data, **options},
+            content_type="multipart/form-data",
+        )
+
+    response = recognize(max_side="0", upsample="2", num_jitters="10")
+    assert response.status_code == 200
+    assert calls == [(300, 1, "hog"), 2]
 
-    monkeypatch.setattr("machine_learning_client.ml_client.ENCODINGS", [b"mock_face_1"])
-    monkeypatch.setattr("machine_learning_client.ml_client.NAMES", ["Character 1"])
+    response = recognize(detector="cnn")
+    assert response.status_code == 400
+    assert b"detector must be one of hog" in response.data
+
+
+def mock_batch_recognition(monkeypatch):
+    """Recognize "harry" (shade 10) and "ron" (shade 50) images."""
+    vectors = {"harry": np.full(128, 0.1), "ron": np.full(128, 0.5)}
+    mock_faces(
+        monkeypatch,
+        {
+            10: [((0, 10, 10, 0), vectors["harry"])],
+            50: [((0, 10, 10, 0), vectors["ron"])],
+        },
+    )
+    use_gallery(monkeypatch, [vectors["harry"], vectors["ron"]], ["harry", "ron"])
+
+
+def test_recognize_faces_multipart(client, monkeypatch):
+    """Test the batch endpoint with several multipart files."""
+    mock_batch_recognition(monkeypatch)
+    monkeypatch.setattr("machine_learning_client.ml_client.BATCH_CHUNK_SIZE", 2)
+
+    data = {
+        "files": [
+            (io.BytesIO(image_bytes(50)), "a.jpg"),
+            (io.BytesIO(image_bytes(99)), "b.jpg"),
+            (io.BytesIO(image_bytes(10)), "c.jpg"),
+        ]
+    }
+    response = client.post(
+        "/recognize_faces", data=data, content_type="multipart/form-data"
+    )
+
+    assert response.mimetype == "application/x-ndjson"
+    results = [json.loads(line) for line in response.data.splitlines()]
+    assert [result["index"] for result in results] == [0, 1, 2]
+    assert results[0]["matched_character"] == "ron"
+    assert results[1]["error"] == "No face found in the image"
+    assert results[2]["matched_character"] == "harry"
+
+
+def test_recognize_faces_packed_stream(client, monkeypatch):
+    """Test the batch endpoint with a packed binary stream."""
+    mock_batch_recognition(monkeypatch)
+    body = b"".join(
+        struct.pack(">I", len(image)) + image
+        for image in (image_bytes(10), image_bytes(50))
+    )
 
-    data = {"file": (io.BytesIO(b"image_data"), "image.jpg")}
+    response = client.post(
+        "/recognize_faces", data=body, content_type="application/octet-stream"
+    )
+
+    results = [json.loads(line) for line in response.data.splitlines()]
+    assert [result["matched_character"] for result in results] == ["harry", "ron"]
+
+
+def test_recognize_faces_truncated_stream(client, monkeypatch):
+    """Test that a truncated packed stream reports an error."""
+    mock_batch_recognition(monkeypatch)
+    body = struct.pack(">I", 10) + b"harry"
+
+    response = client.post(
+        "/recognize_faces", data=body, content_type="application/octet-stream"
+    )
+
+    results = [json.loads(line) for line in response.data.splitlines()]
+    assert results == [{"error": "Truncated image 0"}]
+
+
+def test_recognize_faces_no_files(client):
+    """Test the batch endpoint without any images."""
+    response = client.post("/recognize_faces")
+    assert response.status_code == 400
+
+
+def test_recognize_face_pool_saturated(client, monkeypatch):
+    """Test that a full inference queue is reported as 503."""
+
+    class FullPool:  # pylint: disable=too-few-public-methods
+        """Inference pool stand-in that is always full."""
+
+        pending = 0
+
+        def submit(self, *_args, **_kwargs):
+            """Reject every task."""
+            raise PoolSaturated("Recognition queue is full")
+
+    monkeypatch.setattr("machine_learning_client.ml_client.INFERENCE_POOL", FullPool())
+
+    data = {"file": (io.BytesIO(image_bytes(1)), "image.jpg")}
     response = client.post(
         "/recognize_face", data=data, content_type="multipart/form-data"
     )
 
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_recognize_faces_with_inference_pool(client, monkeypatch):
+    """Test batch recognition with encoding done by worker processes."""
+    mock_batch_recognition(monkeypatch)
+    pool = InferencePool(2, 4)
+    monkeypatch.setattr("machine_learning_client.ml_client.INFERENCE_POOL", pool)
+    try:
+        data = {
+            "files": [
+                (io.BytesIO(image_bytes(50)), "a.jpg"),
+                (io.BytesIO(image_bytes(10)), "b.jpg"),
+            ]
+        }
+        response = client.post(
+            "/recognize_faces", data=data, content_type="multipart/form-data"
+        )
+    finally:
+        pool.shutdown()
+
+    results = [json.loads(line) for line in response.data.splitlines()]
+    assert [result["matched_character"] for result in results] == ["ron", "harry"]
+
+
+def test_recognize_face_caches_repeated_uploads(client, monkeypatch):
+    """Test that a repeated upload is answered from the result cache."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.full(128, 0.1))]})
+    use_gallery(monkeypatch, [np.full(128, 0.1)], ["harry"])
+
+    def post():
+        """Upload the same image."""
+        data = {"file": (io.BytesIO(image_bytes(1)), "image.jpg")}
+        return client.post(
+            "/recognize_face", data=data, content_type="multipart/form-data"
+        ).get_json()
+
+    first, second = post(), post()
+    assert "cached" not in first
+    assert second["cached"] is True
+    assert second["matched_character"] == "harry"
+    stats = client.get("/cache_stats").get_json()["results"]
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+    use_gallery(monkeypatch, [np.full(128, 0.1)], ["ron"])
+    third = post()
+    assert "cached" not in third
+    assert third["matched_character"] == "ron"
+
+
+def test_recognize_face_match_cache(client, monkeypatch):
+    """Test that near-identical encodings share cached matches."""
+    mock_faces(
+        monkeypatch,
+        {
+            1: [((0, 10, 10, 0), np.full(128, 0.1))],
+            2: [((0, 10, 10, 0), np.full(128, 0.1001))],
+        },
+    )
+    use_gallery(monkeypatch, [np.full(128, 0.1)], ["harry"])
+    monkeypatch.setattr("machine_learning_client.ml_client.MATCH_CACHE_QUANTUM", 0.01)
+
+    for shade in (1, 2):
+        data = {"file": (io.BytesIO(image_bytes(shade)), "image.jpg")}
+        response = client.post(
+            "/recognize_face", data=data, content_type="multipart/form-data"
+        )
+        assert response.get_json()["matched_character"] == "harry"
+
+    stats = client.get("/cache_stats").get_json()["matches"]
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+class ClosableWebSocket(FakeWebSocket):
+    """FakeWebSocket recording how it was closed."""
+
+    closed = None
+
+    def close(self, reason=None, message=None):
+        """Record the close code and message."""
+        self.closed = (reason, message)
+
+
+def test_live_matches_newest_frames(monkeypatch):
+    """Test that live streams skip stale frames and encode only new faces."""
+    mock_faces(
+        monkeypatch,
+        {
+            1: [((0, 10, 10, 0), np.full(128, 0.1))],
+            2: [((0, 30, 20, 20), np.full(128, 0.3))],
+        },
+    )
+    use_gallery(
+        monkeypatch, [np.full(128, 0.1), np.full(128, 0.3)], ["Harry Potter", "Ron"]
+    )
+    monkeypatch.setattr(ml_client, "LIVE_KEYFRAME_INTERVAL", 0)
+    ws = FakeWebSocket(
+        [
+            [image_bytes(2), image_bytes(2), image_bytes(1)],
+            [image_bytes(1)],
+            [image_bytes(2)],
+            [image_bytes(0)],
+        ]
+    )
+
+    with pytest.raises(ConnectionClosed):
+        ml_client.live(ws)
+
+    first, same, other, empty = [json.loads(message) for message in ws.sent]
+    assert (first["frame"], first["dropped"]) == (3, 2)
+    assert first["matched_character"] == "Harry Potter" and first["encoded"]
+    assert first["box"] == {"top": 0, "right": 10, "bottom": 10, "left": 0}
+    assert same["matched_character"] == "Harry Potter" and not same["encoded"]
+    assert "encode" not in same["timings_ms"] and "match" not in same["timings_ms"]
+    assert other["matched_character"] == "Ron" and other["encoded"]
+    assert empty["box"] is None and "matched_character" not in empty
+    assert (empty["frame"], empty["dropped"]) == (6, 2)
+
+
+def test_live_rejects_text_frames_and_extra_streams(monkeypatch):
+    """Test live stream errors and the limit on concurrent streams."""
+    ws = FakeWebSocket([["hello"]])
+    with pytest.raises(ConnectionClosed):
+        ml_client.live(ws)
+    assert json.loads(ws.sent[0])["error"] == "Frames must be sent as binary messages"
+
+    monkeypatch.setattr(ml_client, "LIVE_SESSIONS", threading.BoundedSemaphore(1))
+    ml_client.LIVE_SESSIONS.acquire()  # pylint: disable=consider-using-with
+    ws = ClosableWebSocket([[image_bytes(1)]])
+    ml_client.live(ws)
+    assert ws.closed[0] == 1013 and not ws.sent
+
+
+def test_live_runs_recognition_in_inference_pool(monkeypatch):
+    """Test that live detection and encoding go through the inference pool."""
+    mock_faces(monkeypatch, {1: [((0, 10, 10, 0), np.full(128, 0.1))]})
+    use_gallery(monkeypatch, [np.full(128, 0.1)], ["Harry Potter"])
+    submitted = []
+
+    class InlinePool:  # pylint: disable=too-few-public-methods
+        """Inference pool stand-in running tasks on submission."""
+
+        def submit(self, fn, *args):
+            """Run the task and record its function."""
+            submitted.append(fn.__name__)
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+    monkeypatch.setattr(ml_client, "INFERENCE_POOL", InlinePool())
+    ws = FakeWebSocket([[image_bytes(1)]])
+    with pytest.raises(ConnectionClosed):
+        ml_client.live(ws)
+
+    assert json.loads(ws.sent[0])["matched_character"] == "Harry Potter"
+    assert submitted == ["detect_live_faces", "encode_live_face"]
+
+
+def live_token(secret, username, expires):
+    """Sign a /live token the way web_app does."""
+    user = base64.urlsafe_b64encode(username.encode()).decode()
+    payload = f"{user}.{expires}"
+    signature = hmac.new(secret.encode(), payload.encode(), "sha256").hexdigest()
+    return f"{payload}.{signature}"
+
+
+def test_verify_live_token(monkeypatch):
+    """Test that only unexpired tokens signed with the secret are accepted."""
+    monkeypatch.setattr(ml_client, "LIVE_TOKEN_SECRET", "secret")
+    token = live_token("secret", "harry.potter", 1000)
+
+    assert ml_client.verify_live_token(token, now=1000) == "harry.potter"
+    assert ml_client.verify_live_token(token, now=1001) is None
+    assert ml_client.verify_live_token(live_token("other", "harry", 1000), 0) is None
+    assert ml_client.verify_live_token(token.replace(".1000.", ".9999."), 0) is None
+    assert ml_client.verify_live_token("not-a-token", now=0) is None
+    assert ml_client.verify_live_token(token[:-1] + "\u00e9", now=0) is None
+
+    monkeypatch.setattr(ml_client, "LIVE_TOKEN_SECRET", "")
+    assert ml_client.verify_live_token(live_token("", "harry", 1000), 0) is None
+
+
+def test_live_handshake_requires_token_and_origin(client, monkeypatch):
+    """Test that /live is refused before upgrading without a token or origin."""
+    monkeypatch.setattr(ml_client, "LIVE_TOKEN_SECRET", "secret")
+    monkeypatch.setattr(ml_client, "LIVE_ALLOWED_ORIGINS", ["http://localhost:5001"])
+    token = live_token("secret", "harry", time.time() + 30)
+    upgrade = {"Connection": "Upgrade", "Upgrade": "websocket"}
+
+    response = client.get(
+        "/live", headers={**upgrade, "Origin": "http://localhost:5001"}
+    )
+    assert response.status_code == 403
+    assert response.get_json()["error"] == "Invalid or expired live token"
+
+    response = client.get(
+        "/live",
+        query_string={"token": token},
+        headers={**upgrade, "Origin": "http://evil"},
+    )
+    assert response.status_code == 403
+    assert response.get_json()["error"] == "Origin not allowed"
+
+
+def test_readiness_follows_startup(client, tmp_path, monkeypatch):
+    """Test that /readyz reports ready only once init_service has run."""
+    monkeypatch.setattr(ml_client, "STARTUP", {"phase": "starting"})
+    monkeypatch.setattr(ml_client, "GALLERY", ml_client.GALLERY)
+    monkeypatch.setattr(ml_client, "IMAGES_PATH", str(tmp_path))
+    monkeypatch.setattr(ml_client, "ENCODING_CACHE_PATH", "")
+    (tmp_path / "harry.jpg").write_bytes(b"unused")
+    monkeypatch.setattr(
+        ml_client, "encode_reference_images", lambda paths, _method: [np.full(128, 0.1)]
+    )
+
+    assert client.get("/healthz").status_code == 200
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.get_json() == {"status": "starting"}
+
+    ml_client.init_service()
+
+    response = client.get("/readyz")
     assert response.status_code == 200
-    assert b"Character 1" in response.data
+    ready = response.get_json()
+    assert ready["status"] == "ready" and ready["gallery_size"] == 1
+    assert {"decode", "detect", "encode", "match"} <= set(ready["warmup_ms"])
+
+
+def test_warm_up_without_sample_image(monkeypatch, tmp_path):
+    """Test that a missing warmup image does not stop startup."""
+    monkeypatch.setattr(ml_client, "WARMUP_IMAGE", str(tmp_path / "missing.jpg"))
+    assert ml_client.warm_up() is None
+
+
+def test_reload_gallery_requires_token(client, monkeypatch):
+    """Test that the admin endpoints reject requests without the token."""
+    monkeypatch.setattr("machine_learning_client.ml_client.ADMIN_TOKEN", "secret")
+    response = client.post("/admin/reload_gallery", headers={"X-Admin-Token": "wrong"})
+    assert response.status_code == 403
+
+
+def test_reload_gallery_swaps_in_new_images(client, tmp_path, monkeypatch):
+    """Test that a reload picks up new images and invalidates the caches."""
+    images = tmp_path / "images"
+    images.mkdir()
+    (images / "harry.jpg").write_bytes(b"harry")
+    monkeypatch.setattr("machine_learning_client.ml_client.IMAGES_PATH", str(images))
+    monkeypatch.setattr(
+        "machine_learning_client.ml_client.ENCODING_CACHE_PATH", str(tmp_path / "store")
+    )
+    monkeypatch.setattr("machine_learning_client.ml_client.ADMIN_TOKEN", "secret")
+    monkeypatch.setattr("face_recognition.load_image_file", lambda path: path)
+    monkeypatch.setattr(
+        "face_recognition.face_encodings", lambda path: [np.full(128, len(path))]
+    )
+    ml_client.swap_gallery(ml_client.build_gallery())
+    old_gallery = ml_client.GALLERY
+    ml_client.RESULT_CACHE.put("key", "value", 1)
+
+    (images / "luna.jpg").write_bytes(b"luna")
+    response = client.post("/admin/reload_gallery", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 202
+    for _ in range(100):
+        if not ml_client.RELOADER.reloading:
+            break
+        time.sleep(0.05)
+
+    assert old_gallery.names == ["harry"]
+    assert ml_client.GALLERY.names == ["harry", "luna"]
+    assert ml_client.RESULT_CACHE.get("key") is None
+    status = client.get("/admin/gallery", headers={"X-Admin-Token": "secret"})
+    assert status.get_json()["size"] == 2
+
+
+def test_load_character_encodings_in_parallel(tmp_path, monkeypatch):
+    """Test that a large bootstrap is split across processes in order."""
+    images = tmp_path / "images"
+    images.mkdir()
+    for index in range(12):
+        (images / f"character_{index:02d}.jpg").write_bytes(b"x" * index)
+    monkeypatch.setattr("machine_learning_client.ml_client.IMAGES_PATH", str(images))
+    monkeypatch.setattr("machine_learning_client.ml_client.ENCODING_CACHE_PATH", "")
+    monkeypatch.setattr("machine_learning_client.ml_client.BOOTSTRAP_WORKERS", 3)
+    monkeypatch.setattr("machine_learning_client.ml_client.BOOTSTRAP_PARALLEL_MIN", 4)
+
+    def mock_load_image_file(path):
+        """Load the index from the file name, failing for character 5."""
+        index = int(path[-6:-4])
+        if index == 5:
+            raise ValueError("corrupt image")
+        return index
+
+    monkeypatch.setattr("face_recognition.load_image_file", mock_load_image_file)
+    monkeypatch.setattr(
+        "face_recognition.face_encodings",
+        lambda index: [np.full(128, index / 100)] if index != 7 else [],
+    )
+
+    encodings, names = load_character_encodings(start_method="fork")
+
+    expected = [index for index in range(12) if index not in (5, 7)]
+    assert names == [f"character_{index:02d}" for index in expected]
+    assert np.allclose(encodings[:, 0], [index / 100 for index in expected])
+
+
+def test_reload_does_not_fork_encoding_processes(tmp_path, monkeypatch):
+    """Test that only the startup load forks; reloads use a forkserver."""
+    images = tmp_path / "images"
+    images.mkdir()
+    for index in range(4):
+        (images / f"character_{index}.jpg").write_bytes(b"x")
+    monkeypatch.setattr(ml_client, "IMAGES_PATH", str(images))
+    monkeypatch.setattr(ml_client, "ENCODING_CACHE_PATH", "")
+    monkeypatch.setattr(ml_client, "BOOTSTRAP_WORKERS", 2)
+    monkeypatch.setattr(ml_client, "BOOTSTRAP_PARALLEL_MIN", 2)
+    monkeypatch.setattr(ml_client, "warm_up", lambda: None)
+    monkeypatch.setattr(ml_client, "STARTUP", {"phase": "starting"})
+    monkeypatch.setattr(ml_client, "GALLERY", ml_client.GALLERY)
+    monkeypatch.setattr(ml_client, "ML_WORKERS", 0)
+    monkeypatch.setattr(ml_client, "GALLERY_WATCH_INTERVAL", 0)
+    start_methods = []
+
+    class SerialExecutor:
+        """Process pool stand-in recording its start method."""
+
+        def __init__(self, max_workers, mp_context):
+            assert max_workers == 2
+            start_methods.append(mp_context.get_start_method())
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def map(self, function, items, chunksize):
+            """Apply the function in this process."""
+            assert chunksize >= 1
+            return map(function, items)
+
+    monkeypatch.setattr(ml_client, "ProcessPoolExecutor", SerialExecutor)
+    monkeypatch.setattr(
+        ml_client, "encode_reference_image", lambda path: np.full(128, 0.1)
+    )
+
+    ml_client.init_service()
+    ml_client.RELOADER.reload_now()
+
+    assert start_methods == ["fork", "forkserver"]
+
+
+def test_reload_waits_for_inline_inference(tmp_path, monkeypatch):
+    """Test that a small reload does not run dlib next to inline inference."""
+    for index in range(2):
+        (tmp_path / f"character_{index}.jpg").write_bytes(b"x")
+    monkeypatch.setattr(ml_client, "IMAGES_PATH", str(tmp_path))
+    monkeypatch.setattr(ml_client, "ENCODING_CACHE_PATH", "")
+    monkeypatch.setattr(ml_client, "GALLERY", ml_client.GALLERY)
+    monkeypatch.setattr(ml_client, "INLINE_INFERENCE", threading.Lock())
+    encoded = []
+
+    def encode(path):
+        encoded.append(path)
+        return np.full(128, 0.1)
+
+    monkeypatch.setattr(ml_client, "encode_reference_image", encode)
+
+    with ml_client.INLINE_INFERENCE:
+        reload = threading.Thread(target=ml_client.RELOADER.reload_now)
+        reload.start()
+        reload.join(0.2)
+        assert reload.is_alive() and not encoded
+    reload.join(5)
+
+    assert len(encoded) == 2
+    assert ml_client.GALLERY.names == ["character_0", "character_1"]
+
+
+def test_readiness_fails_while_inference_pool_is_broken(client, monkeypatch):
+    """Test that /readyz reports a broken inference pool as not ready."""
+    monkeypatch.setattr(ml_client, "STARTUP", {"phase": "ready", "warmup_ms": 1})
+    pool = SimpleNamespace(size=2, pending=0, broken=True)
+    monkeypatch.setattr(ml_client, "INFERENCE_POOL", pool)
+
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.get_json() == {"status": "inference_pool_broken"}
+
+    pool.broken = False
+    assert client.get("/readyz").get_json()["inference_workers"] == 2
@@ -0,0 +1,39 @@
+"""
+Unit tests for the result_cache module
+"""
+
+from unittest.mock import patch
+from machine_learning_client.result_cache import ResultCache, content_key
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    """Test that the least recently used entries are evicted first."""
+    cache = ResultCache(max_entries=2, max_bytes=100, ttl=60)
+    cache.put("a", 1, 10)
+    cache.put("b", 2, 10)
+    assert cache.get("a") == 1
+    cache.put("c", 3, 10)
+    assert cache.get("b") is None
+    cache.put("d", 4, 85)
+    assert cache.get("a") is None
+    assert cache.get("d") == 4
+    assert cache.stats()["bytes"] == 95
+
+
+def test_entries_expire():
+    """Test that entries are dropped after their time to live."""
+    cache = ResultCache(max_entries=10, max_bytes=100, ttl=5)
+    with patch("time.monotonic", return_value=100.0):
+        cache.put("a", 1, 1)
+    with patch("time.monotonic", return_value=104.0):
+        assert cache.get("a") == 1
+    with patch("time.monotonic", return_value=106.0):
+        assert cache.get("a") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "entries": 0, "bytes": 0}
+
+
+def test_content_key_depends_on_parameters():
+    """Test that keys differ when the content or parameters differ."""
+    assert content_key(b"image", 1) == content_key(b"image", 1)
+    assert content_key(b"image", 1) != content_key(b"image", 2)
+    assert content_key(b"image") != content_key(b"other")
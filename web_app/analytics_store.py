@@ -0,0 +1,247 @@
+"""
+Materialized character distributions.
+
+Besides each user's all-time counters in ``analytics``, every capture bumps
+counters in ``analytics_buckets``: the global all-time totals and daily and
+weekly buckets for both the user and everyone. Dashboards read a handful of
+small documents instead of aggregating ``history``. Global totals are also
+kept in a short-lived in-process cache, which a capture in the same process
+invalidates. ``rebuild_buckets`` recomputes every bucket from ``history``
+and its daily rollups with an aggregation pipeline, e.g. to backfill
+existing data.
+"""
+
+import time
+import threading
+from datetime import datetime, timedelta
+
+from pymongo import DESCENDING
+
+try:
+    from .history_store import ROLLUPS
+except ImportError:
+    from history_store import ROLLUPS
+
+BUCKETS = "analytics_buckets"
+GLOBAL_SCOPE = "*"
+PERIODS = ("all", "day", "week")
+
+# "." and "$" have special meaning in field paths, so they are
+# stored as their full-width forms inside the per-character counters.
+_FIELD_ESCAPES = {".": "．", "$": "＄"}
+
+
+def character_field(name):
+    """
+    Return the ``characters`` sub-field used to count a character.
+    Args:
+        name (str): The matched character.
+    Returns:
+        str: A dotted field path safe to use with ``$inc``.
+    """
+    for char, escaped in _FIELD_ESCAPES.items():
+        name = name.replace(char, escaped)
+    return f"characters.{name}"
+
+
+def character_name(key):
+    """
+    Return the character a key of the ``characters`` counters stands for.
+    Args:
+        key (str): A key of an analytics document's ``characters``.
+    Returns:
+        str: The character name as returned by the ML service.
+    """
+    for char, escaped in _FIELD_ESCAPES.items():
+        key = key.replace(escaped, char)
+    return key
+
+
+def _escaped_character():
+    """Return an aggregation expression for the escaped matched character."""
+    expression = "$matched_character"
+    for char, escaped in _FIELD_ESCAPES.items():
+        expression = {
+            "$replaceAll": {
+                "input": expression,
+                "find": {"$literal": char},
+                "replacement": escaped,
+            }
+        }
+    return expression
+
+
+def period_start(period, timestamp):
+    """
+    Return the start of the bucket a timestamp falls in.
+    Args:
+        period (str): ``all``, ``day`` or ``week``; weeks start on Monday.
+        timestamp (datetime): A UTC timestamp.
+    Returns:
+        datetime: The naive UTC start of the bucket, or None for ``all``.
+    """
+    if period == "all":
+        return None
+    day = datetime(timestamp.year, timestamp.month, timestamp.day)
+    if period == "week":
+        day -= timedelta(days=day.weekday())
+    return day
+
+
+def bucket_id(scope, period, start):
+    """Return the ``_id`` of an ``analytics_buckets`` document."""
+    return {"scope": scope, "period": period, "start": start}
+
+
+def bucket_increments(username, character, timestamp):
+    """
+    Return the bucket counters a capture increments.
+    Args:
+        username (str): The user who made the capture.
+        character (str): The matched character.
+        timestamp (datetime): When the capture was made.
+    Returns:
+        list: ``(_id, increments)`` pairs for ``analytics_buckets``.
+    """
+    increments = {"total": 1, character_field(character): 1}
+    ids = [bucket_id(GLOBAL_SCOPE, "all", None)]
+    for period in ("day", "week"):
+        start = period_start(period, timestamp)
+        ids.append(bucket_id(username, period, start))
+        ids.append(bucket_id(GLOBAL_SCOPE, period, start))
+    return [(_id, increments) for _id in ids]
+
+
+def distribution(document):
+    """
+    Turn a counters document into character percentages.
+    Args:
+        document (dict): A document with ``total`` and ``characters``, or None.
+    Returns:
+        list: ``{"character", "percentage"}`` entries; empty without data.
+    """
+    if not document or "characters" not in document or not document.get("total"):
+        return []
+    return [
+        {
+            "character": character_name(character),
+            "percentage": (count / document["total"]) * 100,
+        }
+        for character, count in document["characters"].items()
+    ]
+
+
+def bucket_series(db, scope, period, limit):
+    """
+    Return the most recent buckets of a scope, newest first.
+    Args:
+        db (pymongo.database.Database): The application database.
+        scope (str): A username, or GLOBAL_SCOPE for everyone.
+        period (str): ``day`` or ``week``.
+        limit (int): Maximum number of buckets.
+    Returns:
+        list: ``{"start", "total", "data"}`` entries.
+    """
+    documents = (
+        db[BUCKETS]
+        .find({"_id.scope": scope, "_id.period": period})
+        .sort("_id.start", DESCENDING)
+        .limit(limit)
+    )
+    return [
+        {
+            "start": document["_id"]["start"].date().isoformat(),
+            "total": document.get("total", 0),
+            "data": distribution(document),
+        }
+        for document in documents
+    ]
+
+
+def rebuild_buckets(db):
+    """
+    Recompute ``analytics_buckets`` from ``history`` and its rollups.
+    Scans the whole history, so it is meant for backfills and repairs, not
+    for serving requests. A rollup counts as its ``count`` captures at the
+    start of its day.
+    Args:
+        db (pymongo.database.Database): The application database.
+    """
+    db[BUCKETS].delete_many({})
+    # Buckets are stored per character first and then folded into one
+    # document each, since $merge cannot add to a nested counter.
+    for scope, period, unit in [
+        (GLOBAL_SCOPE, "all", None),
+        ("$username", "day", "day"),
+        ("$username", "week", "week"),
+        (GLOBAL_SCOPE, "day", "day"),
+        (GLOBAL_SCOPE, "week", "week"),
+    ]:
+        start = None
+        if unit:
+            start = {"$dateTrunc": {"date": "$timestamp", "unit": unit}}
+            if unit == "week":
+                start["$dateTrunc"]["startOfWeek"] = "monday"
+        db.history.aggregate(
+            [
+                {"$unionWith": ROLLUPS},
+                {"$match": {"timestamp": {"$type": "date"}}},
+                {
+                    "$group": {
+                        "_id": {
+                            "scope": scope,
+                            "period": period,
+                            "start": start,
+                            "character": _escaped_character(),
+                        },
+                        "count": {"$sum": {"$ifNull": ["$count", 1]}},
+                    }
+                },
+                {
+                    "$group": {
+                        "_id": {
+                            "scope": "$_id.scope",
+                            "period": "$_id.period",
+                            "start": "$_id.start",
+                        },
+                        "total": {"$sum": "$count"},
+                        "characters": {"$push": {"k": "$_id.character", "v": "$count"}},
+                    }
+                },
+                {"$set": {"characters": {"$arrayToObject": "$characters"}}},
+                {"$merge": {"into": BUCKETS, "whenMatched": "replace"}},
+            ]
+        )
+
+
+class GlobalDistributionCache:
+    """
+    Cache the global all-time distribution for a short time.
+    Args:
+        db (pymongo.database.Database): The application database.
+        ttl (float): Seconds a cached distribution is served.
+    """
+
+    def __init__(self, db, ttl):
+        self.db = db
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cached = None
+
+    def get(self):
+        """Return the global distribution, reading it if the cache is stale."""
+        with self._lock:
+            if self._cached is not None and self._cached[0] > time.monotonic():
+                return self._cached[1]
+        document = self.db[BUCKETS].find_one(
+            {"_id": bucket_id(GLOBAL_SCOPE, "all", None)}
+        )
+        data = distribution(document)
+        with self._lock:
+            self._cached = (time.monotonic() + self.ttl, data)
+        return data
+
+    def invalidate(self):
+        """Drop the cached distribution after a capture."""
+        with self._lock:
+            self._cached = None
@@ -0,0 +1,121 @@
+"""
+Password hashing for login and registration.
+
+bcrypt is deliberately slow, so hashing runs on a small dedicated thread
+pool: a burst of logins can then keep at most that many cores busy instead
+of every request thread, and other routes stay responsive. The work factor
+is configurable; hashes made with a different one are upgraded the next
+time their user logs in.
+
+Live mode's WebSocket is served by the ML service, which cannot see the
+login session; live_token signs short-lived tokens it checks instead.
+"""
+
+import hmac
+import time
+import base64
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from pymongo.errors import PyMongoError
+
+
+def hash_rounds(hashed):
+    """
+    Return the work factor a bcrypt hash was made with.
+    Args:
+        hashed (bytes): A hash such as ``b"$2b$12$..."``.
+    Returns:
+        int: The log2 of the number of rounds, or None if it is unreadable.
+    """
+    try:
+        return int(hashed.split(b"$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def live_token(secret, username, ttl, now=None):
+    """
+    Sign a token admitting a user to the ML service's /live stream.
+    Args:
+        secret (str): The secret shared with the ML service.
+        username (str): The logged-in user.
+        ttl (float): Seconds until the token expires.
+        now (float, optional): The current Unix time.
+    Returns:
+        str: ``<user>.<expires>.<signature>``, the base64url username, the
+        Unix time the token expires at and the hex HMAC-SHA256 of both.
+    """
+    user = base64.urlsafe_b64encode(username.encode()).decode()
+    expires = int((time.time() if now is None else now) + ttl)
+    payload = f"{user}.{expires}"
+    signature = hmac.new(secret.encode(), payload.encode(), "sha256").hexdigest()
+    return f"{payload}.{signature}"
+
+
+class PasswordHasher:
+    """
+    Hash and check passwords on a bounded thread pool.
+    Args:
+        rounds (int): bcrypt work factor for new hashes (4 to 31).
+        workers (int): Maximum number of passwords hashed at once.
+    """
+
+    def __init__(self, rounds, workers):
+        self.rounds = rounds
+        self._pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt"
+        )
+
+    def _hash(self, password):
+        return bcrypt.hashpw(password, bcrypt.gensalt(self.rounds))
+
+    def hash(self, password):
+        """
+        Hash a password with the configured work factor.
+        Args:
+            password (bytes): The UTF-8 encoded password.
+        Returns:
+            bytes: The bcrypt hash.
+        """
+        return self._pool.submit(self._hash, password).result()
+
+    def check(self, password, hashed):
+        """
+        Check a password against a stored hash.
+        Args:
+            password (bytes): The UTF-8 encoded password.
+            hashed (bytes): The stored bcrypt hash.
+        Returns:
+            bool: True if the password matches.
+        """
+        return self._pool.submit(bcrypt.checkpw, password, hashed).result()
+
+    def needs_rehash(self, hashed):
+        """Return True if a hash was made with a different work factor."""
+        return hash_rounds(hashed) != self.rounds
+
+    def rehash_later(self, users, username, password, hashed):
+        """
+        Replace a user's hash with one made with the configured work factor.
+        The new hash is computed and stored in the background so the login
+        that triggered it does not wait; it is only stored if the password
+        has not changed in the meantime.
+        Args:
+            users (pymongo.collection.Collection): The users collection.
+            username (str): The user who just logged in.
+            password (bytes): The password they logged in with.
+            hashed (bytes): Their current hash.
+        """
+
+        def rehash():
+            try:
+                users.update_one(
+                    {"username": username, "password": hashed},
+                    {"$set": {"password": self._hash(password)}},
+                )
+            except PyMongoError as e:
+                logging.error("Failed to rehash password of %s: %s", username, e)
+
+        self._pool.submit(rehash)
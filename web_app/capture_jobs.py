@@ -0,0 +1,251 @@
+"""
+Durable queue of capture jobs in MongoDB.
+
+In job mode /capture stores the uploaded image as a job and answers at once;
+consumer threads, in the web workers or in separate ``flask capture-worker``
+processes, claim jobs, run recognition and record the result, which clients
+fetch by job ID or follow as server-sent events.
+
+A job is claimed by atomically setting it to ``running`` and pushing its
+``available_at`` out by the lease. A consumer that dies leaves the lease to
+expire, after which another consumer claims the job again. Finished jobs
+drop their image and are deleted by a TTL index after a while.
+"""
+
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import PyMongoError
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+FINISHED = (DONE, FAILED)
+JOB_PROJECTION = {"image": 0}
+
+
+def utcnow():
+    """Return the current time as an aware UTC datetime."""
+    return datetime.now(timezone.utc)
+
+
+class CaptureJobQueue:
+    """
+    Capture jobs kept in a MongoDB collection.
+    Args:
+        collection (pymongo.collection.Collection): The jobs collection.
+        lease (float): Seconds a claimed job is reserved for its consumer.
+        max_attempts (int): Claims before a job that keeps being retried
+            fails.
+        ttl (float): Seconds finished jobs are kept.
+    """
+
+    def __init__(self, collection, lease, max_attempts, ttl):
+        self.collection = collection
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.ttl = ttl
+        self.wake = threading.Event()
+
+    def ensure_indexes(self):
+        """Create the claim index and the TTL index of finished jobs."""
+        self.collection.create_index(
+            [("status", ASCENDING), ("available_at", ASCENDING)]
+        )
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    def enqueue(self, username, image, content_type, timestamp, trace_id=None):
+        """
+        Add a capture to the queue.
+        Args:
+            username (str): The user who made the capture.
+            image (bytes): The uploaded image.
+            content_type (str): Its MIME type.
+            timestamp (datetime): When the capture was made.
+            trace_id (str): Request ID to pass on to the ML service.
+        Returns:
+            str: The job ID.
+        """
+        now = utcnow()
+        result = self.collection.insert_one(
+            {
+                "username": username,
+                "status": QUEUED,
+                "image": image,
+                "content_type": content_type,
+                "timestamp": timestamp,
+                "request_id": trace_id,
+                "attempts": 0,
+                "created": now,
+                "available_at": now,
+            }
+        )
+        self.wake.set()
+        return str(result.inserted_id)
+
+    def claim(self):
+        """
+        Claim the job that has been available longest.
+        Returns:
+            dict: The claimed job, with a ``claim`` token, or None.
+        """
+        now = utcnow()
+        return self.collection.find_one_and_update(
+            {"status": {"$in": [QUEUED, RUNNING]}, "available_at": {"$lte": now}},
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "available_at": now + timedelta(seconds=self.lease),
+                    "claim": ObjectId(),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("available_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def finish(self, job, status_code, body):
+        """
+        Store the outcome of a claimed job and drop its image.
+        Nothing is stored if the job's lease expired and another consumer
+        claimed it meanwhile.
+        Args:
+            job (dict): The job as returned by claim.
+            status_code (int): HTTP status of the outcome; 200 means done.
+            body (dict): The JSON body a synchronous capture would return.
+        """
+        now = utcnow()
+        self.collection.update_one(
+            {"_id": job["_id"], "claim": job["claim"]},
+            {
+                "$set": {
+                    "status": DONE if status_code == 200 else FAILED,
+                    "status_code": status_code,
+                    "result": body,
+                    "finished": now,
+                    "expires_at": now + timedelta(seconds=self.ttl),
+                },
+                "$unset": {"image": "", "available_at": ""},
+            },
+        )
+
+    def retry(self, job, delay, body):
+        """
+        Put a claimed job back in the queue, or fail it after max_attempts.
+        Args:
+            job (dict): The job as returned by claim.
+            delay (float): Seconds before the job may be claimed again.
+            body (dict): The outcome recorded if the job fails for good.
+        """
+        if job["attempts"] >= self.max_attempts:
+            self.finish(job, 503, body)
+            return
+        self.collection.update_one(
+            {"_id": job["_id"], "claim": job["claim"]},
+            {
+                "$set": {
+                    "status": QUEUED,
+                    "available_at": utcnow() + timedelta(seconds=delay),
+                }
+            },
+        )
+
+    def get(self, job_id, username):
+        """
+        Look up a job of a user.
+        Args:
+            job_id (str): The job ID.
+            username (str): The user the job must belong to.
+        Returns:
+            dict: The job without its image, or None if there is none.
+        """
+        try:
+            _id = ObjectId(job_id)
+        except (InvalidId, TypeError):
+            return None
+        return self.collection.find_one(
+            {"_id": _id, "username": username}, JOB_PROJECTION
+        )
+
+
+def job_status(job):
+    """
+    Describe a job for the client.
+    Args:
+        job (dict): A job document.
+    Returns:
+        dict: The job's ``status`` and, once it finished, the fields of the
+        response a synchronous capture would have returned.
+    """
+    if job["status"] in FINISHED:
+        return {**job.get("result", {}), "status": job["status"]}
+    return {"status": job["status"]}
+
+
+class CaptureWorkers:
+    """
+    Threads consuming capture jobs.
+    Args:
+        queue (CaptureJobQueue): The queue to consume.
+        process: Callable taking a job and returning ``(status_code, body,
+            retry_after)``; a ``retry_after`` puts the job back in the queue
+            for that many seconds.
+        workers (int): Number of consumer threads.
+        poll_interval (float): Seconds an idle consumer waits before
+            looking for jobs again, unless a job is enqueued in this process.
+    """
+
+    def __init__(self, queue, process, workers, poll_interval):
+        self.queue = queue
+        self.process = process
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._threads = []
+
+    def start(self):
+        """Start the consumer threads, unless they are already running."""
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(
+                target=self.run,
+                name=f"capture-worker-{len(self._threads)}",
+                daemon=True,
+            )
+            self._threads.append(thread)
+            thread.start()
+
+    def run_once(self):
+        """
+        Claim and process one job.
+        Returns:
+            bool: Whether a job was processed.
+        """
+        job = self.queue.claim()
+        if job is None:
+            return False
+        if job["attempts"] > self.queue.max_attempts:
+            # Its consumers kept dying before finishing it.
+            self.queue.finish(job, 500, {"error": "Capture could not be processed"})
+            return True
+        try:
+            status_code, body, retry_after = self.process(job)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.exception("Capture job %s failed", job["_id"])
+            status_code, body, retry_after = 500, {"error": str(e)}, None
+        if retry_after is not None:
+            self.queue.retry(job, float(retry_after), body)
+        else:
+            self.queue.finish(job, status_code, body)
+        return True
+
+    def run(self):
+        """Process jobs until the process exits."""
+        while True:
+            try:
+                if self.run_once():
+                    continue
+            except PyMongoError as e:
+                logging.error("Failed to process capture jobs: %s", e)
+            self.queue.wake.wait(self.poll_interval)
+            self.queue.wake.clear()
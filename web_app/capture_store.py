@@ -0,0 +1,283 @@
+"""
+Recording of capture results in MongoDB.
+
+Every capture increments counters with server-side ``$inc`` upserts, the
+user's all-time counters in ``analytics`` and the global and time-bucketed
+counters in ``analytics_buckets``, and appends a ``history`` document, so
+concurrent captures never lose counts and no document has to be read first.
+Under high capture rates the writes can instead be buffered and flushed in
+batches with ``bulk_write``, trading a short delay before they show up for
+far fewer round trips.
+
+A buffered batch is written counters first, then history. When a write
+fails, whatever was not written goes back into the buffer and is retried
+by the next flush, so a MongoDB outage delays captures instead of losing
+them, up to a bound on the captures held in memory.
+"""
+
+import atexit
+import logging
+import threading
+from collections import defaultdict
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+DUPLICATE_KEY = 11000
+
+try:
+    from .analytics_store import BUCKETS, bucket_increments, character_field
+except ImportError:
+    from analytics_store import BUCKETS, bucket_increments, character_field
+
+
+def history_document(username, character, timestamp, encoding=None):
+    """
+    Build the history document recorded for a capture.
+    The face encoding, when known, is kept as the raw float32 bytes so the
+    capture can be matched again without its image.
+    """
+    document = {
+        "username": username,
+        "matched_character": character,
+        "timestamp": timestamp,
+    }
+    if encoding is not None:
+        document["encoding"] = encoding
+    return document
+
+
+def counter_increments(username, character, timestamp):
+    """
+    Return every counter a capture increments.
+    Args:
+        username (str): The user who made the capture.
+        character (str): The matched character.
+        timestamp (datetime): When the capture was made.
+    Returns:
+        list: ``(collection, filter, increments)`` triples.
+    """
+    return [
+        (
+            "analytics",
+            {"username": username},
+            {"total": 1, character_field(character): 1},
+        )
+    ] + [
+        (BUCKETS, {"_id": _id}, increments)
+        for _id, increments in bucket_increments(username, character, timestamp)
+    ]
+
+
+def write_counters(db, counters):
+    """
+    Apply counter increments with one unordered bulk write per collection.
+    Args:
+        db (pymongo.database.Database): The application database.
+        counters (list): ``(collection, filter, increments)`` triples.
+    """
+    operations = defaultdict(list)
+    for collection, query, increments in counters:
+        operations[collection].append(
+            UpdateOne(query, {"$inc": dict(increments)}, upsert=True)
+        )
+    for collection, requests in operations.items():
+        db[collection].bulk_write(requests, ordered=False)
+
+
+class CaptureRecorder:
+    """
+    Write each capture to MongoDB as it happens.
+    Args:
+        db (pymongo.database.Database): The application database.
+    """
+
+    pending = 0
+
+    def __init__(self, db):
+        self.db = db
+
+    def record(self, username, character, timestamp, encoding=None):
+        """
+        Count a capture in the analytics and add it to the user's history.
+        Args:
+            username (str): The user who made the capture.
+            character (str): The matched character.
+            timestamp (datetime): When the capture was made.
+            encoding (bytes): The captured face's encoding, if known.
+        """
+        write_counters(self.db, counter_increments(username, character, timestamp))
+        self.db.history.insert_one(
+            history_document(username, character, timestamp, encoding)
+        )
+
+    def flush(self):
+        """Nothing is buffered; present for interface parity."""
+
+
+class WriteBehindRecorder:  # pylint: disable=too-many-instance-attributes
+    """
+    Buffer captures and write them to MongoDB in batches.
+    Increments of the same counter document are merged before they are sent,
+    so a flush costs one ``bulk_write`` per counter collection and one
+    ``insert_many`` for history however many captures it covers.
+    Args:
+        db (pymongo.database.Database): The application database.
+        max_batch (int): Buffered captures that trigger an immediate flush.
+        interval (float): Seconds between background flushes.
+        max_pending (int): Captures kept for retrying while MongoDB is
+            failing; a failed batch that would exceed it is dropped.
+    """
+
+    def __init__(self, db, max_batch, interval, max_pending):
+        self.db = db
+        self.max_batch = max_batch
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._buffer = self._empty_buffer()
+        self._wake = threading.Event()
+        self._thread = None
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _empty_buffer():
+        """Return empty merged counter increments and history documents."""
+        return {}, []
+
+    @property
+    def pending(self):
+        """Number of buffered captures."""
+        with self._lock:
+            return len(self._buffer[1])
+
+    def record(self, username, character, timestamp, encoding=None):
+        """
+        Buffer a capture; it is written by the next flush.
+        Args:
+            username (str): The user who made the capture.
+            character (str): The matched character.
+            timestamp (datetime): When the capture was made.
+            encoding (bytes): The captured face's encoding, if known.
+        """
+        with self._lock:
+            counters, documents = self._buffer
+            for collection, query, increments in counter_increments(
+                username, character, timestamp
+            ):
+                key = (collection, repr(query))
+                if key not in counters:
+                    counters[key] = (collection, query, defaultdict(int))
+                for field, amount in increments.items():
+                    counters[key][2][field] += amount
+            documents.append(history_document(username, character, timestamp, encoding))
+            full = len(documents) >= self.max_batch
+            if self._thread is None:
+                # Started lazily so it runs in the process serving requests,
+                # not in a parent that forks workers afterwards.
+                self._thread = threading.Thread(
+                    target=self._run, name="capture-writer", daemon=True
+                )
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """
+        Write every buffered capture.
+        Returns:
+            int: The number of captures written.
+        Raises:
+            pymongo.errors.PyMongoError: If a write failed; the captures it
+                did not write are back in the buffer.
+        """
+        with self._lock:
+            (counters, documents), self._buffer = self._buffer, self._empty_buffer()
+        if not documents:
+            return 0
+        count = len(documents)
+        try:
+            self._write_counters(counters)
+            self._write_history(documents)
+        except PyMongoError:
+            self._requeue(counters, documents)
+            raise
+        return count
+
+    def _write_counters(self, counters):
+        """
+        Write merged counter increments, removing those written.
+        A write that failed without saying which increments were applied,
+        such as a dropped connection, is retried whole, so its increments
+        may be counted twice.
+        """
+        by_collection = defaultdict(list)
+        for key, (collection, _, _) in counters.items():
+            by_collection[collection].append(key)
+        for collection, keys in by_collection.items():
+            requests = [
+                UpdateOne(
+                    counters[key][1], {"$inc": dict(counters[key][2])}, upsert=True
+                )
+                for key in keys
+            ]
+            try:
+                self.db[collection].bulk_write(requests, ordered=False)
+            except BulkWriteError as e:
+                failed = {error["index"] for error in e.details["writeErrors"]}
+                for index, key in enumerate(keys):
+                    if index not in failed:
+                        del counters[key]
+                raise
+            for key in keys:
+                del counters[key]
+
+    def _write_history(self, documents):
+        """
+        Insert history documents, removing those written.
+        insert_many gives every document its ``_id`` before sending it, so
+        when a retry finds one already inserted it counts as written.
+        """
+        try:
+            self.db.history.insert_many(list(documents), ordered=False)
+        except BulkWriteError as e:
+            failed = {
+                error["index"]
+                for error in e.details["writeErrors"]
+                if error["code"] != DUPLICATE_KEY
+            }
+            documents[:] = [
+                document for index, document in enumerate(documents) if index in failed
+            ]
+            if documents:
+                raise
+            return
+        documents.clear()
+
+    def _requeue(self, counters, documents):
+        """Put the unwritten part of a failed batch back into the buffer."""
+        with self._lock:
+            buffered_counters, buffered_documents = self._buffer
+            if len(buffered_documents) + len(documents) > self.max_pending:
+                logging.error(
+                    "Dropping %d unwritten captures: %d are buffered already",
+                    len(documents),
+                    len(buffered_documents),
+                )
+                return
+            for key, (collection, query, increments) in counters.items():
+                if key not in buffered_counters:
+                    buffered_counters[key] = (collection, query, defaultdict(int))
+                for field, amount in increments.items():
+                    buffered_counters[key][2][field] += amount
+            buffered_documents[:0] = documents
+
+    def _run(self):
+        """Flush every interval, or sooner when the buffer fills up."""
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except PyMongoError as e:
+                logging.error("Failed to write buffered captures: %s", e)
@@ -0,0 +1,55 @@
+"""
+Gunicorn settings for serving the web app in production.
+
+Run with ``gunicorn -c gunicorn.conf.py web_app:app``. Requests spend nearly
+all their time waiting on ml-client and MongoDB, so each worker process
+serves many of them concurrently on threads (``gthread``); set
+``WEB_WORKER_CLASS=gevent`` to use greenlets instead where gevent is
+installed.
+"""
+
+import os
+import shutil
+import multiprocessing
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+workers = int(os.getenv("WEB_WORKERS", str(multiprocessing.cpu_count() * 2 + 1)))
+worker_class = os.getenv("WEB_WORKER_CLASS", "gthread")
+threads = int(os.getenv("WEB_THREADS", "32"))
+worker_connections = int(os.getenv("WEB_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.getenv("WEB_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("WEB_KEEPALIVE", "5"))
+accesslog = "-"
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Start with an empty multiprocess metrics directory, if one is used."""
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drop the live gauges of a worker that exited."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # pylint: disable-next=import-outside-toplevel
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):  # pylint: disable=unused-argument
+    """
+    Create the MongoDB indexes and the image catalog and start the capture
+    job consumers and the history rollups once the worker has loaded the app.
+    """
+    # Imported here: the app is loaded per worker, so it opens its MongoDB
+    # connections after the fork rather than sharing the master's.
+    import web_app  # pylint: disable=import-outside-toplevel
+
+    web_app.ensure_indexes()  # pylint: disable=no-member
+    web_app.image_catalog.refresh()  # pylint: disable=no-member
+    web_app.start_capture_workers()  # pylint: disable=no-member
+    web_app.history_retention.start()  # pylint: disable=no-member
@@ -0,0 +1,255 @@
+"""
+Retention and rollup of the capture history.
+
+``history`` holds one document per capture, with its face encoding, which
+/history pages through and /history/rescore matches again. Raw captures are
+only kept for a retention period: a background job compacts every whole UTC
+day that has fallen out of it into ``history_rollups``, one document per
+user, day and character holding the number of captures, and then deletes
+the captures. Rollups are shaped like history documents plus a ``count``,
+so the same queries, sort order and paging cursors work on both.
+
+Captures can still arrive for a day that was already rolled up, from a
+queued capture job or a delayed write-behind flush, so the job adds their
+counts to the existing rollups. It first tags the captures it takes with a
+run id, and a rollup records the runs added to it: a run interrupted before
+deleting its captures is merged again on the next run without counting
+twice, and captures arriving meanwhile wait for the next run. The analytics
+counters are kept separately and are not affected.
+
+Every web worker starts the background job, but each interval only the
+process that takes the lease in ``leases`` runs it.
+"""
+
+import time
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+ROLLUPS = "history_rollups"
+LEASES = "leases"
+ROLLUP_LEASE = "history-rollup"
+ROLLUP_KEY = ["username", "timestamp", "matched_character"]
+HISTORY_SORT = [("timestamp", DESCENDING), ("_id", DESCENDING)]
+
+
+def retention_cutoff(now, days):
+    """
+    Return the start of the oldest day whose raw captures are kept.
+    Args:
+        now (datetime): The current time, as an aware datetime.
+        days (int): The retention period in days.
+    Returns:
+        datetime: A naive UTC midnight; earlier captures are rolled up.
+    """
+    oldest = (now - timedelta(days=days)).astimezone(timezone.utc)
+    return datetime(oldest.year, oldest.month, oldest.day)
+
+
+def merge_rollup_run(db, run):
+    """
+    Add the captures tagged with a rollup run to the daily counts.
+    Rollups that already list the run are left alone, so merging a run
+    again does not count its captures twice.
+    Args:
+        db (pymongo.database.Database): The application database.
+        run (ObjectId): The run the captures were tagged with.
+    """
+    runs = {"$ifNull": ["$runs", []]}
+    db.history.aggregate(
+        [
+            {"$match": {"rollup_run": run}},
+            {
+                "$group": {
+                    "_id": {
+                        "username": "$username",
+                        "timestamp": {
+                            "$dateTrunc": {"date": "$timestamp", "unit": "day"}
+                        },
+                        "matched_character": "$matched_character",
+                    },
+                    "count": {"$sum": 1},
+                }
+            },
+            # Without an _id, rollups that are inserted get a new ObjectId,
+            # which the paging cursors of /history rely on.
+            {
+                "$replaceWith": {
+                    "$mergeObjects": ["$_id", {"count": "$count", "runs": [run]}]
+                }
+            },
+            {
+                "$merge": {
+                    "into": ROLLUPS,
+                    "on": ROLLUP_KEY,
+                    "whenMatched": [
+                        {
+                            "$set": {
+                                "count": {
+                                    "$cond": [
+                                        {"$in": [run, runs]},
+                                        "$count",
+                                        {"$add": ["$count", "$$new.count"]},
+                                    ]
+                                },
+                                "runs": {"$setUnion": [runs, [run]]},
+                            }
+                        }
+                    ],
+                    "whenNotMatched": "insert",
+                }
+            },
+        ],
+        allowDiskUse=True,
+    )
+
+
+def rollup_expired(db, cutoff):
+    """
+    Compact the captures recorded before a cutoff into daily counts.
+    Captures left tagged by an interrupted run are merged as well.
+    Args:
+        db (pymongo.database.Database): The application database.
+        cutoff (datetime): A UTC midnight, so whole days are rolled up.
+    Returns:
+        int: The number of captures deleted.
+    """
+    expired = {"timestamp": {"$lt": cutoff}}
+    db.history.update_many(
+        {**expired, "rollup_run": {"$exists": False}},
+        {"$set": {"rollup_run": ObjectId()}},
+    )
+    deleted = 0
+    for run in db.history.distinct("rollup_run", expired):
+        merge_rollup_run(db, run)
+        deleted += db.history.delete_many({"rollup_run": run}).deleted_count
+    return deleted
+
+
+def history_page(db, query, projection, limit):
+    """
+    Return a page of a user's history, newest first.
+    Rollups are older than every raw capture, so a page only continues into
+    them once the raw captures matching the query are exhausted.
+    Args:
+        db (pymongo.database.Database): The application database.
+        query (dict): The user and paging cursor conditions.
+        projection (dict): The fields of raw captures to return.
+        limit (int): The page size.
+    Returns:
+        list: History documents; those from rollups carry a ``count``.
+    """
+    records = list(db.history.find(query, projection).sort(HISTORY_SORT).limit(limit))
+    if len(records) < limit:
+        records += list(
+            db[ROLLUPS]
+            .find(query, {**projection, "count": 1})
+            .sort(HISTORY_SORT)
+            .limit(limit - len(records))
+        )
+    return records
+
+
+def iter_history(db, username, projection, batch_size):
+    """
+    Yield a user's whole history, newest first: raw captures, then rollups.
+    Args:
+        db (pymongo.database.Database): The application database.
+        username (str): The user.
+        projection (dict): The fields of raw captures to return.
+        batch_size (int): Documents fetched per round trip.
+    """
+    for collection, fields in (
+        (db.history, projection),
+        (db[ROLLUPS], {**projection, "count": 1}),
+    ):
+        yield from (
+            collection.find({"username": username}, fields)
+            .sort(HISTORY_SORT)
+            .batch_size(batch_size)
+        )
+
+
+class HistoryRetention:
+    """
+    Roll up the captures older than the retention period in the background.
+    Args:
+        db (pymongo.database.Database): The application database.
+        days (int): Days raw captures are kept; 0 keeps them forever.
+        interval (float): Seconds between rollups.
+    """
+
+    def __init__(self, db, days, interval):
+        self.db = db
+        self.days = days
+        self.interval = interval
+        self._thread = None
+
+    def ensure_indexes(self):
+        """Create the indexes of the rollup job and of paging rollups."""
+        self.db.history.create_index("timestamp")
+        self.db[ROLLUPS].create_index(
+            [(field, ASCENDING) for field in ROLLUP_KEY], unique=True
+        )
+        self.db[ROLLUPS].create_index(
+            [("username", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)]
+        )
+
+    def run_once(self, now=None):
+        """
+        Roll up the captures that fell out of the retention period.
+        Args:
+            now (datetime): The current time; defaults to now.
+        Returns:
+            int: The number of captures rolled up and deleted.
+        """
+        if self.days <= 0:
+            return 0
+        cutoff = retention_cutoff(now or datetime.now(timezone.utc), self.days)
+        deleted = rollup_expired(self.db, cutoff)
+        if deleted:
+            logging.info(
+                "Rolled up %d captures recorded before %s", deleted, cutoff.date()
+            )
+        return deleted
+
+    def take_lease(self, now=None):
+        """
+        Claim this interval's rollup for this process.
+        Args:
+            now (datetime): The current time; defaults to now.
+        Returns:
+            bool: Whether no other process took the lease this interval.
+        """
+        now = now or datetime.now(timezone.utc)
+        try:
+            self.db[LEASES].update_one(
+                {"_id": ROLLUP_LEASE, "expires_at": {"$lte": now}},
+                {"$set": {"expires_at": now + timedelta(seconds=self.interval)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def start(self):
+        """Start the background rollups, if retention is enabled."""
+        if self.days > 0 and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="history-rollup", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        """Roll up every interval until the process exits."""
+        while True:
+            try:
+                if self.take_lease():
+                    self.run_once()
+            except PyMongoError as e:
+                logging.error("Failed to roll up history: %s", e)
+            time.sleep(self.interval)
@@ -0,0 +1,173 @@
+"""
+Catalog of the character images served at /images.
+
+The images directory is scanned into an in-memory index, refreshed at most
+every ``ttl`` seconds, so serving an image needs no filesystem lookup. For
+every image a full-size WebP and JPEG and WebP thumbnails are generated
+once, into a separate directory keyed by content hash (the images directory
+is also the ML service's gallery, so nothing may be added to it). Every
+file gets a strong ETag from the hash of its bytes and a version from the
+hash of its source image, which clients can put in the URL to cache it for
+good.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+
+from PIL import Image, ImageOps
+
+IMAGE_EXTENSIONS = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+# Generated variants by filename suffix: (thumbnail, Pillow format, MIME type).
+VARIANTS = {
+    ".webp": (False, "WEBP", "image/webp"),
+    ".thumb.jpg": (True, "JPEG", "image/jpeg"),
+    ".thumb.webp": (True, "WEBP", "image/webp"),
+}
+
+CatalogEntry = namedtuple("CatalogEntry", "path mimetype size etag version")
+
+
+def file_digest(path):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_variant(source, target, thumbnail_size, image_format):
+    """
+    Write a re-encoded and optionally downscaled copy of an image.
+    The copy is written to a temporary file and renamed into place, so
+    processes generating the same variant concurrently do not clash.
+    Args:
+        source (str): Path of the original image.
+        target (str): Path of the variant.
+        thumbnail_size (int): Longest side of the variant, or None to keep it.
+        image_format (str): Pillow format name, e.g. ``"WEBP"``.
+    """
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        if thumbnail_size:
+            image.thumbnail((thumbnail_size, thumbnail_size))
+        temporary = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(temporary, format=image_format, quality=85)
+    os.replace(temporary, target)
+
+
+class ImageCatalog:
+    """
+    In-memory index of the character images and their generated variants.
+    Args:
+        directory (str): Directory holding the original images.
+        variants_dir (str): Directory the variants are generated into.
+        thumbnail_size (int): Longest side of thumbnails in pixels.
+        ttl (float): Seconds between rescans of ``directory``.
+    """
+
+    def __init__(self, directory, variants_dir, thumbnail_size, ttl):
+        self.directory = directory
+        self.variants_dir = variants_dir
+        self.thumbnail_size = thumbnail_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Source images by filename with their (size, mtime) and entries,
+        # and every entry by the filename it is served under.
+        self._scan = {}, {}
+        self._expires = 0.0
+
+    def get(self, filename):
+        """
+        Look up an image or variant by the filename it is served under.
+        Args:
+            filename (str): e.g. ``"harry.jpg"`` or ``"harry.thumb.webp"``.
+        Returns:
+            CatalogEntry: The file to serve, or None if there is none.
+        """
+        if time.monotonic() >= self._expires:
+            self.refresh()
+        return self._scan[1].get(filename)
+
+    def thumbnails(self):
+        """
+        Return the thumbnails of every character.
+        Returns:
+            dict: ``{name: {"jpeg": (filename, version), "webp": ...}}``.
+        """
+        if time.monotonic() >= self._expires:
+            self.refresh()
+        thumbnails = {}
+        for name, suffixes in (("jpeg", ".thumb.jpg"), ("webp", ".thumb.webp")):
+            for filename, entry in self._scan[1].items():
+                if filename.endswith(suffixes):
+                    character = filename[: -len(suffixes)]
+                    thumbnails.setdefault(character, {})[name] = (
+                        filename,
+                        entry.version,
+                    )
+        return thumbnails
+
+    def refresh(self):
+        """
+        Rescan the images directory, generating variants of new images.
+        Images whose size and modification time are unchanged are not read
+        again. A missing directory leaves the catalog empty.
+        """
+        with self._lock:
+            if time.monotonic() < self._expires:
+                return
+            sources, entries = {}, {}
+            try:
+                filenames = sorted(os.listdir(self.directory))
+            except OSError as e:
+                logging.error("Failed to list %s: %s", self.directory, e)
+                filenames = []
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+                    continue
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                    key = (stat.st_size, stat.st_mtime_ns)
+                    cached = self._scan[0].get(filename)
+                    if cached is None or cached[0] != key:
+                        cached = (key, self._index(path, filename))
+                except OSError as e:
+                    logging.error("Failed to catalog %s: %s", path, e)
+                    continue
+                sources[filename] = cached
+                entries.update(cached[1])
+            self._scan = sources, entries
+            self._expires = time.monotonic() + self.ttl
+
+    def _index(self, path, filename):
+        """Return the catalog entries of one image, generating its variants."""
+        stem, extension = os.path.splitext(filename)
+        version = file_digest(path)[:16]
+        mimetype = IMAGE_EXTENSIONS[extension.lower()]
+        entries = {
+            filename: CatalogEntry(
+                path, mimetype, os.path.getsize(path), version, version
+            )
+        }
+        os.makedirs(self.variants_dir, exist_ok=True)
+        for suffix, (thumbnail, image_format, mimetype) in VARIANTS.items():
+            size = self.thumbnail_size if thumbnail else None
+            target = os.path.join(
+                self.variants_dir, f"{version}-{size or 'full'}{suffix}"
+            )
+            if not os.path.exists(target):
+                write_variant(path, target, size, image_format)
+            entries[stem + suffix] = CatalogEntry(
+                target,
+                mimetype,
+                os.path.getsize(target),
+                file_digest(target)[:16],
+                version,
+            )
+        return entries
@@ -0,0 +1,151 @@
+"""
+Prometheus metrics and request IDs for the web app.
+
+Every request is timed by endpoint and tagged with an ID, taken from the
+caller's X-Request-ID header or generated, which is echoed in the response,
+added to every log line written while handling it and forwarded to
+ml-client. The ML call and every MongoDB command are timed separately, so a
+slow capture can be broken down and followed into ml-client's logs.
+"""
+
+import os
+import re
+import time
+import uuid
+import logging
+
+from flask import Response, g, has_request_context, request
+from pymongo import monitoring
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+REQUEST_LATENCY = Histogram(
+    "web_request_duration_seconds",
+    "Time spent handling HTTP requests.",
+    ["endpoint", "method", "status"],
+)
+STAGE_LATENCY = Histogram(
+    "web_stage_duration_seconds",
+    "Time spent in each stage of a request, such as the ML service call.",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20),
+)
+MONGO_LATENCY = Histogram(
+    "web_mongo_command_duration_seconds",
+    "Time spent in MongoDB commands.",
+    ["command", "collection", "outcome"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1),
+)
+CIRCUIT_OPEN = Gauge(
+    "web_ml_circuit_open",
+    "Whether calls to the ML service are being skipped.",
+    multiprocess_mode="max",
+)
+PENDING_WRITES = Gauge(
+    "web_pending_capture_writes",
+    "Captures buffered for a write-behind flush.",
+    multiprocess_mode="livesum",
+)
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Record the duration of every MongoDB command in MONGO_LATENCY."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore names its collection separately.
+            collection = event.command.get("collection")
+        self._collections[event.request_id] = (
+            collection if isinstance(collection, str) else "-"
+        )
+
+    def _observe(self, event, outcome):
+        collection = self._collections.pop(event.request_id, "-")
+        MONGO_LATENCY.labels(event.command_name, collection, outcome).observe(
+            event.duration_micros / 1e6
+        )
+
+    def succeeded(self, event):
+        self._observe(event, "success")
+
+    def failed(self, event):
+        self._observe(event, "failure")
+
+
+def request_id():
+    """Return the ID of the current request, or ``-`` outside of one."""
+    if has_request_context():
+        return g.get("request_id", "-")
+    return "-"
+
+
+class RequestIdFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Add the current request ID to log records as ``request_id``."""
+
+    def filter(self, record):
+        record.request_id = request_id()
+        return True
+
+
+def metrics_response():
+    """
+    Render every metric in the Prometheus text format.
+    When PROMETHEUS_MULTIPROC_DIR is set, the metrics of all worker
+    processes are collected from that directory.
+    """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def instrument(app, refresh_gauges=None):
+    """
+    Time the requests of a Flask app, propagate request IDs and add /metrics.
+    Args:
+        app (Flask): The application.
+        refresh_gauges: Optional callable updating the gauges; it runs after
+            every request and before metrics are rendered.
+    """
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+
+    @app.before_request
+    def start_timer():
+        incoming = request.headers.get(REQUEST_ID_HEADER, "")
+        g.request_id = (
+            incoming if _REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex
+        )
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(
+            time.perf_counter() - g.get("request_start", time.perf_counter())
+        )
+        response.headers[REQUEST_ID_HEADER] = request_id()
+        if refresh_gauges:
+            refresh_gauges()
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        if refresh_gauges:
+            refresh_gauges()
+        return metrics_response()
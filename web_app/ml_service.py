@@ -0,0 +1,210 @@
+"""
+HTTP client for the machine learning service.
+
+All captures share one requests.Session, so connections to ml-client are
+pooled and kept alive instead of being opened per request. Connection
+failures and 502/503/504 responses are retried a bounded number of times
+with jittered backoff, and a circuit breaker fails fast while ml-client keeps
+failing so web workers are not tied up waiting on it. Only those failures
+count towards the breaker: other errors, such as a 500 for an image that
+cannot be decoded, are about the request rather than the service.
+"""
+
+import io
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+UNAVAILABLE_STATUSES = (502, 503, 504)
+
+
+class CircuitOpen(Exception):
+    """Raised when the ML service is being skipped after repeated failures."""
+
+
+class CircuitBreaker:
+    """
+    Count consecutive failures and stop calls for a while after too many.
+    After ``reset_timeout`` seconds one trial call is let through; its
+    success closes the circuit again and its failure re-opens it. Calls
+    report their outcome with the admission allow() returned, so one that
+    started before the circuit opened cannot end another call's trial.
+    Args:
+        failure_threshold (int): Consecutive failures that open the circuit.
+        reset_timeout (float): Seconds to wait before a trial call.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """``closed``, ``open`` or ``half-open``."""
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def allow(self):
+        """
+        Admit a call if one may be made now.
+        Returns:
+            str: ``"trial"`` for the half-open trial call, ``"call"`` while
+            the circuit is closed, or None if the call must not be made.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return "call"
+            if self._trial_running:
+                return None
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._trial_running = True
+                return "trial"
+            return None
+
+    def record_success(self, admission="call"):
+        """Close the circuit after a successful call."""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            if admission == "trial":
+                self._trial_running = False
+
+    def record_failure(self, admission="call"):
+        """Count a failed call, opening the circuit at the threshold."""
+        with self._lock:
+            self.failures += 1
+            if admission == "trial" or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            if admission == "trial":
+                self._trial_running = False
+
+    def end_trial(self, admission):
+        """Let another call be the trial if this one was it."""
+        if admission == "trial":
+            with self._lock:
+                self._trial_running = False
+
+
+class MLServiceClient:
+    """
+    Pooled keep-alive client for ml-client's recognition endpoints.
+    Args:
+        base_url (str): The ML service URL, e.g. ``http://ml-client:5000``.
+        connect_timeout (float): Seconds to wait for a connection.
+        read_timeout (float): Seconds to wait for a response.
+        retries (int): Retries after connection errors or 502/503/504.
+        pool_size (int): Maximum pooled connections to the service.
+        breaker (CircuitBreaker): The breaker guarding the service.
+    """
+
+    def __init__(
+        self, base_url, connect_timeout, read_timeout, retries, pool_size, breaker
+    ):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=retries,
+            status_forcelist=UNAVAILABLE_STATUSES,
+            allowed_methods=frozenset(["GET", "POST"]),
+            backoff_factor=0.2,
+            backoff_jitter=0.2,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retry
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, path, **kwargs):
+        """
+        POST to the ML service through the circuit breaker.
+        Args:
+            path (str): The endpoint path, e.g. ``/recognize_face``.
+            kwargs: Passed on to requests.Session.post.
+        Returns:
+            requests.Response: The service's response.
+        Raises:
+            CircuitOpen: If the circuit is open.
+            requests.exceptions.RequestException: If the request failed.
+        """
+        admission = self.breaker.allow()
+        if not admission:
+            raise CircuitOpen("ML service is unavailable")
+        try:
+            response = self.session.post(
+                f"{self.base_url}{path}", timeout=self.timeout, **kwargs
+            )
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure(admission)
+            raise
+        else:
+            if response.status_code in UNAVAILABLE_STATUSES:
+                self.breaker.record_failure(admission)
+            else:
+                self.breaker.record_success(admission)
+            return response
+        finally:
+            # Any other exception must not leave a half-open trial pending
+            # forever, which would reject every later call.
+            self.breaker.end_trial(admission)
+
+    def recognize(self, data, content_type, request_id=None, include_encoding=False):
+        """
+        Send an image to ``/recognize_face`` as the raw request body.
+        A file object is streamed from its current position without being
+        read into memory; it must be seekable so a retry can resend it, and
+        its remaining size is sent as the Content-Length.
+        Args:
+            data: The image bytes or a seekable binary file object.
+            content_type (str): The image MIME type.
+            request_id (str): Sent as X-Request-ID to trace the call.
+            include_encoding (bool): Ask for the packed encoding of the face.
+        Returns:
+            requests.Response: The service's response.
+        """
+        if not content_type or not content_type.startswith("image/"):
+            content_type = "application/octet-stream"
+        headers = {"Content-Type": content_type}
+        if not isinstance(data, bytes):
+            position = data.tell()
+            headers["Content-Length"] = str(data.seek(0, io.SEEK_END) - position)
+            data.seek(position)
+        if request_id:
+            headers["X-Request-ID"] = request_id
+        params = {"include_encoding": "1"} if include_encoding else None
+        return self.post("/recognize_face", data=data, headers=headers, params=params)
+
+    def match(self, encodings, k=None, request_id=None):
+        """
+        Match packed face encodings against the gallery with ``/match``.
+        Args:
+            encodings (list): Base64 float32 encodings from ``/recognize_face``
+                or ``/encode``.
+            k (int): Matches per encoding; the service's default if None.
+            request_id (str): Sent as X-Request-ID to trace the call.
+        Returns:
+            requests.Response: The service's response.
+        """
+        body = {"encodings": encodings}
+        if k is not None:
+            body["k"] = k
+        headers = {"X-Request-ID": request_id} if request_id else None
+        return self.post("/match", json=body, headers=headers)
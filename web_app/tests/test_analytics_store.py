@@ -0,0 +1,75 @@
+"""
+Unit tests for the materialized analytics.
+"""
+
+from datetime import datetime, timezone
+
+from web_app.analytics_store import (
+    GlobalDistributionCache,
+    bucket_increments,
+    character_field,
+    character_name,
+    distribution,
+    period_start,
+)
+
+
+def test_character_field_round_trip():
+    """Test that dots and dollars in names are escaped in counter paths."""
+    assert character_field("harry") == "characters.harry"
+    field = character_field("$mr.weasley")
+    assert field.count(".") == 1
+    assert character_name(field.split(".", 1)[1]) == "$mr.weasley"
+
+
+def test_period_start():
+    """Test that captures fall in UTC day buckets and Monday-based weeks."""
+    timestamp = datetime(2024, 11, 7, 23, 30, tzinfo=timezone.utc)  # A Thursday
+    assert period_start("all", timestamp) is None
+    assert period_start("day", timestamp) == datetime(2024, 11, 7)
+    assert period_start("week", timestamp) == datetime(2024, 11, 4)
+
+
+def test_bucket_increments():
+    """Test that a capture bumps global and per-user daily and weekly buckets."""
+    timestamp = datetime(2024, 11, 7, 12, tzinfo=timezone.utc)
+    increments = bucket_increments("alice", "harry", timestamp)
+    assert {(i["scope"], i["period"], i["start"]) for i, _ in increments} == {
+        ("*", "all", None),
+        ("alice", "day", datetime(2024, 11, 7)),
+        ("*", "day", datetime(2024, 11, 7)),
+        ("alice", "week", datetime(2024, 11, 4)),
+        ("*", "week", datetime(2024, 11, 4)),
+    }
+    assert all(inc == {"total": 1, "characters.harry": 1} for _, inc in increments)
+
+
+def test_distribution():
+    """Test that counters become percentages of the total."""
+    assert not distribution(None)
+    assert not distribution({"total": 0, "characters": {}})
+    assert distribution({"total": 4, "characters": {"harry": 3, "mr．weasley": 1}}) == [
+        {"character": "harry", "percentage": 75.0},
+        {"character": "mr.weasley", "percentage": 25.0},
+    ]
+
+
+def test_global_cache_invalidation():
+    """Test that the global distribution is cached until invalidated."""
+    reads = []
+
+    class Buckets:  # pylint: disable=too-few-public-methods
+        """Bucket collection stand-in counting reads."""
+
+        def find_one(self, _query):
+            """Return the global counters."""
+            reads.append(1)
+            return {"total": 1, "characters": {"harry": 1}}
+
+    cache = GlobalDistributionCache({"analytics_buckets": Buckets()}, ttl=60)
+    assert cache.get() == [{"character": "harry", "percentage": 100.0}]
+    cache.get()
+    assert len(reads) == 1
+    cache.invalidate()
+    cache.get()
+    assert len(reads) == 2
@@ -0,0 +1,33 @@
+"""
+Unit tests for password hashing.
+"""
+
+import hmac
+import bcrypt
+from web_app.auth import PasswordHasher, hash_rounds, live_token
+
+
+def test_hash_uses_configured_rounds():
+    """Test that new hashes use the configured work factor and verify."""
+    hasher = PasswordHasher(rounds=4, workers=1)
+    hashed = hasher.hash(b"secret")
+    assert hash_rounds(hashed) == 4
+    assert hasher.check(b"secret", hashed)
+    assert not hasher.check(b"wrong", hashed)
+
+
+def test_needs_rehash():
+    """Test that only hashes with another work factor need rehashing."""
+    hasher = PasswordHasher(rounds=5, workers=1)
+    assert hasher.needs_rehash(bcrypt.hashpw(b"secret", bcrypt.gensalt(4)))
+    assert not hasher.needs_rehash(bcrypt.hashpw(b"secret", bcrypt.gensalt(5)))
+    assert hash_rounds(b"not a hash") is None
+
+
+def test_live_token_is_signed_and_expires():
+    """Test the /live token layout the ML service verifies."""
+    token = live_token("secret", "harry.potter", 30, now=1000)
+    user, expires, signature = token.split(".")
+    assert (user, expires) == ("aGFycnkucG90dGVy", "1030")
+    expected = hmac.new(b"secret", f"{user}.{expires}".encode(), "sha256")
+    assert signature == expected.hexdigest()
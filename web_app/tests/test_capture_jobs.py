@@ -0,0 +1,75 @@
+"""
+Unit tests for the capture job queue consumers.
+"""
+
+from bson import ObjectId
+from web_app.capture_jobs import CaptureWorkers, job_status
+
+
+class FakeQueue:
+    """Queue stand-in handing out prepared jobs and recording outcomes."""
+
+    max_attempts = 3
+
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+        self.outcomes = []
+
+    def claim(self):
+        """Return the next prepared job, if any."""
+        return self.jobs.pop(0) if self.jobs else None
+
+    def finish(self, job, status_code, body):
+        """Record a finished job."""
+        self.outcomes.append(("finish", job["_id"], status_code, body))
+
+    def retry(self, job, delay, body):
+        """Record a job put back in the queue."""
+        self.outcomes.append(("retry", job["_id"], delay, body))
+
+
+def make_job(attempts=1):
+    """Return a claimed job document."""
+    return {"_id": ObjectId(), "claim": ObjectId(), "attempts": attempts}
+
+
+def test_workers_finish_and_retry_jobs():
+    """Test that results are stored and unavailable services are retried."""
+    done, busy, broken = make_job(), make_job(), make_job()
+    outcomes = {
+        done["_id"]: (200, {"match": "harry"}, None),
+        busy["_id"]: (503, {"error": "busy"}, "2"),
+    }
+
+    def process(job):
+        if job is broken:
+            raise RuntimeError("boom")
+        return outcomes[job["_id"]]
+
+    queue = FakeQueue([done, busy, broken])
+    workers = CaptureWorkers(queue, process, workers=1, poll_interval=0)
+    while workers.run_once():
+        pass
+
+    assert queue.outcomes == [
+        ("finish", done["_id"], 200, {"match": "harry"}),
+        ("retry", busy["_id"], 2.0, {"error": "busy"}),
+        ("finish", broken["_id"], 500, {"error": "boom"}),
+    ]
+
+
+def test_workers_fail_jobs_that_outlive_their_attempts():
+    """Test that a job reclaimed after too many lost leases fails."""
+    job = make_job(attempts=4)
+    queue = FakeQueue([job])
+    CaptureWorkers(queue, None, workers=1, poll_interval=0).run_once()
+    assert queue.outcomes[0][:3] == ("finish", job["_id"], 500)
+
+
+def test_job_status():
+    """Test that finished jobs expose their result."""
+    assert job_status({"status": "running"}) == {"status": "running"}
+    assert job_status({"status": "done", "result": {"match": "ron"}}) == {
+        "match": "ron",
+        "status": "done",
+    }
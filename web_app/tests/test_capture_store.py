@@ -0,0 +1,193 @@
+"""
+Unit tests for recording captures in MongoDB.
+"""
+
+from datetime import datetime, timezone
+
+import pytest
+from pymongo import UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from web_app.capture_store import CaptureRecorder, WriteBehindRecorder
+
+NOW = datetime(2024, 11, 1, tzinfo=timezone.utc)
+
+
+class FakeCollection:  # pylint: disable=too-few-public-methods
+    """
+    Collection stand-in recording the write calls it receives.
+    Exceptions in ``failures`` are raised, in order, by the next calls.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.failures = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            if self.failures:
+                raise self.failures.pop(0)
+
+        return call
+
+
+class FakeDatabase(dict):
+    """Database stand-in creating collections on first use."""
+
+    def __missing__(self, name):
+        self[name] = FakeCollection()
+        return self[name]
+
+    def __getattr__(self, name):
+        return self[name]
+
+
+def written_counters(db, collection):
+    """Return the UpdateOne requests bulk-written to a collection."""
+    return [
+        request
+        for name, (requests,), kwargs in db[collection].calls
+        if name == "bulk_write" and kwargs == {"ordered": False}
+        for request in requests
+    ]
+
+
+def test_record_uses_inc_upserts():
+    """Test that a capture is counted with $inc and added to history."""
+    db = FakeDatabase()
+    CaptureRecorder(db).record("alice", "harry", NOW)
+
+    assert written_counters(db, "analytics") == [
+        UpdateOne(
+            {"username": "alice"},
+            {"$inc": {"total": 1, "characters.harry": 1}},
+            upsert=True,
+        )
+    ]
+    assert len(written_counters(db, "analytics_buckets")) == 5
+    assert len(db["analytics_buckets"].calls) == 1
+    assert db.history.calls == [
+        (
+            "insert_one",
+            ({"username": "alice", "matched_character": "harry", "timestamp": NOW},),
+            {},
+        )
+    ]
+
+
+def test_write_behind_merges_counts():
+    """Test that buffered captures are flushed as one batch per collection."""
+    db = FakeDatabase()
+    recorder = WriteBehindRecorder(db, max_batch=100, interval=3600, max_pending=1000)
+    recorder.record("alice", "harry", NOW)
+    recorder.record("alice", "harry", NOW)
+    recorder.record("bob", "snape", NOW)
+    assert recorder.pending == 3
+    assert not db
+
+    assert recorder.flush() == 3
+    assert recorder.pending == 0
+    assert written_counters(db, "analytics") == [
+        UpdateOne(
+            {"username": "alice"},
+            {"$inc": {"total": 2, "characters.harry": 2}},
+            upsert=True,
+        ),
+        UpdateOne(
+            {"username": "bob"},
+            {"$inc": {"total": 1, "characters.snape": 1}},
+            upsert=True,
+        ),
+    ]
+    global_all = {"_id": {"scope": "*", "period": "all", "start": None}}
+    assert UpdateOne(
+        global_all,
+        {"$inc": {"total": 3, "characters.harry": 2, "characters.snape": 1}},
+        upsert=True,
+    ) in written_counters(db, "analytics_buckets")
+    [(name, (documents,), _)] = db.history.calls
+    assert name == "insert_many" and len(documents) == 3
+    assert recorder.flush() == 0
+
+
+def test_write_behind_retries_unwritten_history():
+    """Test that history a failed flush did not insert is written next time."""
+    db = FakeDatabase()
+    db.history.failures.append(AutoReconnect("primary stepped down"))
+    recorder = WriteBehindRecorder(db, max_batch=100, interval=3600, max_pending=10)
+    recorder.record("alice", "harry", NOW)
+    recorder.record("bob", "snape", NOW)
+
+    with pytest.raises(AutoReconnect):
+        recorder.flush()
+    assert recorder.pending == 2
+    assert len(written_counters(db, "analytics")) == 2
+
+    recorder.record("carol", "ron", NOW)
+    assert recorder.flush() == 3
+    # Only the new capture's counters are written again.
+    assert len(written_counters(db, "analytics")) == 3
+    assert written_counters(db, "analytics")[-1] == UpdateOne(
+        {"username": "carol"},
+        {"$inc": {"total": 1, "characters.ron": 1}},
+        upsert=True,
+    )
+    [_, (name, (documents,), _)] = db.history.calls
+    assert name == "insert_many"
+    assert [document["username"] for document in documents] == [
+        "alice",
+        "bob",
+        "carol",
+    ]
+
+
+def test_write_behind_keeps_failed_counters():
+    """Test that only the counters a bulk write rejected are retried."""
+    db = FakeDatabase()
+    db.analytics.failures.append(
+        BulkWriteError({"writeErrors": [{"index": 1, "code": 91}]})
+    )
+    recorder = WriteBehindRecorder(db, max_batch=100, interval=3600, max_pending=10)
+    recorder.record("alice", "harry", NOW)
+    recorder.record("bob", "snape", NOW)
+    recorder.record("bob", "snape", NOW)
+
+    with pytest.raises(BulkWriteError):
+        recorder.flush()
+    assert not db.history.calls
+    assert recorder.pending == 3
+
+    recorder.flush()
+    assert written_counters(db, "analytics")[-1] == UpdateOne(
+        {"username": "bob"},
+        {"$inc": {"total": 2, "characters.snape": 2}},
+        upsert=True,
+    )
+    assert len(written_counters(db, "analytics")) == 3
+
+
+def test_write_behind_treats_duplicate_history_as_written():
+    """Test that documents a retried insert finds already present count."""
+    db = FakeDatabase()
+    db.history.failures.append(
+        BulkWriteError({"writeErrors": [{"index": 0, "code": 11000}]})
+    )
+    recorder = WriteBehindRecorder(db, max_batch=100, interval=3600, max_pending=10)
+    recorder.record("alice", "harry", NOW)
+
+    assert recorder.flush() == 1
+    assert recorder.pending == 0
+
+
+def test_write_behind_bounds_retained_captures():
+    """Test that a failed batch is dropped rather than exceed max_pending."""
+    db = FakeDatabase()
+    db.analytics.failures.append(AutoReconnect("down"))
+    recorder = WriteBehindRecorder(db, max_batch=100, interval=3600, max_pending=2)
+    for _ in range(3):
+        recorder.record("alice", "harry", NOW)
+
+    with pytest.raises(AutoReconnect):
+        recorder.flush()
+    assert recorder.pending == 0
@@ -0,0 +1,168 @@
+"""
+Unit tests for the history retention and rollups.
+"""
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+from web_app.history_store import (
+    LEASES,
+    ROLLUPS,
+    HistoryRetention,
+    history_page,
+    retention_cutoff,
+)
+
+
+class FakeHistory:
+    """History collection stand-in recording rollup queries."""
+
+    def __init__(self, deleted=0, runs=()):
+        self.deleted = deleted
+        self.runs = list(runs)
+        self.calls = []
+
+    def update_many(self, query, update):
+        """Record the tagging of a run, which distinct then returns."""
+        self.calls.append(("update_many", query, update))
+        self.runs.append(update["$set"]["rollup_run"])
+
+    def distinct(self, field, query):
+        """Return the runs tagged so far."""
+        self.calls.append(("distinct", field, query))
+        return list(self.runs)
+
+    def aggregate(self, pipeline, **kwargs):
+        """Record an aggregation."""
+        self.calls.append(("aggregate", pipeline, kwargs))
+
+    def delete_many(self, query):
+        """Record a delete."""
+        self.calls.append(("delete_many", query))
+        return SimpleNamespace(deleted_count=self.deleted)
+
+
+class FakeCursor:
+    """Cursor stand-in applying the limit."""
+
+    def __init__(self, records):
+        self.records = records
+
+    def sort(self, _keys):
+        """Ignore the sort; records are prepared in order."""
+        return self
+
+    def limit(self, limit):
+        """Apply the limit."""
+        self.records = self.records[:limit]
+        return self
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+class FakeDatabase:  # pylint: disable=too-few-public-methods
+    """Database stand-in with a history and a rollup collection."""
+
+    def __init__(self, history, rollups):
+        self.history = history
+        self.rollups = rollups
+
+    def __getitem__(self, name):
+        assert name == ROLLUPS
+        return self.rollups
+
+
+def test_retention_cutoff_is_a_utc_midnight():
+    """Test that only whole days before the retention period are rolled up."""
+    now = datetime(2024, 11, 10, 1, 30, tzinfo=timezone(timedelta(hours=5)))
+
+    assert retention_cutoff(now, 7) == datetime(2024, 11, 2)
+    assert retention_cutoff(now, 0) == datetime(2024, 11, 9)
+
+
+def test_run_once_adds_tagged_captures_then_deletes():
+    """Test that expired captures are tagged, added to rollups and deleted."""
+    leftover = ObjectId()
+    history = FakeHistory(deleted=3, runs=[leftover])
+    retention = HistoryRetention(SimpleNamespace(history=history), 30, 3600)
+
+    deleted = retention.run_once(datetime(2024, 11, 10, 12, tzinfo=timezone.utc))
+
+    expired = {"timestamp": {"$lt": datetime(2024, 10, 11)}}
+    tag, distinct = history.calls[0], history.calls[1]
+    run = tag[2]["$set"]["rollup_run"]
+    assert deleted == 6
+    assert tag[1] == {**expired, "rollup_run": {"$exists": False}}
+    assert distinct == ("distinct", "rollup_run", expired)
+    merged = [call[1] for call in history.calls if call[0] == "delete_many"]
+    assert merged == [{"rollup_run": leftover}, {"rollup_run": run}]
+
+    _, pipeline, kwargs = history.calls[-2]
+    assert pipeline[0] == {"$match": {"rollup_run": run}}
+    merge = pipeline[-1]["$merge"]
+    assert merge["into"] == ROLLUPS and merge["whenNotMatched"] == "insert"
+    update = merge["whenMatched"][0]["$set"]
+    runs = {"$ifNull": ["$runs", []]}
+    assert update["count"]["$cond"] == [
+        {"$in": [run, runs]},
+        "$count",
+        {"$add": ["$count", "$$new.count"]},
+    ]
+    assert update["runs"] == {"$setUnion": [runs, [run]]}
+    assert kwargs == {"allowDiskUse": True}
+
+
+def test_lease_admits_one_process_per_interval():
+    """Test that the rollup lease is only taken while it is free."""
+    now = datetime(2024, 11, 10, 12, tzinfo=timezone.utc)
+    updates = []
+
+    def update_one(query, update, upsert):
+        updates.append((query, update, upsert))
+        if len(updates) > 1:
+            raise DuplicateKeyError("E11000")
+
+    db = {LEASES: SimpleNamespace(update_one=update_one)}
+    retention = HistoryRetention(db, 30, 3600)
+
+    assert retention.take_lease(now)
+    assert not retention.take_lease(now)
+    query, update, upsert = updates[0]
+    assert query == {"_id": "history-rollup", "expires_at": {"$lte": now}}
+    assert update == {"$set": {"expires_at": now + timedelta(hours=1)}}
+    assert upsert
+
+
+def test_run_once_keeps_history_without_retention():
+    """Test that a retention of 0 days never rolls up."""
+    history = FakeHistory()
+    retention = HistoryRetention(SimpleNamespace(history=history), 0, 3600)
+
+    assert retention.run_once() == 0
+    assert not history.calls
+
+
+def test_history_page_fills_up_with_rollups():
+    """Test that rollups are only read once the raw captures run out."""
+    queries = []
+
+    def collection(records):
+        def find(query, projection):
+            queries.append((query, projection))
+            return FakeCursor(list(records))
+
+        return SimpleNamespace(find=find)
+
+    history = collection([{"n": 1}, {"n": 2}])
+    db = FakeDatabase(history, collection([{"n": 3}, {"n": 4}]))
+
+    page = history_page(db, {"username": "u"}, {"matched_character": 1}, 3)
+    assert [record["n"] for record in page] == [1, 2, 3]
+    assert queries[1] == ({"username": "u"}, {"matched_character": 1, "count": 1})
+
+    queries.clear()
+    assert len(history_page(db, {}, {"matched_character": 1}, 2)) == 2
+    assert len(queries) == 1
@@ -0,0 +1,50 @@
+"""
+Unit tests for the character image catalog.
+"""
+
+import os
+
+from PIL import Image
+from web_app.image_catalog import ImageCatalog
+
+
+def make_catalog(tmp_path, ttl=300):
+    """Create a catalog over a directory holding one large JPEG."""
+    images = tmp_path / "images"
+    images.mkdir()
+    Image.new("RGB", (1000, 800), "red").save(images / "harry.jpg")
+    (images / "notes.txt").write_text("not an image")
+    return images, ImageCatalog(str(images), str(tmp_path / "variants"), 100, ttl)
+
+
+def test_catalog_generates_variants(tmp_path):
+    """Test that thumbnails and WebP copies are generated and indexed."""
+    _, catalog = make_catalog(tmp_path)
+    original = catalog.get("harry.jpg")
+    thumbnail = catalog.get("harry.thumb.webp")
+
+    assert original.mimetype == "image/jpeg"
+    assert thumbnail.mimetype == "image/webp"
+    assert thumbnail.version == original.version
+    assert thumbnail.etag != original.etag
+    with Image.open(thumbnail.path) as image:
+        assert max(image.size) == 100
+    assert catalog.get("harry.webp") is not None
+    assert catalog.get("notes.txt") is None
+    assert catalog.thumbnails() == {
+        "harry": {
+            "jpeg": ("harry.thumb.jpg", original.version),
+            "webp": ("harry.thumb.webp", original.version),
+        }
+    }
+
+
+def test_catalog_rescans_after_ttl(tmp_path):
+    """Test that changed images get a new version after the TTL."""
+    images, catalog = make_catalog(tmp_path, ttl=0)
+    version = catalog.get("harry.jpg").version
+
+    Image.new("RGB", (10, 10), "blue").save(images / "harry.jpg")
+    os.utime(images / "harry.jpg", ns=(0, 0))
+    assert catalog.get("harry.jpg").version != version
+    assert catalog.get("ron.jpg") is None
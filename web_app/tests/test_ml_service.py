@@ -0,0 +1,133 @@
+"""
+Unit tests for the ML service client's circuit breaker.
+"""
+
+import pytest
+import requests
+from web_app.ml_service import CircuitBreaker, CircuitOpen, MLServiceClient
+
+
+def test_breaker_opens_after_threshold():
+    """Test that the breaker rejects calls after enough failures."""
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_trial(monkeypatch):
+    """Test that one trial call is allowed after the reset timeout."""
+    now = [100.0]
+    monkeypatch.setattr("web_app.ml_service.time.monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    now[0] += 10
+    assert breaker.state == "half-open"
+    trial = breaker.allow()
+    assert trial == "trial"
+    assert not breaker.allow()
+    breaker.record_failure(trial)
+    assert not breaker.allow()
+
+    now[0] += 10
+    trial = breaker.allow()
+    assert trial == "trial"
+    breaker.record_success(trial)
+    assert breaker.state == "closed"
+    assert breaker.allow() == "call"
+
+
+def test_only_the_trial_call_ends_the_trial(monkeypatch):
+    """Test that a call admitted before the circuit opened keeps one trial."""
+    now = [100.0]
+    monkeypatch.setattr("web_app.ml_service.time.monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    stale = breaker.allow()
+    breaker.record_failure()
+
+    now[0] += 10
+    trial = breaker.allow()
+    assert trial == "trial"
+    breaker.end_trial(stale)
+    breaker.record_failure(stale)
+    assert not breaker.allow()
+
+    breaker.end_trial(trial)
+    now[0] += 10
+    assert breaker.allow() == "trial"
+
+
+class FakeResponse:  # pylint: disable=too-few-public-methods
+    """Minimal stand-in for requests.Response."""
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def test_client_counts_unavailable_responses(monkeypatch):
+    """Test that 503 responses count as failures and open the circuit."""
+    monkeypatch.setattr(
+        "requests.Session.post", lambda *_args, **_kwargs: FakeResponse(503)
+    )
+    service = MLServiceClient(
+        "http://ml-client:5000/", 1, 1, 0, 1, CircuitBreaker(1, 60)
+    )
+    assert service.recognize(b"data", "image/jpeg").status_code == 503
+    with pytest.raises(CircuitOpen):
+        service.recognize(b"data", "image/jpeg")
+
+
+def test_client_ignores_request_errors(monkeypatch):
+    """Test that errors caused by the request, e.g. a bad image, do not count."""
+    monkeypatch.setattr(
+        "requests.Session.post", lambda *_args, **_kwargs: FakeResponse(500)
+    )
+    service = MLServiceClient(
+        "http://ml-client:5000", 1, 1, 0, 1, CircuitBreaker(1, 60)
+    )
+    for _ in range(3):
+        assert service.recognize(b"garbage", "image/jpeg").status_code == 500
+    assert service.breaker.state == "closed"
+
+
+def test_unexpected_error_ends_the_trial(monkeypatch):
+    """Test that a trial call failing unexpectedly lets the next one through."""
+    now = [100.0]
+    monkeypatch.setattr("web_app.ml_service.time.monotonic", lambda: now[0])
+
+    def mock_post(*_args, **_kwargs):
+        raise OSError("upload stream closed")
+
+    monkeypatch.setattr("requests.Session.post", mock_post)
+    service = MLServiceClient(
+        "http://ml-client:5000", 1, 1, 0, 1, CircuitBreaker(1, 10)
+    )
+    service.breaker.record_failure()
+
+    now[0] += 10
+    with pytest.raises(OSError):
+        service.recognize(b"data", "image/jpeg")
+    assert service.breaker.allow()
+
+
+def test_client_uses_timeouts(monkeypatch):
+    """Test that requests carry the connect and read timeouts."""
+    seen = {}
+
+    def mock_post(_session, url, **kwargs):
+        seen["url"] = url
+        seen["timeout"] = kwargs["timeout"]
+        raise requests.exceptions.ReadTimeout("slow")
+
+    monkeypatch.setattr("requests.Session.post", mock_post)
+    service = MLServiceClient(
+        "http://ml-client:5000", 2, 20, 0, 1, CircuitBreaker(3, 60)
+    )
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        service.recognize(b"data", "image/jpeg")
+    assert seen == {"url": "http://ml-client:5000/recognize_face", "timeout": (2, 20)}
+    assert service.breaker.failures == 1
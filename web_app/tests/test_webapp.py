@@ -5,16 +5,37 @@ Unit tests for the web_app module.
 # pylint: disable=redefined-outer-name
 
 import io
+import json
+import time
+import base64
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
 import pytest
 import requests
 import bcrypt
-from web_app.web_app import app
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from prometheus_client import generate_latest
+from web_app.web_app import app, ensure_indexes
+from web_app.auth import PasswordHasher
+from web_app.image_catalog import CatalogEntry
+from web_app.history_store import ROLLUPS
+from web_app.ml_service import CircuitBreaker
+from web_app.metrics import MongoCommandTimer
+
+
+def client_metrics():
+    """Return the metrics exposition of the web app."""
+    return generate_latest().decode()
 
 
 @pytest.fixture
-def client():
+def client(monkeypatch):
     """Set up a test client for Flask."""
     app.config["TESTING"] = True
+    monkeypatch.setattr("web_app.web_app.ml_service.breaker", CircuitBreaker(5, 30))
     with app.test_client() as client:
         yield client
 
@@ -22,7 +43,7 @@ def client():
 def test_login_success(client, monkeypatch):
     """Test the /login endpoint with valid credentials."""
 
-    def mock_find_one(_query):
+    def mock_find_one(_query, _projection=None):
         return {
             "username": "testuser",
             "password": bcrypt.hashpw("testpass".encode("utf-8"), bcrypt.gensalt()),
@@ -42,7 +63,7 @@ def test_login_success(client, monkeypatch):
 def test_login_failure(client, monkeypatch):
     """Test the /login endpoint with invalid credentials."""
 
-    def mock_find_one(_query):
+    def mock_find_one(_query, _projection=None):
         return {
             "username": "testuser",
             "password": bcrypt.hashpw("testpass".encode("utf-8"), bcrypt.gensalt()),
@@ -59,16 +80,77 @@ def test_login_failure(client, monkeypatch):
     assert b"Invalid username or password" in response.data
 
 
+def test_login_rehashes_outdated_hash(client, monkeypatch):
+    """Test that logging in upgrades a hash made with another work factor."""
+    old_hash = bcrypt.hashpw(b"testpass", bcrypt.gensalt(4))
+    updates = []
+    stored = threading.Event()
+
+    def mock_update_one(query, update):
+        updates.append((query, update))
+        stored.set()
+
+    monkeypatch.setattr("web_app.web_app.password_hasher", PasswordHasher(5, 1))
+    monkeypatch.setattr(
+        "web_app.web_app.users_collection.find_one",
+        lambda _query, _projection=None: {"password": old_hash},
+    )
+    monkeypatch.setattr("web_app.web_app.users_collection.update_one", mock_update_one)
+
+    response = client.post(
+        "/login", data={"username": "testuser", "password": "testpass"}
+    )
+    assert response.status_code == 302
+    assert stored.wait(10)
+    query, update = updates[0]
+    assert query == {"username": "testuser", "password": old_hash}
+    new_hash = update["$set"]["password"]
+    assert new_hash.startswith(b"$2b$05$")
+    assert bcrypt.checkpw(b"testpass", new_hash)
+
+
+def test_ensure_indexes_isolates_and_retries_failures(monkeypatch):
+    """Test that a failing index neither skips the others nor stays missing."""
+    created = []
+    failures = [OperationFailure("not primary")]
+    done = threading.Event()
+
+    def flaky():
+        if failures:
+            raise failures.pop()
+        created.append("users")
+        done.set()
+
+    monkeypatch.setattr(
+        "web_app.web_app.index_steps",
+        lambda: [
+            ("history", lambda: created.append("history")),
+            ("users", flaky),
+            ("history_rollups", lambda: created.append("history_rollups")),
+        ],
+    )
+    monkeypatch.setattr("web_app.web_app.INDEX_RETRY_INTERVAL", 0)
+
+    assert not ensure_indexes()
+    assert done.wait(5)
+    assert created == ["history", "history_rollups", "users"]
+
+
+def username_index(monkeypatch, ready):
+    """Mark the unique username index as created or not."""
+    event = threading.Event()
+    if ready:
+        event.set()
+    monkeypatch.setattr("web_app.web_app.USERNAME_INDEX", event)
+
+
 def test_register_new_user(client, monkeypatch):
     """Test the /register endpoint with a new user."""
 
-    def mock_find_one(_query):
-        return None
-
     def mock_insert_one(_document):
         pass
 
-    monkeypatch.setattr("web_app.web_app.users_collection.find_one", mock_find_one)
+    username_index(monkeypatch, True)
     monkeypatch.setattr("web_app.web_app.users_collection.insert_one", mock_insert_one)
 
     response = client.post(
@@ -83,10 +165,11 @@ def test_register_new_user(client, monkeypatch):
 def test_register_existing_user(client, monkeypatch):
     """Test the /register endpoint with an existing user."""
 
-    def mock_find_one(_query):
-        return {"username": "existinguser"}
+    def mock_insert_one(_document):
+        raise DuplicateKeyError("E11000 duplicate key error")
 
-    monkeypatch.setattr("web_app.web_app.users_collection.find_one", mock_find_one)
+    username_index(monkeypatch, True)
+    monkeypatch.setattr("web_app.web_app.users_collection.insert_one", mock_insert_one)
 
     response = client.post(
         "/register",
@@ -97,6 +180,58 @@ def test_register_existing_user(client, monkeypatch):
     assert b"Username already exists" in response.data
 
 
+def test_register_waits_for_username_index(client, monkeypatch):
+    """Test that sign-ups are refused while usernames are not unique-indexed."""
+    inserted = []
+    attempts = []
+
+    def mock_create_index(*args, **kwargs):
+        attempts.append((args, kwargs))
+        if len(attempts) == 1:
+            raise OperationFailure("E11000 duplicate key error: username")
+
+    username_index(monkeypatch, False)
+    monkeypatch.setattr(
+        "web_app.web_app.users_collection.create_index", mock_create_index
+    )
+    monkeypatch.setattr("web_app.web_app.users_collection.insert_one", inserted.append)
+
+    form = {"username": "newuser", "password": "newpass"}
+    response = client.post("/register", data=form)
+    assert response.status_code == 503
+    assert b"temporarily unavailable" in response.data
+    assert not inserted
+
+    response = client.post("/register", data=form)
+    assert response.status_code == 302
+    assert len(inserted) == 1
+    assert attempts[-1] == (("username",), {"unique": True})
+
+
+def test_serve_image_caching(client, monkeypatch):
+    """Test ETag revalidation and immutable caching of versioned images."""
+    entry = CatalogEntry(__file__, "image/jpeg", 5, "abc123", "v1")
+    monkeypatch.setattr(
+        "web_app.web_app.image_catalog.get",
+        lambda filename: entry if filename == "harry.thumb.jpg" else None,
+    )
+
+    response = client.get("/images/harry.thumb.jpg?v=v1")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"abc123"'
+    assert "immutable" in response.headers["Cache-Control"]
+    response.close()
+
+    response = client.get(
+        "/images/harry.thumb.jpg", headers={"If-None-Match": '"abc123"'}
+    )
+    assert response.status_code == 304
+    assert response.data == b""
+    assert "no-cache" in response.headers["Cache-Control"]
+
+    assert client.get("/images/ron.jpg").status_code == 404
+
+
 def test_logout(client):
     """Test the /logout endpoint."""
     with client.session_transaction() as session:
@@ -114,6 +249,45 @@ def test_homepage_redirect_without_login(client):
     assert b"login" in response.data
 
 
+def test_homepage_live_mode(client, monkeypatch):
+    """Test that the live mode button is configured from LIVE_URL."""
+    monkeypatch.setattr("web_app.web_app.character_images", dict)
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    monkeypatch.setattr("web_app.web_app.LIVE_URL", "")
+    page = client.get("/homepage").get_data(as_text=True)
+    assert '"url": ""' in page
+
+    monkeypatch.setattr("web_app.web_app.LIVE_URL", "ws://localhost:5000/live")
+    page = client.get("/homepage").get_data(as_text=True)
+    assert '"url": ""' in page
+
+    monkeypatch.setattr("web_app.web_app.LIVE_TOKEN_SECRET", "secret")
+    page = client.get("/homepage").get_data(as_text=True)
+    assert '"url": "ws://localhost:5000/live"' in page
+    assert 'id="live"' in page
+
+
+def test_live_token_requires_login(client, monkeypatch):
+    """Test that /live tokens are only issued to logged-in users."""
+    monkeypatch.setattr("web_app.web_app.LIVE_URL", "ws://localhost:5000/live")
+    monkeypatch.setattr("web_app.web_app.LIVE_TOKEN_SECRET", "")
+    assert client.get("/live/token").status_code == 401
+
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+    assert client.get("/live/token").status_code == 404
+
+    monkeypatch.setattr("web_app.web_app.LIVE_TOKEN_SECRET", "secret")
+    response = client.get("/live/token")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-store"
+    user, expires, _signature = response.get_json()["token"].split(".")
+    assert base64.urlsafe_b64decode(user) == b"testuser"
+    assert int(expires) > time.time()
+
+
 def test_capture_photo_without_image_data(client):
     """Test the /capture endpoint without providing image data."""
     with client.session_transaction() as session:
@@ -144,7 +318,7 @@ def test_capture_timeout(client, monkeypatch):
     def mock_post(*args, **kwargs):
         raise requests.exceptions.Timeout("The request timed out.")
 
-    monkeypatch.setattr("requests.post", mock_post)
+    monkeypatch.setattr("requests.Session.post", mock_post)
 
     with client.session_transaction() as session:
         session["username"] = "testuser"
@@ -155,8 +329,468 @@ def test_capture_timeout(client, monkeypatch):
     assert response.get_json() == {"error": "Failed to process image"}
 
 
+def test_capture_streams_upload(client, monkeypatch):
+    """Test that /capture forwards the upload as a stream and records the match."""
+    sent = {}
+    recorded = []
+
+    def mock_post(_session, url, **kwargs):
+        sent["url"] = url
+        # Kept in memory rather than in a spooled file that rolls over to
+        # disk when requests asks for its fileno().
+        assert isinstance(kwargs["data"], io.BytesIO)
+        sent["body"] = kwargs["data"].read()
+        sent["content_length"] = kwargs["headers"]["Content-Length"]
+        sent["content_type"] = kwargs["headers"]["Content-Type"]
+        sent["request_id"] = kwargs["headers"]["X-Request-ID"]
+        sent["params"] = kwargs["params"]
+        return SimpleNamespace(
+            status_code=200,
+            raise_for_status=lambda: None,
+            json=lambda: {
+                "matched_character": "harry",
+                "encoding": base64.b64encode(b"\0" * 512).decode(),
+            },
+        )
+
+    monkeypatch.setattr("requests.Session.post", mock_post)
+    monkeypatch.setattr(
+        "web_app.web_app.capture_recorder.record",
+        lambda *args: recorded.append(args[:2] + args[3:]),
+    )
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    data = {"image": (io.BytesIO(b"jpeg bytes"), "capture.jpg", "image/jpeg")}
+    response = client.post(
+        "/capture",
+        data=data,
+        content_type="multipart/form-data",
+        headers={"X-Request-ID": "trace-1"},
+    )
+    assert response.get_json() == {"match": "harry"}
+    assert response.headers["X-Request-ID"] == "trace-1"
+    assert sent == {
+        "url": "http://ml-client:5000/recognize_face",
+        "body": b"jpeg bytes",
+        "content_length": "10",
+        "content_type": "image/jpeg",
+        "request_id": "trace-1",
+        "params": {"include_encoding": "1"},
+    }
+    assert recorded == [("testuser", "harry", b"\0" * 512)]
+
+    metrics = client.get("/metrics").data.decode()
+    assert 'web_stage_duration_seconds_count{stage="ml_call"}' in metrics
+    assert 'endpoint="/capture"' in metrics
+    assert "web_ml_circuit_open 0.0" in metrics
+
+
+@pytest.mark.parametrize("memory_limit, in_memory", [(1024, True), (4, False)])
+def test_capture_upload_is_not_rolled_over(
+    client, monkeypatch, memory_limit, in_memory
+):
+    """Test that small uploads reach requests' adapter still in memory."""
+    sent = {}
+
+    def mock_send(_adapter, prepared, **_kwargs):
+        sent["in_memory"] = isinstance(prepared.body, io.BytesIO)
+        sent["content_length"] = prepared.headers["Content-Length"]
+        sent["body"] = prepared.body.read()
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = io.BytesIO(b'{"matched_character": "harry"}')
+        return response
+
+    monkeypatch.setattr("web_app.web_app.UPLOAD_MEMORY_BYTES", memory_limit)
+    monkeypatch.setattr("requests.adapters.HTTPAdapter.send", mock_send)
+    monkeypatch.setattr("web_app.web_app.capture_recorder.record", lambda *args: None)
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    data = {"image": (io.BytesIO(b"jpeg bytes"), "capture.jpg", "image/jpeg")}
+    response = client.post("/capture", data=data, content_type="multipart/form-data")
+    assert response.get_json() == {"match": "harry"}
+    assert sent == {
+        "in_memory": in_memory,
+        "content_length": "10",
+        "body": b"jpeg bytes",
+    }
+
+
+def test_mongo_command_timer():
+    """Test that MongoDB commands are timed per command and collection."""
+    timer = MongoCommandTimer()
+    timer.started(
+        SimpleNamespace(command_name="find", command={"find": "history"}, request_id=7)
+    )
+    timer.succeeded(
+        SimpleNamespace(command_name="find", request_id=7, duration_micros=1500)
+    )
+    samples = client_metrics()
+    assert (
+        'web_mongo_command_duration_seconds_count{collection="history",'
+        'command="find",outcome="success"}' in samples
+    )
+
+
+def test_capture_too_large(client, monkeypatch):
+    """Test that uploads over the size limit are rejected with JSON."""
+    monkeypatch.setitem(app.config, "MAX_CONTENT_LENGTH", 100)
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    data = {"image": (io.BytesIO(b"x" * 200), "capture.jpg")}
+    response = client.post("/capture", data=data, content_type="multipart/form-data")
+    assert response.status_code == 413
+    assert "upload limit" in response.get_json()["error"]
+
+
 def test_history_unauthorized(client):
     """Test the /history endpoint without authentication."""
     response = client.get("/history")
     assert response.status_code == 401
     assert response.get_json() == {"error": "Unauthorized"}
+
+
+def test_capture_circuit_open(client, monkeypatch):
+    """Test that /capture fails fast once the ML service keeps failing."""
+    calls = []
+
+    def mock_post(*args, **_kwargs):
+        calls.append(args)
+        raise requests.exceptions.ConnectionError("Connection refused")
+
+    monkeypatch.setattr("requests.Session.post", mock_post)
+
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    statuses = []
+    for _ in range(7):
+        data = {"image": (io.BytesIO(b"fake_image_data"), "image.jpg")}
+        response = client.post(
+            "/capture", data=data, content_type="multipart/form-data"
+        )
+        statuses.append(response.status_code)
+
+    assert statuses == [500] * 5 + [503] * 2
+    assert len(calls) == 5
+    assert response.get_json()["degraded"] is True
+    assert response.headers["Retry-After"] == "30"
+
+
+class FakeCursor:
+    """Cursor stand-in recording how the query was refined."""
+
+    def __init__(self, records, calls):
+        self.records = records
+        self.calls = calls
+
+    def sort(self, *keys):
+        """Record the sort order."""
+        self.calls["sort"] = keys
+        return self
+
+    def limit(self, limit):
+        """Record the limit and apply it."""
+        self.calls["limit"] = limit
+        self.records = self.records[:limit]
+        return self
+
+    def batch_size(self, size):
+        """Record the batch size."""
+        self.calls["batch_size"] = size
+        return self
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+class FakeDatabase(SimpleNamespace):  # pylint: disable=too-few-public-methods
+    """Database stand-in whose collections are attributes and items."""
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+def fake_collection(records, calls):
+    """Return a collection stand-in whose find records the query."""
+
+    def find(query, projection):
+        calls["query"] = query
+        calls["projection"] = projection
+        return FakeCursor(records, calls)
+
+    return SimpleNamespace(find=find)
+
+
+def mock_history(monkeypatch, records, rollups=()):
+    """
+    Serve history records and rollups from fake collections and record the
+    queries; those of the rollups under ``calls["rollups"]``.
+    """
+    calls = {"rollups": {}}
+    db = FakeDatabase(
+        **{
+            "history": fake_collection(records, calls),
+            ROLLUPS: fake_collection(list(rollups), calls["rollups"]),
+        }
+    )
+    monkeypatch.setattr("web_app.web_app.db", db)
+    return calls
+
+
+def history_records(count):
+    """Return history documents one minute apart, newest first."""
+    return [
+        {
+            "_id": ObjectId(),
+            "matched_character": "harry",
+            "timestamp": datetime(2024, 11, 1, 12, 0) - timedelta(minutes=i),
+        }
+        for i in range(count)
+    ]
+
+
+def test_capture_job_mode(client, monkeypatch):
+    """Test that job mode queues the capture and reports it when finished."""
+    queued = []
+    job = {"_id": ObjectId(), "username": "testuser", "status": "queued"}
+
+    def mock_enqueue(username, image, content_type, _timestamp, _trace_id):
+        queued.append((username, image, content_type))
+        return str(job["_id"])
+
+    monkeypatch.setattr("web_app.web_app.CAPTURE_JOBS", True)
+    monkeypatch.setattr("web_app.web_app.CAPTURE_EVENTS_POLL", 0)
+    monkeypatch.setattr("web_app.web_app.capture_jobs.enqueue", mock_enqueue)
+    monkeypatch.setattr(
+        "web_app.web_app.capture_jobs.get",
+        lambda job_id, username: job if job_id == str(job["_id"]) else None,
+    )
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    data = {"image": (io.BytesIO(b"jpeg bytes"), "capture.jpg", "image/jpeg")}
+    response = client.post("/capture", data=data, content_type="multipart/form-data")
+    body = response.get_json()
+    assert response.status_code == 202
+    assert queued == [("testuser", b"jpeg bytes", "image/jpeg")]
+    assert body["status_url"] == f"/capture/{job['_id']}"
+    assert client.get(body["status_url"]).get_json() == {"status": "queued"}
+    assert client.get(f"/capture/{ObjectId()}").status_code == 404
+
+    job.update(status="done", result={"match": "harry"})
+    response = client.get(body["events_url"])
+    assert response.mimetype == "text/event-stream"
+    assert response.get_data(as_text=True) == (
+        'event: result\ndata: {"match": "harry", "status": "done"}\n\n'
+    )
+
+
+def test_capture_job_events_are_capped(client, monkeypatch):
+    """Test that streams beyond the cap are refused and slots are released."""
+    job = {"_id": ObjectId(), "username": "testuser", "status": "running"}
+    streams = threading.BoundedSemaphore(1)
+    monkeypatch.setattr("web_app.web_app.CAPTURE_EVENT_STREAMS", streams)
+    monkeypatch.setattr("web_app.web_app.CAPTURE_EVENTS_TIMEOUT", 0)
+    monkeypatch.setattr("web_app.web_app.capture_jobs.get", lambda *_args: job)
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+    url = f"/capture/{job['_id']}/events"
+
+    with streams:
+        assert client.get(url).status_code == 503
+
+    for _ in range(2):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert "event: timeout" in response.get_data(as_text=True)
+        response.close()
+
+
+def test_history_rescore(client, monkeypatch):
+    """Test that stored encodings are matched again without their images."""
+    records = history_records(3)
+    records[0]["encoding"] = b"\1" * 512
+    records[2]["encoding"] = b"\2" * 512
+    calls = mock_history(monkeypatch, records)
+    sent = {}
+
+    def mock_post(_session, url, **kwargs):
+        sent["url"] = url
+        sent["json"] = kwargs["json"]
+        return SimpleNamespace(
+            status_code=200,
+            raise_for_status=lambda: None,
+            json=lambda: {
+                "results": [
+                    {"matched_character": "ron", "distance": 0.3},
+                    {"matched_character": "harry", "distance": 0.5},
+                ]
+            },
+        )
+
+    monkeypatch.setattr("requests.Session.post", mock_post)
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    response = client.post("/history/rescore?limit=3")
+    entries = response.get_json()["history"]
+    assert response.status_code == 200
+    assert calls["projection"]["encoding"] == 1
+    assert sent["url"] == "http://ml-client:5000/match"
+    assert sent["json"] == {
+        "encodings": [
+            base64.b64encode(b"\1" * 512).decode(),
+            base64.b64encode(b"\2" * 512).decode(),
+        ]
+    }
+    assert [(entry["character"], entry["current"]) for entry in entries] == [
+        ("harry", "ron"),
+        ("harry", None),
+        ("harry", "harry"),
+    ]
+    assert entries[0]["distance"] == 0.3
+
+
+def test_history_pagination(client, monkeypatch):
+    """Test that /history returns one page and a cursor for the next."""
+    records = history_records(5)
+    calls = mock_history(monkeypatch, records)
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    response = client.get("/history?limit=2")
+    body = response.get_json()
+    assert response.status_code == 200
+    assert body["history"] == [
+        {"character": "harry", "timestamp": "2024-11-01 08:00:00"},
+        {"character": "harry", "timestamp": "2024-11-01 07:59:00"},
+    ]
+    assert body["next_before"] == "2024-11-01T11:59:00"
+    assert body["next_before_id"] == str(records[1]["_id"])
+    assert calls["query"] == {"username": "testuser"}
+    assert calls["projection"] == {"matched_character": 1, "timestamp": 1}
+    assert calls["limit"] == 2
+
+    client.get(
+        f"/history?limit=2&before={body['next_before']}"
+        f"&before_id={body['next_before_id']}"
+    )
+    before = datetime(2024, 11, 1, 11, 59, tzinfo=timezone.utc)
+    assert calls["query"] == {
+        "username": "testuser",
+        "$or": [
+            {"timestamp": {"$lt": before}},
+            {"timestamp": before, "_id": {"$lt": records[1]["_id"]}},
+        ],
+    }
+
+
+def test_history_last_page_and_bad_cursor(client, monkeypatch):
+    """Test that the last page has no cursor and bad cursors are rejected."""
+    mock_history(monkeypatch, history_records(1))
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    body = client.get("/history").get_json()
+    assert len(body["history"]) == 1
+    assert "next_before" not in body
+
+    response = client.get("/history?before=yesterday")
+    assert response.status_code == 400
+
+
+def test_history_continues_into_rollups(client, monkeypatch):
+    """Test that a page is filled up with daily rollups of older captures."""
+    rollups = [
+        {
+            "_id": ObjectId(),
+            "matched_character": "ron",
+            "timestamp": datetime(2024, 8, 1),
+            "count": 4,
+        }
+    ]
+    calls = mock_history(monkeypatch, history_records(2), rollups)
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    body = client.get("/history?limit=5").get_json()
+    assert body["history"][2] == {
+        "character": "ron",
+        "timestamp": "2024-08-01",
+        "count": 4,
+    }
+    assert len(body["history"]) == 3
+    assert calls["rollups"]["limit"] == 3
+    assert calls["rollups"]["projection"]["count"] == 1
+    assert calls["rollups"]["query"] == {"username": "testuser"}
+
+
+def test_history_export_streams_everything(client, monkeypatch):
+    """Test that /history/export streams every record as one JSON document."""
+    calls = mock_history(monkeypatch, history_records(3))
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    response = client.get("/history/export")
+    assert response.status_code == 200
+    assert "attachment" in response.headers["Content-Disposition"]
+    assert len(json.loads(response.data)["history"]) == 3
+    assert "limit" not in calls
+
+
+def test_analytics_global_scope(client, monkeypatch):
+    """Test that /analytics?scope=global serves the cached global distribution."""
+    monkeypatch.setattr(
+        "web_app.web_app.global_distribution.get",
+        lambda: [{"character": "harry", "percentage": 100.0}],
+    )
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    response = client.get("/analytics?scope=global")
+    assert response.get_json() == {
+        "data": [{"character": "harry", "percentage": 100.0}]
+    }
+    assert client.get("/analytics?scope=everyone").status_code == 400
+
+
+def test_analytics_daily_buckets(client, monkeypatch):
+    """Test that /analytics?period=day reads the user's recent day buckets."""
+    calls = {}
+
+    def find(query):
+        calls["query"] = query
+        return FakeCursor(
+            [
+                {
+                    "_id": {**query_id, "start": datetime(2024, 11, 1)},
+                    "total": 2,
+                    "characters": {"harry": 2},
+                }
+            ],
+            calls,
+        )
+
+    query_id = {"scope": "testuser", "period": "day"}
+    monkeypatch.setattr(
+        "web_app.web_app.db", {"analytics_buckets": SimpleNamespace(find=find)}
+    )
+    with client.session_transaction() as session:
+        session["username"] = "testuser"
+
+    response = client.get("/analytics?period=day&limit=3")
+    assert response.get_json() == {
+        "buckets": [
+            {
+                "start": "2024-11-01",
+                "total": 2,
+                "data": [{"character": "harry", "percentage": 100.0}],
+            }
+        ]
+    }
+    assert calls["query"] == {"_id.scope": "testuser", "_id.period": "day"}
+    assert calls["limit"] == 3
@@ -2,8 +2,15 @@
 This is the updated web application code.
 """
 
+import io
 import os
+import json
+import time
+import base64
+import binascii
 import logging
+import tempfile
+import threading
 from datetime import datetime, timezone
 import pytz
 
@@ -16,43 +23,271 @@ from flask import (
     flash,
     session,
     jsonify,
-    send_from_directory,
     abort,
+    Request,
+    Response,
+    stream_with_context,
 )
-from pymongo import MongoClient
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from dotenv import load_dotenv
 
-import bcrypt
 import requests
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+
+try:
+    from .auth import PasswordHasher, live_token
+    from .capture_jobs import FINISHED, QUEUED, CaptureJobQueue, CaptureWorkers
+    from .capture_jobs import job_status
+    from .image_catalog import ImageCatalog
+    from .ml_service import CircuitBreaker, CircuitOpen, MLServiceClient
+    from .capture_store import CaptureRecorder, WriteBehindRecorder
+    from .history_store import HistoryRetention, history_page, iter_history
+    from .metrics import CIRCUIT_OPEN, PENDING_WRITES, STAGE_LATENCY
+    from .metrics import MongoCommandTimer, instrument, request_id
+    from .analytics_store import (
+        BUCKETS,
+        GLOBAL_SCOPE,
+        GlobalDistributionCache,
+        bucket_series,
+        distribution,
+        rebuild_buckets,
+    )
+except ImportError:
+    from auth import PasswordHasher, live_token
+    from capture_jobs import FINISHED, QUEUED, CaptureJobQueue, CaptureWorkers
+    from capture_jobs import job_status
+    from image_catalog import ImageCatalog
+    from ml_service import CircuitBreaker, CircuitOpen, MLServiceClient
+    from capture_store import CaptureRecorder, WriteBehindRecorder
+    from history_store import HistoryRetention, history_page, iter_history
+    from metrics import CIRCUIT_OPEN, PENDING_WRITES, STAGE_LATENCY
+    from metrics import MongoCommandTimer, instrument, request_id
+    from analytics_store import (
+        BUCKETS,
+        GLOBAL_SCOPE,
+        GlobalDistributionCache,
+        bucket_series,
+        distribution,
+        rebuild_buckets,
+    )
 
 load_dotenv()
 
+# Requests up to this size keep their uploads in memory; larger ones are
+# spooled to a temporary file.
+UPLOAD_MEMORY_BYTES = int(os.getenv("UPLOAD_MEMORY_BYTES", str(1024 * 1024)))
+
+
+class UploadRequest(Request):
+    """
+    Request storing each upload either in memory or on disk from the start.
+    Werkzeug's default SpooledTemporaryFile rolls over to disk as soon as
+    anything asks for its fileno(), which requests does to size a body, so
+    forwarding a small upload would still write it to a temporary file.
+    """
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        if total_content_length is not None and (
+            total_content_length <= UPLOAD_MEMORY_BYTES
+        ):
+            return io.BytesIO()
+        return tempfile.TemporaryFile("rb+")
+
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.secret_key = os.getenv("SECRET_KEY", "SECRET_KEY")
 app.config["SESSION_PERMANENT"] = False
+# Uploads larger than this are rejected from their Content-Length header,
+# before any of the body is read.
+app.config["MAX_CONTENT_LENGTH"] = int(
+    os.getenv("MAX_UPLOAD_BYTES", str(8 * 1024 * 1024))
+)
+# Captures are downscaled and re-encoded in the browser before upload;
+# a quality of 0 sends lossless PNG instead of JPEG.
+CAPTURE_MAX_SIDE = int(os.getenv("CAPTURE_MAX_SIDE", "1024"))
+CAPTURE_JPEG_QUALITY = float(os.getenv("CAPTURE_JPEG_QUALITY", "0.85"))
+# Live mode streams webcam frames straight to the ML service's /live
+# WebSocket at this URL, as seen from the browser; empty disables it. The
+# browser first fetches a token signed with LIVE_TOKEN_SECRET, shared with
+# the ML service, and valid for LIVE_TOKEN_TTL seconds; live mode also
+# stays off without a secret.
+LIVE_URL = os.getenv("LIVE_URL", "")
+LIVE_TOKEN_SECRET = os.getenv("LIVE_TOKEN_SECRET", "")
+LIVE_TOKEN_TTL = float(os.getenv("LIVE_TOKEN_TTL", "30"))
+LIVE_MAX_SIDE = int(os.getenv("LIVE_MAX_SIDE", "480"))
+LIVE_FPS = float(os.getenv("LIVE_FPS", "10"))
+
+# Character images, and the thumbnails and WebP copies generated from them.
+# Versioned image URLs are cached by browsers for a year.
+IMAGES_DIR = os.getenv("IMAGES_DIR", "/app/images")
+IMAGE_VARIANTS_DIR = os.getenv(
+    "IMAGE_VARIANTS_DIR", os.path.join(tempfile.gettempdir(), "image-variants")
+)
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "480"))
+IMAGE_INDEX_TTL = float(os.getenv("IMAGE_INDEX_TTL", "300"))
+IMAGE_MAX_AGE = 365 * 24 * 3600
+image_catalog = ImageCatalog(
+    IMAGES_DIR, IMAGE_VARIANTS_DIR, THUMBNAIL_SIZE, IMAGE_INDEX_TTL
+)
 
 mongo_uri = os.getenv("MONGO_URI", "mongodb://mongodb:27017/")
-client = MongoClient(mongo_uri)
+client = MongoClient(mongo_uri, event_listeners=[MongoCommandTimer()])
 db = client["harryface"]
 users_collection = db["users"]
 
-ml_client_url = "http://ml-client:5000"
+# bcrypt work factor for new hashes; existing hashes with another factor are
+# replaced on their next login. At most BCRYPT_WORKERS hashes run at once.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", "2"))
+password_hasher = PasswordHasher(BCRYPT_ROUNDS, BCRYPT_WORKERS)
+
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "500"))
+HISTORY_EXPORT_BATCH = 1000
+HISTORY_PROJECTION = {"matched_character": 1, "timestamp": 1}
+# Raw captures are kept HISTORY_RETENTION_DAYS days (0 keeps them forever);
+# every HISTORY_ROLLUP_INTERVAL seconds older ones are compacted into daily
+# per-character counts.
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "0"))
+HISTORY_ROLLUP_INTERVAL = float(os.getenv("HISTORY_ROLLUP_INTERVAL", "3600"))
+history_retention = HistoryRetention(
+    db, HISTORY_RETENTION_DAYS, HISTORY_ROLLUP_INTERVAL
+)
+
+# Seconds before indexes that failed on startup are created again, doubling
+# up to INDEX_RETRY_MAX_INTERVAL.
+INDEX_RETRY_INTERVAL = float(os.getenv("INDEX_RETRY_INTERVAL", "5"))
+INDEX_RETRY_MAX_INTERVAL = float(os.getenv("INDEX_RETRY_MAX_INTERVAL", "300"))
+# Set once the unique index on usernames is known to exist.
+USERNAME_INDEX = threading.Event()
+
+# Seconds between batched analytics/history writes; 0 writes every capture
+# immediately.
+WRITE_BEHIND_INTERVAL = float(os.getenv("WRITE_BEHIND_INTERVAL", "0"))
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "500"))
+# Captures held in memory for retrying while MongoDB writes fail.
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "10000"))
+capture_recorder = (
+    WriteBehindRecorder(
+        db, WRITE_BEHIND_BATCH, WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_PENDING
+    )
+    if WRITE_BEHIND_INTERVAL > 0
+    else CaptureRecorder(db)
+)
+
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "10"))
+ANALYTICS_MAX_BUCKETS = int(os.getenv("ANALYTICS_MAX_BUCKETS", "90"))
+global_distribution = GlobalDistributionCache(db, ANALYTICS_CACHE_TTL)
+
+ml_client_url = os.getenv("ML_CLIENT_URL", "http://ml-client:5000")
+ML_CONNECT_TIMEOUT = float(os.getenv("ML_CONNECT_TIMEOUT", "2"))
+ML_READ_TIMEOUT = float(os.getenv("ML_READ_TIMEOUT", "20"))
+ML_RETRIES = int(os.getenv("ML_RETRIES", "2"))
+ML_POOL_SIZE = int(os.getenv("ML_POOL_SIZE", "10"))
+ML_BREAKER_FAILURES = int(os.getenv("ML_BREAKER_FAILURES", "5"))
+ML_BREAKER_RESET = float(os.getenv("ML_BREAKER_RESET", "30"))
+ML_RETRY_AFTER = str(int(ML_BREAKER_RESET))
+# Keep each capture's face encoding in its history record so it can be
+# matched again against a changed gallery without the image.
+STORE_ENCODINGS = os.getenv("STORE_ENCODINGS", "1") == "1"
+
+# With CAPTURE_JOBS=1 /capture queues captures in MongoDB and answers at
+# once; CAPTURE_WORKERS consumer threads per process recognize them, or
+# `flask capture-worker` runs consumers in a process of their own.
+CAPTURE_JOBS = os.getenv("CAPTURE_JOBS", "0") == "1"
+CAPTURE_WORKERS = int(os.getenv("CAPTURE_WORKERS", "4"))
+CAPTURE_POLL_INTERVAL = float(os.getenv("CAPTURE_POLL_INTERVAL", "0.5"))
+# Each event stream holds a server thread, so at most
+# CAPTURE_EVENTS_MAX_STREAMS are open per process and each lasts at most
+# CAPTURE_EVENTS_TIMEOUT seconds; other clients poll /capture/<job_id>.
+# Streams check their job every CAPTURE_EVENTS_POLL seconds, backing off to
+# CAPTURE_EVENTS_MAX_POLL while it is pending.
+CAPTURE_EVENTS_POLL = float(os.getenv("CAPTURE_EVENTS_POLL", "0.25"))
+CAPTURE_EVENTS_MAX_POLL = float(os.getenv("CAPTURE_EVENTS_MAX_POLL", "2"))
+CAPTURE_EVENTS_TIMEOUT = float(os.getenv("CAPTURE_EVENTS_TIMEOUT", "20"))
+CAPTURE_EVENTS_MAX_STREAMS = int(os.getenv("CAPTURE_EVENTS_MAX_STREAMS", "8"))
+CAPTURE_EVENT_STREAMS = threading.BoundedSemaphore(CAPTURE_EVENTS_MAX_STREAMS)
+capture_jobs = CaptureJobQueue(
+    db["capture_jobs"],
+    lease=float(os.getenv("CAPTURE_JOB_LEASE", "60")),
+    max_attempts=int(os.getenv("CAPTURE_JOB_ATTEMPTS", "5")),
+    ttl=float(os.getenv("CAPTURE_JOB_TTL", "3600")),
+)
 
-logging.basicConfig(level=logging.INFO)
+ml_service = MLServiceClient(
+    ml_client_url,
+    connect_timeout=ML_CONNECT_TIMEOUT,
+    read_timeout=ML_READ_TIMEOUT,
+    retries=ML_RETRIES,
+    pool_size=ML_POOL_SIZE,
+    breaker=CircuitBreaker(ML_BREAKER_FAILURES, ML_BREAKER_RESET),
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(levelname)s:%(name)s:[%(request_id)s] %(message)s"
+)
+
+
+def refresh_gauges():
+    """Update the gauges that are read rather than counted."""
+    CIRCUIT_OPEN.set(ml_service.breaker.state != "closed")
+    PENDING_WRITES.set(capture_recorder.pending)
+
+
+instrument(app, refresh_gauges)
 
 
 @app.route("/images/<filename>")
 def serve_image(filename):
-    """Serve images from the /images directory."""
-    safe_filename = secure_filename(filename)
-    image_directory = "/app/images"
+    """
+    Serve a character image or one of its variants from the image catalog.
+    ``harry.jpg`` is the original; ``harry.webp``, ``harry.thumb.jpg`` and
+    ``harry.thumb.webp`` are generated from it. With a ``v`` parameter
+    matching the image's version the response may be cached indefinitely;
+    otherwise clients revalidate it with its ETag.
+    """
+    entry = image_catalog.get(filename)
+    if entry is None:
+        abort(404)
+    if request.if_none_match.contains(entry.etag):
+        response = Response(status=304)
+    else:
+        try:
+            body = open(entry.path, "rb")  # pylint: disable=consider-using-with
+        except OSError:
+            abort(404)
+        response = Response(
+            wrap_file(request.environ, body),
+            mimetype=entry.mimetype,
+            direct_passthrough=True,
+        )
+        response.content_length = entry.size
+    response.set_etag(entry.etag)
+    response.cache_control.public = True
+    if request.args.get("v") == entry.version:
+        response.cache_control.max_age = IMAGE_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
-    file_path = os.path.join(image_directory, safe_filename)
 
-    if os.path.isfile(file_path):
-        return send_from_directory(image_directory, safe_filename)
-    abort(404)
+def character_images():
+    """Return versioned JPEG and WebP thumbnail URLs of every character."""
+    return {
+        character: {
+            kind: url_for("serve_image", filename=filename, v=version)
+            for kind, (filename, version) in kinds.items()
+        }
+        for character, kinds in image_catalog.thumbnails().items()
+    }
 
 
 @app.route("/")
@@ -70,8 +305,12 @@ def login():
         username = request.form["username"]
         password = request.form["password"].encode("utf-8")
 
-        user = users_collection.find_one({"username": username})
-        if user and bcrypt.checkpw(password, user["password"]):
+        user = users_collection.find_one({"username": username}, {"password": 1})
+        if user and password_hasher.check(password, user["password"]):
+            if password_hasher.needs_rehash(user["password"]):
+                password_hasher.rehash_later(
+                    users_collection, username, password, user["password"]
+                )
             session["username"] = username
             session.permanent = False
             return redirect(url_for("homepage"))
@@ -87,13 +326,19 @@ def register():
         username = request.form["username"]
         password = request.form["password"].encode("utf-8")
 
-        if users_collection.find_one({"username": username}):
-            flash("Username already exists. Please choose a different one.")
-        else:
-            hashed_password = bcrypt.hashpw(password, bcrypt.gensalt())
+        # The unique index on username rejects taken names, so concurrent
+        # sign-ups cannot both succeed and no lookup is needed first. Without
+        # it duplicates would be accepted silently, so wait for it.
+        if not username_index_ready():
+            flash("Registration is temporarily unavailable. Please try again.")
+            return render_template("register.html"), 503
+        try:
             users_collection.insert_one(
-                {"username": username, "password": hashed_password}
+                {"username": username, "password": password_hasher.hash(password)}
             )
+        except DuplicateKeyError:
+            flash("Username already exists. Please choose a different one.")
+        else:
             flash("Registration successful! Please log in.")
             return redirect(url_for("login"))
     return render_template("register.html")
@@ -111,121 +356,602 @@ def homepage():
     """Homepage for logged-in users."""
     if "username" not in session:
         return redirect(url_for("login"))
-    return render_template("homepage.html", username=session["username"])
+    return render_template(
+        "homepage.html",
+        username=session["username"],
+        capture_max_side=CAPTURE_MAX_SIDE,
+        capture_quality=CAPTURE_JPEG_QUALITY,
+        live={
+            "url": LIVE_URL if LIVE_TOKEN_SECRET else "",
+            "max_side": LIVE_MAX_SIDE,
+            "fps": LIVE_FPS,
+        },
+        character_images=character_images(),
+    )
 
 
-@app.route("/capture", methods=["POST"])
-def capture():
-    """Handle image capture and perform face matching."""
+@app.route("/live/token", methods=["GET"])
+def live_stream_token():
+    """Issue the logged-in user a short-lived token for the /live stream."""
     if "username" not in session:
         return jsonify({"error": "Unauthorized"}), 401
-
-    if "image" not in request.files:
-        return jsonify({"error": "No image uploaded"}), 400
-
-    image_file = request.files["image"]
-
+    if not (LIVE_URL and LIVE_TOKEN_SECRET):
+        return jsonify({"error": "Live mode is disabled"}), 404
+    token = live_token(LIVE_TOKEN_SECRET, session["username"], LIVE_TOKEN_TTL)
+    response = jsonify({"token": token})
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+
+@app.errorhandler(413)
+def upload_too_large(_error):
+    """Reject uploads over MAX_CONTENT_LENGTH with a JSON error."""
+    limit = app.config["MAX_CONTENT_LENGTH"]
+    return jsonify({"error": f"Image exceeds the {limit} byte upload limit"}), 413
+
+
+DEGRADED_BODY = {
+    "error": "Face recognition is temporarily unavailable",
+    "degraded": True,
+}
+
+
+def degraded_response(retry_after):
+    """
+    Build the response sent while the ML service is unavailable.
+    Args:
+        retry_after (str): Seconds the client should wait before retrying.
+    Returns:
+        tuple: A 503 JSON response with a Retry-After header.
+    """
+    return jsonify(DEGRADED_BODY), 503, {"Retry-After": retry_after}
+
+
+def recognize_capture(username, image, content_type, timestamp, trace_id):
+    """
+    Recognize a capture with the ML service and record the match.
+    Args:
+        username (str): The user who made the capture.
+        image: The image bytes or a seekable binary file object.
+        content_type (str): The image MIME type.
+        timestamp (datetime): When the capture was made.
+        trace_id (str): Request ID passed on to the ML service.
+    Returns:
+        tuple: The status code and JSON body for the client, and the
+        Retry-After seconds if the ML service is unavailable, else None.
+    """
     try:
-        response = requests.post(
-            f"{ml_client_url}/recognize_face",
-            files={
-                "file": (
-                    image_file.filename,
-                    image_file.read(),
-                    image_file.content_type,
-                )
-            },
-            timeout=20,
-        )
+        with STAGE_LATENCY.labels("ml_call").time():
+            response = ml_service.recognize(
+                image, content_type, trace_id, include_encoding=STORE_ENCODINGS
+            )
+        if response.status_code == 503:
+            app.logger.warning("ML service is saturated")
+            return 503, DEGRADED_BODY, response.headers.get("Retry-After", "1")
         response.raise_for_status()
+    except CircuitOpen:
+        app.logger.warning("ML service circuit open, skipping recognition")
+        return 503, DEGRADED_BODY, ML_RETRY_AFTER
     except requests.exceptions.RequestException as e:
         app.logger.error("Error communicating with ML service: %s", e)
-        return jsonify({"error": "Failed to process image"}), 500
+        return 500, {"error": "Failed to process image"}, None
 
     result = response.json()
     if "error" in result:
         app.logger.error("Error occurred: %s", result["error"])
-        return jsonify({"error": {"message": result["error"], "code": 400}}), 400
+        return 400, {"error": {"message": result["error"], "code": 400}}, None
 
     matched_character = result.get("matched_character", "No match found")
+    try:
+        encoding = base64.b64decode(result["encoding"], validate=True)
+    except (KeyError, TypeError, binascii.Error):
+        encoding = None
+
+    capture_recorder.record(username, matched_character, timestamp, encoding)
+    global_distribution.invalidate()
+    return 200, {"match": matched_character}, None
+
+
+def process_capture_job(job):
+    """Recognize and record a queued capture; run by the capture workers."""
+    return recognize_capture(
+        job["username"],
+        job["image"],
+        job["content_type"],
+        job["timestamp"],
+        job.get("request_id"),
+    )
 
-    user_analytics = db.analytics.find_one({"username": session["username"]})
-    if not user_analytics:
-        user_analytics = {"username": session["username"], "total": 0, "characters": {}}
 
-    user_analytics["total"] += 1
-    if matched_character in user_analytics["characters"]:
-        user_analytics["characters"][matched_character] += 1
-    else:
-        user_analytics["characters"][matched_character] = 1
+capture_workers = CaptureWorkers(
+    capture_jobs, process_capture_job, CAPTURE_WORKERS, CAPTURE_POLL_INTERVAL
+)
 
-    db.analytics.update_one(
-        {"username": session["username"]},
-        {"$set": user_analytics},
-        upsert=True,
-    )
 
-    db.history.insert_one(
-        {
-            "username": session["username"],
-            "matched_character": matched_character,
-            "timestamp": datetime.now(timezone.utc),
+@app.route("/capture", methods=["POST"])
+def capture():
+    """
+    Handle image capture and perform face matching.
+    With CAPTURE_JOBS enabled the image is queued instead and the response
+    is a 202 with the job's ID and the URLs of its status and its events.
+    """
+    if "username" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if "image" not in request.files:
+        return jsonify({"error": "No image uploaded"}), 400
+
+    image_file = request.files["image"]
+    timestamp = datetime.now(timezone.utc)
+
+    if CAPTURE_JOBS:
+        job_id = capture_jobs.enqueue(
+            session["username"],
+            image_file.read(),
+            image_file.mimetype,
+            timestamp,
+            request_id(),
+        )
+        status_url = url_for("capture_job", job_id=job_id)
+        body = {
+            "job_id": job_id,
+            "status": QUEUED,
+            "status_url": status_url,
+            "events_url": url_for("capture_job_events", job_id=job_id),
         }
+        return jsonify(body), 202, {"Location": status_url}
+
+    # Forward the upload, in memory or in its temporary file, as the request
+    # body instead of copying it and re-encoding it as multipart.
+    status, body, retry_after = recognize_capture(
+        session["username"],
+        image_file.stream,
+        image_file.mimetype,
+        timestamp,
+        request_id(),
+    )
+    if retry_after is not None:
+        return degraded_response(retry_after)
+    return jsonify(body), status
+
+
+@app.route("/capture/<job_id>", methods=["GET"])
+def capture_job(job_id):
+    """Report the status, and once finished the result, of a capture job."""
+    if "username" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    job = capture_jobs.get(job_id, session["username"])
+    if job is None:
+        return jsonify({"error": "Unknown capture job"}), 404
+    return jsonify(job_status(job))
+
+
+def server_sent_event(event, data):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/capture/<job_id>/events", methods=["GET"])
+def capture_job_events(job_id):
+    """
+    Stream the progress of a capture job as server-sent events.
+    A ``status`` event is sent whenever the job's status changes and a
+    ``result`` event, shaped like /capture/<job_id>, once it finishes. The
+    stream ends after CAPTURE_EVENTS_TIMEOUT seconds with a ``timeout``
+    event; the client can then poll /capture/<job_id>, as it must when all
+    CAPTURE_EVENTS_MAX_STREAMS streams are in use and this answers 503.
+    """
+    if "username" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
+    username = session["username"]
+    if capture_jobs.get(job_id, username) is None:
+        return jsonify({"error": "Unknown capture job"}), 404
+    # Released when the response is closed, including on disconnects.
+    if not CAPTURE_EVENT_STREAMS.acquire(  # pylint: disable=consider-using-with
+        blocking=False
+    ):
+        return jsonify({"error": "Too many event streams, poll instead"}), 503
+
+    def generate():
+        deadline = time.monotonic() + CAPTURE_EVENTS_TIMEOUT
+        delay = CAPTURE_EVENTS_POLL
+        last = None
+        while True:
+            job = capture_jobs.get(job_id, username)
+            if job is None:
+                yield server_sent_event("result", {"error": "Unknown capture job"})
+                return
+            status = job_status(job)
+            if job["status"] in FINISHED:
+                yield server_sent_event("result", status)
+                return
+            if status != last:
+                yield server_sent_event("status", status)
+                last = status
+            if time.monotonic() >= deadline:
+                yield server_sent_event("timeout", status)
+                return
+            time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            delay = min(delay * 2, CAPTURE_EVENTS_MAX_POLL)
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+    response.call_on_close(CAPTURE_EVENT_STREAMS.release)
+    return response
+
+
+def create_username_index():
+    """
+    Create the unique index on usernames, which registration relies on.
+    Raises:
+        pymongo.errors.PyMongoError: If MongoDB is unavailable, or existing
+            duplicate usernames prevent building the index.
+    """
+    users_collection.create_index("username", unique=True)
+    USERNAME_INDEX.set()
+
+
+def username_index_ready():
+    """
+    Return whether usernames are guaranteed unique, creating the index now
+    if startup could not.
+    """
+    if not USERNAME_INDEX.is_set():
+        try:
+            create_username_index()
+        except PyMongoError as e:
+            app.logger.error("Unique username index is missing: %s", e)
+    return USERNAME_INDEX.is_set()
+
+
+def index_steps():
+    """
+    Return the steps creating the indexes the queries rely on.
+    Returns:
+        list: ``(name, create)`` pairs; each create call makes one
+        collection's indexes.
+    """
+    return [
+        (
+            "history",
+            lambda: db.history.create_index(
+                [
+                    ("username", ASCENDING),
+                    ("timestamp", DESCENDING),
+                    ("_id", DESCENDING),
+                ]
+            ),
+        ),
+        ("analytics", lambda: db.analytics.create_index("username", unique=True)),
+        ("users", create_username_index),
+        ("capture_jobs", capture_jobs.ensure_indexes),
+        ("history_rollups", history_retention.ensure_indexes),
+        (
+            BUCKETS,
+            lambda: db[BUCKETS].create_index(
+                [
+                    ("_id.scope", ASCENDING),
+                    ("_id.period", ASCENDING),
+                    ("_id.start", DESCENDING),
+                ]
+            ),
+        ),
+    ]
 
-    return jsonify({"match": matched_character})
+
+def create_indexes(steps):
+    """
+    Run index steps, each on its own so one failure does not skip the rest.
+    Args:
+        steps (list): ``(name, create)`` pairs from index_steps.
+    Returns:
+        list: The steps that failed.
+    """
+    failed = []
+    for name, create in steps:
+        try:
+            create()
+        except PyMongoError as e:
+            app.logger.error("Failed to create the %s indexes: %s", name, e)
+            failed.append((name, create))
+    return failed
+
+
+def retry_indexes(steps):
+    """Retry failed index steps, backing off, until all of them succeed."""
+    delay = INDEX_RETRY_INTERVAL
+    while steps:
+        time.sleep(delay)
+        steps = create_indexes(steps)
+        delay = min(delay * 2, INDEX_RETRY_MAX_INTERVAL)
+    app.logger.info("Created the remaining MongoDB indexes")
+
+
+def ensure_indexes():
+    """
+    Create the indexes the queries rely on.
+    Creating an index that already exists is a no-op, so this is safe to run
+    on every start. Indexes that cannot be created, e.g. while MongoDB is
+    still starting, are logged and retried in the background so the app
+    still starts.
+    Returns:
+        bool: Whether every index was created.
+    """
+    failed = create_indexes(index_steps())
+    if failed:
+        threading.Thread(
+            target=retry_indexes, args=(failed,), name="index-retry", daemon=True
+        ).start()
+    return not failed
+
+
+def parse_history_cursor(values):
+    """
+    Build the keyset filter for a page of history from request arguments.
+    Args:
+        values (Mapping): ``before``, the ISO 8601 UTC timestamp of the last
+            record already shown, and ``before_id``, its id.
+    Returns:
+        dict: Extra query conditions; empty for the first page.
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    if "before" not in values:
+        return {}
+    before = datetime.fromisoformat(values["before"])
+    if before.tzinfo is None:
+        before = before.replace(tzinfo=timezone.utc)
+    if "before_id" not in values:
+        return {"timestamp": {"$lt": before}}
+    try:
+        before_id = ObjectId(values["before_id"])
+    except InvalidId as e:
+        raise ValueError(str(e)) from e
+    return {
+        "$or": [
+            {"timestamp": {"$lt": before}},
+            {"timestamp": before, "_id": {"$lt": before_id}},
+        ]
+    }
+
+
+def history_entry(record, eastern):
+    """
+    Format a history record for the client.
+    Args:
+        record (dict): A history document with its timestamp.
+        eastern (tzinfo): The time zone timestamps are shown in.
+    Returns:
+        dict: The character and local timestamp; for a daily rollup, the
+        UTC date and the ``count`` of captures instead.
+    """
+    if "count" in record:
+        return {
+            "character": record["matched_character"],
+            "timestamp": record["timestamp"].date().isoformat(),
+            "count": record["count"],
+        }
+    timestamp = record["timestamp"]
+    if isinstance(timestamp, str):
+        dt_object = datetime.fromisoformat(timestamp)
+    else:
+        dt_object = timestamp
+    if dt_object.tzinfo is None:
+        dt_object = dt_object.replace(tzinfo=timezone.utc)
+
+    local_time = dt_object.astimezone(eastern).strftime("%Y-%m-%d %H:%M:%S")
+    return {"character": record["matched_character"], "timestamp": local_time}
+
+
+def next_history_cursor(records, limit):
+    """
+    Return the cursor of the page of history after ``records``.
+    Args:
+        records (list): The history documents of this page, newest first.
+        limit (int): The page size they were fetched with.
+    Returns:
+        dict: ``next_before`` and ``next_before_id``, or nothing on the
+        last page.
+    """
+    if len(records) < limit or not isinstance(records[-1]["timestamp"], datetime):
+        return {}
+    last = records[-1]
+    return {
+        "next_before": last["timestamp"].replace(tzinfo=None).isoformat(),
+        "next_before_id": str(last["_id"]),
+    }
 
 
 @app.route("/history", methods=["GET"])
 def history():
-    """Retrieve match history for the logged-in user."""
+    """
+    Retrieve match history for the logged-in user, newest first.
+    Results are paged: pass the ``next_before`` and ``next_before_id`` of a
+    response as ``before`` and ``before_id`` to get the following page.
+    Captures older than the retention period are listed per day and
+    character with their ``count``.
+    """
     if "username" not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
+    try:
+        limit = int(request.args.get("limit", HISTORY_PAGE_SIZE))
+        cursor_filter = parse_history_cursor(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid history cursor: {e}"}), 400
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
     eastern = pytz.timezone("America/New_York")
-    history_records = db.history.find({"username": session["username"]}).sort(
-        "timestamp", -1
+    records = history_page(
+        db,
+        {"username": session["username"], **cursor_filter},
+        HISTORY_PROJECTION,
+        limit,
     )
-    history_list = []
-
-    for record in history_records:
-        timestamp = record["timestamp"]
-        if isinstance(timestamp, str):
-            dt_object = datetime.fromisoformat(timestamp)
-        else:
-            dt_object = timestamp
+    body = {"history": [history_entry(record, eastern) for record in records]}
+    body.update(next_history_cursor(records, limit))
+    return jsonify(body)
+
+
+@app.route("/history/rescore", methods=["POST"])
+def rescore_history():
+    """
+    Match a page of the logged-in user's captures against the current gallery.
+    The stored face encodings are sent to the ML service's /match endpoint,
+    so no image is uploaded or detected again. Paging works as for
+    /history. Captures recorded without an encoding, and daily rollups of
+    older captures, have a ``current`` of None. The stored history is left
+    unchanged.
+    """
+    if "username" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
 
-        local_time = dt_object.astimezone(eastern).strftime("%Y-%m-%d %H:%M:%S")
-        history_list.append(
-            {"character": record["matched_character"], "timestamp": local_time}
-        )
+    try:
+        limit = int(request.values.get("limit", HISTORY_PAGE_SIZE))
+        cursor_filter = parse_history_cursor(request.values)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid history cursor: {e}"}), 400
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    records = history_page(
+        db,
+        {"username": session["username"], **cursor_filter},
+        {**HISTORY_PROJECTION, "encoding": 1},
+        limit,
+    )
+    encoded = [record for record in records if record.get("encoding")]
+    matches = []
+    if encoded:
+        try:
+            response = ml_service.match(
+                [base64.b64encode(record["encoding"]).decode() for record in encoded],
+                request_id=request_id(),
+            )
+            if response.status_code == 503:
+                return degraded_response(response.headers.get("Retry-After", "1"))
+            response.raise_for_status()
+        except CircuitOpen:
+            return degraded_response(ML_RETRY_AFTER)
+        except requests.exceptions.RequestException as e:
+            app.logger.error("Error communicating with ML service: %s", e)
+            return jsonify({"error": "Failed to rescore history"}), 500
+        matches = response.json()["results"]
+
+    current = {id(record): match for record, match in zip(encoded, matches)}
+    eastern = pytz.timezone("America/New_York")
+    entries = []
+    for record in records:
+        entry = history_entry(record, eastern)
+        match = current.get(id(record))
+        entry["current"] = match["matched_character"] if match else None
+        entry["distance"] = match.get("distance") if match else None
+        entries.append(entry)
+    body = {"history": entries}
+    body.update(next_history_cursor(records, limit))
+    return jsonify(body)
+
+
+@app.route("/history/export", methods=["GET"])
+def export_history():
+    """Stream the logged-in user's full match history as a JSON document."""
+    if "username" not in session:
+        return jsonify({"error": "Unauthorized"}), 401
 
-    return jsonify({"history": history_list})
+    username = session["username"]
+    eastern = pytz.timezone("America/New_York")
+    records = iter_history(db, username, HISTORY_PROJECTION, HISTORY_EXPORT_BATCH)
+
+    def generate():
+        yield '{"history": ['
+        separator = ""
+        for record in records:
+            yield separator + json.dumps(history_entry(record, eastern))
+            separator = ","
+        yield "]}"
+
+    filename = f"{secure_filename(username)}-history.json"
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/json",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 
 @app.route("/analytics", methods=["GET"])
 def analytics():
-    """Provide analytics data for the logged-in user."""
+    """
+    Provide the character distribution of the logged-in user or of everyone.
+    ``scope`` is ``user`` (default) or ``global``. ``period`` is ``all``
+    (default) for all-time percentages, or ``day`` or ``week`` for the most
+    recent ``limit`` buckets, newest first.
+    """
     if "username" not in session:
         return jsonify({"error": "Unauthorized"}), 401
 
-    user_analytics_data = db.analytics.find_one({"username": session["username"]})
-    if (
-        not user_analytics_data
-        or "characters" not in user_analytics_data
-        or user_analytics_data["total"] == 0
-    ):
-        return jsonify({"data": []})
+    scope = request.args.get("scope", "user")
+    period = request.args.get("period", "all")
+    if scope not in ("user", "global") or period not in ("all", "day", "week"):
+        return jsonify({"error": "Invalid analytics scope or period"}), 400
+
+    if period == "all":
+        if scope == "global":
+            return jsonify({"data": global_distribution.get()})
+        return jsonify(
+            {
+                "data": distribution(
+                    db.analytics.find_one({"username": session["username"]})
+                )
+            }
+        )
 
-    data = [
-        {
-            "character": character,
-            "percentage": (count / user_analytics_data["total"]) * 100,
-        }
-        for character, count in user_analytics_data["characters"].items()
-    ]
-    return jsonify({"data": data})
+    try:
+        limit = int(request.args.get("limit", 7))
+    except ValueError:
+        return jsonify({"error": "Invalid analytics limit"}), 400
+    limit = max(1, min(limit, ANALYTICS_MAX_BUCKETS))
+    owner = GLOBAL_SCOPE if scope == "global" else session["username"]
+    return jsonify({"buckets": bucket_series(db, owner, period, limit)})
+
+
+@app.cli.command("rebuild-analytics")
+def rebuild_analytics():
+    """Recompute the global and time-bucketed analytics from history."""
+    rebuild_buckets(db)
+    global_distribution.invalidate()
+
+
+@app.cli.command("rollup-history")
+def rollup_history():
+    """Roll up the captures older than HISTORY_RETENTION_DAYS now."""
+    ensure_indexes()
+    history_retention.run_once()
+
+
+def start_capture_workers():
+    """Start this process's capture job consumers if job mode is enabled."""
+    if CAPTURE_JOBS:
+        capture_workers.start()
+
+
+@app.cli.command("capture-worker")
+def capture_worker():
+    """Consume capture jobs with CAPTURE_WORKERS threads until stopped."""
+    ensure_indexes()
+    capture_workers.start()
+    threading.Event().wait()
+
+
+@app.cli.command("build-image-variants")
+def build_image_variants():
+    """Generate the thumbnails and WebP copies of the character images."""
+    image_catalog.refresh()
 
 
 if __name__ == "__main__":
+    ensure_indexes()
+    start_capture_workers()
+    history_retention.start()
     app.run(host="0.0.0.0", port=5001)